@@ -0,0 +1,326 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import Manager, get_context
+from types import SimpleNamespace
+
+from zoe import ZoeRecordCollector, P2PCustomerIndex, RecordFormatterPool, format_record_batch, build_detail_record
+from zoe import build_p2p_columns, format_arrow_batch, pa, peak_rss_bytes
+from zoe import parse_id, write_new_mode_file, get_zoe_file_hash, process_delta_mode
+from zoe_synth import SCALES, synth_dna_rows, synth_p2p_customers, synth_zoe_records, write_synth_zoe_file
+
+SAMPLE_LINE = "|".join(["ACC0000001", "123456"] + [f"FIELD{i}" for i in range(55)])
+
+
+def _proxy_worker(zoe_data, thread_id: int, records: int, batch_size: int):
+    """mimics the old path: one Manager proxy append per record"""
+    for _ in range(0, records, batch_size):
+        for _ in range(batch_size):
+            zoe_data.append(SAMPLE_LINE)
+
+
+def _collector_worker(zoe_data, thread_id: int, records: int, batch_size: int):
+    """hands each fetch batch to the collector in one call"""
+    for _ in range(0, records, batch_size):
+        zoe_data.add_batch((0, thread_id), [SAMPLE_LINE] * batch_size)
+
+
+def _run_threads(target, zoe_data, threads: int, records: int, batch_size: int) -> float:
+    workers = [
+        threading.Thread(target=target, args=(zoe_data, thread_id, records, batch_size))
+        for thread_id in range(threads)
+    ]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - start
+
+
+def bench_collection(threads: int, records: int, batch_size: int):
+    """compares Manager().list() appends with the in-process ZoeRecordCollector"""
+    total = threads * records
+
+    with Manager() as manager:
+        proxy = manager.list()
+        proxy_secs = _run_threads(_proxy_worker, proxy, threads, records, batch_size)
+        assert len(proxy) == total
+
+    collector = ZoeRecordCollector()
+    collector_secs = _run_threads(_collector_worker, collector, threads, records, batch_size)
+    assert len(collector.records()) == total
+
+    print(f"records: {total} threads: {threads} batch: {batch_size}")
+    print(f"manager proxy : {proxy_secs:8.3f}s {total / proxy_secs:12,.0f} rec/s")
+    print(f"collector     : {collector_secs:8.3f}s {total / collector_secs:12,.0f} rec/s")
+    print(f"speedup       : {proxy_secs / collector_secs:8.1f}x")
+
+
+def _sample_rows(count: int) -> list:
+    rows = []
+    for i in range(count):
+        row = [f"ACC{i:08d}", 100000 + i % 5000] + [f"VALUE{c}" for c in range(2, 50)]
+        row[16] = f"DL:{i}:NC:USA:D{i:07d}:20300101"
+        rows.append(tuple(row))
+    return rows
+
+
+def _sample_p2p() -> P2PCustomerIndex:
+    return P2PCustomerIndex(
+        ["persnbr", "CXCCustomerID", "registeredEmail", "registeredPhone"],
+        [(100000 + i, f"CXC{i}", f"user{i}@example.com", "5555550100") for i in range(0, 5000, 3)],
+    )
+
+
+def _format_in_threads(batches: list, threads: int, p2p_cust, formatter=None) -> float:
+    """each thread formats its share of the batches, either inline or through the formatter pool"""
+    def worker(thread_id):
+        pending = []
+        for batch in batches[thread_id::threads]:
+            if formatter is None:
+                format_record_batch(batch, p2p_cust, False)
+            else:
+                pending.append(formatter.submit(batch, False))
+        for future in pending:
+            future.result()
+
+    workers = [threading.Thread(target=worker, args=(thread_id,)) for thread_id in range(threads)]
+    start = time.perf_counter()
+    for worker_thread in workers:
+        worker_thread.start()
+    for worker_thread in workers:
+        worker_thread.join()
+    return time.perf_counter() - start
+
+
+def bench_formatting(thread_counts: list, format_workers: int, records: int, batch_size: int):
+    """record formatting throughput inside the fetching threads against a FORMAT_WORKERS process pool"""
+    rows = _sample_rows(records)
+    batches = [rows[pos:pos + batch_size] for pos in range(0, records, batch_size)]
+    p2p_cust = _sample_p2p()
+
+    formatter = RecordFormatterPool(format_workers, p2p_cust)
+    formatter.submit(batches[0], False).result()  # start the worker processes before timing
+    try:
+        print(f"records: {records} format workers: {format_workers}")
+        for threads in thread_counts:
+            in_thread = _format_in_threads(batches, threads, p2p_cust)
+            pooled = _format_in_threads(batches, threads, p2p_cust, formatter)
+            print(
+                f"MAX_THREADS {threads:3d}: in-thread {records / in_thread:12,.0f} rec/s   "
+                f"process pool {records / pooled:12,.0f} rec/s"
+            )
+    finally:
+        formatter.shutdown()
+
+
+def _best_of(repeat: int, func) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def bench_detail_layout(records: int, batch_size: int):
+    """per-row build_detail_record against the compiled DETAIL_LAYOUT formatter"""
+    rows = _sample_rows(records)
+    batches = [rows[pos:pos + batch_size] for pos in range(0, records, batch_size)]
+    p2p_cust = _sample_p2p()
+
+    per_row = _best_of(3, lambda: [
+        [build_detail_record(list(row), p2p_cust, False) for row in batch] for batch in batches
+    ])
+    compiled = _best_of(3, lambda: [format_record_batch(batch, p2p_cust, False) for batch in batches])
+
+    print(f"records: {records} detail layout")
+    print(f"build_detail_record : {records / per_row:12,.0f} rec/s")
+    print(f"compiled layout     : {records / compiled:12,.0f} rec/s ({per_row / compiled:.1f}x)")
+
+
+def bench_columnar(records: int, batch_size: int):
+    """compiled row formatter against the Arrow column-wise formatter of COLUMNAR_YN"""
+    if pa is None:
+        print("pyarrow not installed, skipping the columnar benchmark")
+        return
+    rows = _sample_rows(records)
+    batches = [rows[pos:pos + batch_size] for pos in range(0, records, batch_size)]
+    tables = [
+        pa.table({f"c{pos}": list(column) for pos, column in enumerate(zip(*batch))}) for batch in batches
+    ]
+    p2p_cust = _sample_p2p()
+    p2p_columns = build_p2p_columns(p2p_cust)
+
+    row_path = _best_of(3, lambda: [format_record_batch(batch, p2p_cust, False) for batch in batches])
+    columnar = _best_of(3, lambda: [format_arrow_batch(table, p2p_columns, False) for table in tables])
+
+    print(f"records: {records} columnar formatting")
+    print(f"row path     : {records / row_path:12,.0f} rec/s")
+    print(f"columnar     : {records / columnar:12,.0f} rec/s ({row_path / columnar:.1f}x)")
+
+
+def _row_batches(count: int, batch_size: int = 10000):
+    batch = []
+    for row in synth_dna_rows(count):
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _suite_build_detail_record(count: int, workdir: str) -> float:
+    p2p_cust = synth_p2p_customers(count)
+    secs = 0.0
+    for batch in _row_batches(count):
+        start = time.perf_counter()
+        for row in batch:
+            build_detail_record(list(row), p2p_cust, False)
+        secs += time.perf_counter() - start
+    return secs
+
+
+def _suite_parse_id(count: int, workdir: str) -> float:
+    secs = 0.0
+    for batch in _row_batches(count):
+        ids = [row[16] for row in batch]
+        start = time.perf_counter()
+        for id_record in ids:
+            parse_id(id_record)
+        secs += time.perf_counter() - start
+    return secs
+
+
+def _suite_write_new_mode_file(shards: int):
+    def bench(count: int, workdir: str) -> float:
+        records = [line for lines in synth_zoe_records(count) for line in lines]
+        apwx = SimpleNamespace(args=SimpleNamespace(
+            TEST_YN="Y", SIDECAR_YN="N", DELTA_OUTPUT_FILE_NAME=None, OUTPUT_SHARDS=str(shards),
+        ))
+        start = time.perf_counter()
+        write_new_mode_file(os.path.join(workdir, "new.txt"), records, apwx, None)
+        return time.perf_counter() - start
+    return bench
+
+
+def _suite_get_zoe_file_hash(count: int, workdir: str) -> float:
+    zoe_file = write_synth_zoe_file(os.path.join(workdir, "zoe.txt"), count)
+    start = time.perf_counter()
+    get_zoe_file_hash(zoe_file)
+    return time.perf_counter() - start
+
+
+def _suite_process_delta_mode(engine: str):
+    def bench(count: int, workdir: str) -> float:
+        old_file = write_synth_zoe_file(os.path.join(workdir, "old.txt"), count)
+        new_file = write_synth_zoe_file(os.path.join(workdir, "new.txt"), count, change_rate=0.01)
+        apwx = SimpleNamespace(args=SimpleNamespace(
+            OLD_ZOE_FILE=old_file, NEW_ZOE_FILE=new_file, TEST_YN="Y", DELTA_ENGINE=engine,
+            DELTA_MEMORY_MB="256", DELTA_DELETES_YN="Y", DELTA_WORKERS="1",
+        ))
+        start = time.perf_counter()
+        process_delta_mode(apwx, os.path.join(workdir, "delta.txt"))
+        return time.perf_counter() - start
+    return bench
+
+
+SUITE = {
+    "build_detail_record": _suite_build_detail_record,
+    "parse_id": _suite_parse_id,
+    "write_new_mode_file": _suite_write_new_mode_file(1),
+    "write_new_mode_file[shards=4]": _suite_write_new_mode_file(4),
+    "get_zoe_file_hash": _suite_get_zoe_file_hash,
+    "process_delta_mode[HASH]": _suite_process_delta_mode("HASH"),
+    "process_delta_mode[SORT]": _suite_process_delta_mode("SORT"),
+    "process_delta_mode[DIGEST]": _suite_process_delta_mode("DIGEST"),
+}
+
+
+def _run_suite_case(name: str, count: int, repeat: int) -> dict:
+    """runs in a fresh process, so the peak RSS belongs to this benchmark alone"""
+    with tempfile.TemporaryDirectory(prefix="zoe-bench-") as workdir, contextlib.redirect_stdout(io.StringIO()):
+        secs = min(SUITE[name](count, workdir) for _ in range(repeat))
+    peak = peak_rss_bytes()
+    return {
+        "rec_per_sec": round(count / secs) if secs else None,
+        "secs": round(secs, 3),
+        "peak_mb": round(peak / 1048576, 1) if peak is not None else None,  # None where the platform has no rusage
+    }
+
+
+def bench_suite(scale: str, baseline_file: str, save_baseline: bool, tolerance: float, repeat: int = 3) -> bool:
+    """times the main code paths on seeded synthetic data and compares them with the stored baselines;
+    returns False when a benchmark regressed by more than 'tolerance'"""
+    count = SCALES[scale]
+    baselines = {}
+    if os.path.exists(baseline_file):
+        with open(baseline_file, "r") as f:
+            baselines = json.load(f)
+    baseline = baselines.get(scale, {})
+
+    results = {}
+    regressions = []
+    print(f"records: {count} ({scale})")
+    for name in SUITE:
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+            result = results[name] = pool.submit(_run_suite_case, name, count, repeat).result()
+        note = ""
+        base = baseline.get(name)
+        if base:
+            if result["rec_per_sec"] < base["rec_per_sec"] * (1 - tolerance):
+                regressions.append(name)
+                note = f"  SLOWER than baseline {base['rec_per_sec']:,} rec/s"
+            elif result["peak_mb"] and base.get("peak_mb") and result["peak_mb"] > base["peak_mb"] * (1 + tolerance):
+                regressions.append(name)
+                note = f"  MORE MEMORY than baseline {base['peak_mb']} MB"
+        peak_mb = f"{result['peak_mb']:8.1f} MB" if result["peak_mb"] is not None else "       - MB"
+        print(f"{name:28s} {result['rec_per_sec']:12,} rec/s {result['secs']:9.3f}s peak {peak_mb}{note}")
+
+    if save_baseline:
+        baselines[scale] = results
+        with open(baseline_file, "w") as f:
+            json.dump(baselines, f, indent=2)
+        print(f"saved baseline to {baseline_file}")
+        return True
+    if not baseline:
+        print(f"no {scale} baseline in {baseline_file}, run with --save-baseline to record one")
+    if regressions:
+        print(f"regressed: {', '.join(regressions)}")
+    return not regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ZOE performance benchmarks")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--records", type=int, default=20000, help="records per thread")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--format-workers", type=int, default=4)
+    parser.add_argument("--format-records", type=int, default=200000)
+    parser.add_argument("--suite", action="store_true", help="run the end-to-end suite against baselines instead")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="10k")
+    parser.add_argument("--baseline-file", default="bench_baselines.json")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown/memory growth")
+    parser.add_argument("--repeat", type=int, default=3, help="suite timings are the best of this many runs")
+    args = parser.parse_args()
+    if args.suite:
+        if not bench_suite(args.scale, args.baseline_file, args.save_baseline, args.tolerance, args.repeat):
+            raise SystemExit(1)
+        return
+    bench_collection(args.threads, args.records, args.batch_size)
+    bench_detail_layout(args.format_records, args.batch_size)
+    bench_columnar(args.format_records, args.batch_size)
+    bench_formatting([1, 2, 4, 8, 16], args.format_workers, args.format_records, args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
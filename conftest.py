@@ -1,7 +1,9 @@
+import dataclasses
 import os
 import pathlib
 import pytest
 from dataclasses import dataclass
+from typing import Optional
 from unittest.mock import MagicMock
 
 from zoe import AppWorxEnum, get_config, ScriptData
@@ -20,6 +22,26 @@ class FakeApwxArgs:
     P2P_SCHEMA: str
     OLD_ZOE_FILE: str = "old_zoe.txt"
     NEW_ZOE_FILE: str = "new_zoe.txt"
+    STREAM_YN: str = "N"
+    P2P_SNAPSHOT_FILE: Optional[str] = None
+    FORMAT_WORKERS: str = "0"
+    TASK_STATS_FILE: Optional[str] = None
+    FETCH_MEMORY_MB: str = "64"
+    COLUMNAR_YN: str = "N"
+    DELTA_ENGINE: str = "HASH"
+    DELTA_MEMORY_MB: str = "512"
+    DELTA_DELETES_YN: str = "N"
+    SIDECAR_YN: str = "N"
+    DELTA_WORKERS: str = "1"
+    INCREMENTAL_YN: str = "N"
+    WATERMARK_FILE: Optional[str] = None
+    DELTA_OUTPUT_FILE_NAME: Optional[str] = None
+    METRICS_FILE: Optional[str] = None
+    CHECKPOINT_DIR: Optional[str] = None
+    RESUME_YN: str = "N"
+    ENGINE: str = "THREAD"
+    OUTPUT_SHARDS: str = "1"
+    P2P_SNAPSHOT_MAX_AGE_HOURS: str = "24"
 
 @dataclass
 class FakeApwx:
@@ -69,6 +91,13 @@ def new_fake_apwx(script_args: dict) -> FakeApwx:
         )
     )
 
+@pytest.fixture
+def apwx_with():
+    """builds a FakeApwx from a ScriptData fixture's arguments with some of them overridden"""
+    def build(script_data: ScriptData, **overrides) -> FakeApwx:
+        return FakeApwx(args=dataclasses.replace(script_data.apwx.args, **overrides))
+    return build
+
 @pytest.fixture(scope="module")
 def script_data_new():
     apwx = new_fake_apwx(SCRIPT_ARGUMENTS_NEW)
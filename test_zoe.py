@@ -4,6 +4,15 @@ from pathlib import Path
 from unittest.mock import patch, MagicMock
 
 from zoe import run, process_new_mode, process_delta_mode, build_detail_record, build_header_record, build_trailer_record
+from zoe import ZoeRecordCollector, StreamingZoeWriter, write_new_mode_file
+from zoe import P2PCustomerIndex, P2PSnapshotIndex, load_p2p_customers, p2p_watermark_text, parse_p2p_watermark
+from zoe import ConnectionPool, RecordFormatterPool, format_record_batch, process_query_key
+from zoe import build_zoe_tasks, load_task_durations, save_task_durations
+from zoe import plan_partitions, bind_values, FetchTuner
+from zoe import compile_detail_formatter, build_p2p_columns, format_arrow_batch, process_query_key_columnar
+from zoe import ExternalSorter, get_zoe_file_hash, load_zoe_sidecar, ZoeFileReader, iter_zoe_records
+from zoe import merge_incremental_records, load_incremental_state, save_incremental_state, process_zoe_task
+from zoe import ZoeTask, ZoeExtraction, ZoeCheckpoint, ScriptData, RunProfiler, profiled, QUERY_KEYS
 
 def test_run_new_mode(script_data_new, mocker):
     apwx = script_data_new.apwx
@@ -89,4 +98,790 @@ def test_build_trailer_record():
     result = build_trailer_record(args)
     assert result.startswith("9|LOAD|03|FTF")
     assert "CDE0083" in result and "CDE0084" in result
-    assert "CDE0123:123" in result or ":123" in result
\ No newline at end of file
+    assert "CDE0123:123" in result or ":123" in result
+
+
+def test_record_collector_orders_by_slot():
+    collector = ZoeRecordCollector()
+    collector.add_batch((1, 0), ["k1-t0-a", "k1-t0-b"])
+    collector.add_batch((0, 1), ["k0-t1"])
+    collector.add_batch((0, 0), ["k0-t0"])
+    collector.add_batch((1, 0), ["k1-t0-c"])
+    collector.add_batch((0, 0), [])
+    assert len(collector) == 5
+    assert collector.records() == ["k0-t0", "k0-t1", "k1-t0-a", "k1-t0-b", "k1-t0-c"]
+
+
+def test_streaming_writer_matches_buffered_file(script_data_new, tmp_path):
+    apwx = script_data_new.apwx
+    records = [f"ACC{i}|PERS{i}|CXC|{i}|" + "|".join(str(n) for n in range(52)) for i in range(1, 6)]
+    file_stat = os.stat(tmp_path)
+    buffered = tmp_path / "buffered.txt"
+    streamed = tmp_path / "streamed.txt"
+    write_new_mode_file(str(buffered), records, apwx, file_stat)
+
+    zoe_writer = StreamingZoeWriter(str(streamed), apwx.args.TEST_YN, file_stat, max_batches=1)
+    zoe_writer.start()
+    zoe_writer.add_batch((0, 0), records[:2])
+    zoe_writer.add_batch((0, 1), records[2:])
+    zoe_writer.close()
+
+    assert len(zoe_writer) == 5
+    assert streamed.read_text() == buffered.read_text()
+    assert "CDE0110:15|CDE0111:5" in streamed.read_text().splitlines()[-1]
+
+
+def test_load_p2p_customers_streams_all_batches(script_data_new):
+    batches = [[(1, "CXC1", "one@email.com"), (None, "", "")], [(2, "CXC2", "")], []]
+    cur = MagicMock()
+    cur.description = [("persnbr",), ("CXCCustomerID",), ("registeredEmail",)]
+    cur.fetchmany.side_effect = batches
+    p2p_dbh = MagicMock()
+    p2p_dbh.cursor.return_value.__enter__.return_value = cur
+    script_data = MagicMock(config={"p2p_cust_org": "select ..."})
+
+    p2p_cust = load_p2p_customers(p2p_dbh, script_data)
+
+    assert isinstance(p2p_cust, P2PCustomerIndex)
+    assert len(p2p_cust) == 2
+    assert len(p2p_cust.rows) == 3
+    assert p2p_cust[1] == {"persnbr": 1, "CXCCustomerID": "CXC1", "registeredEmail": "one@email.com"}
+    assert None not in p2p_cust
+    assert p2p_cust.get(3) is None
+
+
+def test_build_detail_record_with_p2p_index():
+    p2p_cust = P2PCustomerIndex(
+        ["persnbr", "CXCCustomerID", "registeredEmail", "registeredPhone"],
+        [("PERS456", "CXC789", "test@email.com", "1234567890")],
+    )
+    record_ary = ["ACC123", "PERS456", "VAL1", "VAL2", "VAL3"]
+    plain = {"PERS456": {"CXCCustomerID": "CXC789", "registeredEmail": "test@email.com", "registeredPhone": "1234567890"}}
+    assert build_detail_record(record_ary, p2p_cust) == build_detail_record(record_ary, plain)
+
+
+def _fake_p2p_dbh(description, batches):
+    cur = MagicMock()
+    cur.description = description
+    cur.fetchmany.side_effect = batches
+    p2p_dbh = MagicMock()
+    p2p_dbh.cursor.return_value.__enter__.return_value = cur
+    return p2p_dbh, cur
+
+
+def test_p2p_snapshot_refreshes_incrementally(tmp_path):
+    snapshot = str(tmp_path / "p2p.sqlite")
+    description = [("persnbr",), ("CXCCustomerID",), ("updated",)]
+    script_data = MagicMock(config={
+        "p2p_cust_org": "select all",
+        "p2p_cust_org_changed": "select changed",
+        "p2p_watermark_column": "updated",
+    })
+
+    p2p_dbh, cur = _fake_p2p_dbh(description, [[(1, "CXC1", 10), (2, "CXC2", 20), (None, "X", 30)], []])
+    p2p_cust = load_p2p_customers(p2p_dbh, script_data, snapshot)
+    assert isinstance(p2p_cust, P2PSnapshotIndex)
+    assert len(p2p_cust) == 2
+    assert cur.execute.call_args.args == ("select all",)
+
+    p2p_dbh, cur = _fake_p2p_dbh(description, [[(2, "CXC2-NEW", 25), (3, "CXC3", 22)], []])
+    p2p_cust = load_p2p_customers(p2p_dbh, script_data, snapshot)
+    assert cur.execute.call_args.args == ("select changed", 20)
+    assert len(p2p_cust) == 3
+    assert p2p_cust[2]["CXCCustomerID"] == "CXC2-NEW"
+    assert 1 in p2p_cust and 4 not in p2p_cust
+    assert [row[0] for row in p2p_cust.rows] == [1, 2, 3]
+
+    p2p_cust = load_p2p_customers(None, script_data, snapshot)
+    assert p2p_cust.get(3) == {"persnbr": 3, "CXCCustomerID": "CXC3", "updated": 22}
+
+    import sqlite3
+    from datetime import datetime
+    conn = sqlite3.connect(snapshot)
+    assert conn.execute("SELECT value FROM p2p_meta WHERE name = 'watermark'").fetchone() == ("25",)
+    conn.execute("UPDATE p2p_meta SET value = '2024-03-01T06:30:00' WHERE name = 'full_loaded'")
+    conn.commit()
+    conn.close()
+    # past the maximum age the snapshot is reloaded in full, which drops the persons deleted in P2P
+    p2p_dbh, cur = _fake_p2p_dbh(description, [[(1, "CXC1", 10), (3, "CXC3", 30)], []])
+    p2p_cust = load_p2p_customers(p2p_dbh, script_data, snapshot, max_age_hours=24)
+    assert cur.execute.call_args.args == ("select all",)
+    assert 2 not in p2p_cust and len(p2p_cust) == 2
+
+    watermark = datetime(2024, 3, 1, 6, 30)
+    assert parse_p2p_watermark(p2p_watermark_text(watermark)) == watermark
+    assert parse_p2p_watermark(b"pickled by an older version") is None
+
+
+def test_connection_pool_warm_up_retry_and_reuse():
+    attempts = []
+
+    def connect():
+        attempts.append(1)
+        return MagicMock() if len(attempts) > 1 else None  # first attempt fails
+
+    pool = ConnectionPool("TEST", connect, size=2, retries=3, backoff=0)
+    assert pool.warm_up() == 2
+    assert pool.failures == 1
+
+    with pool.acquire() as first:
+        pass
+    with pool.acquire() as second:
+        assert second is first  # warm connection is reused
+    assert len(attempts) == 3
+
+    with pytest.raises(RuntimeError):
+        with pool.acquire() as broken:
+            raise RuntimeError("connection dropped")
+    broken.close.assert_called_once()
+
+    stats = pool.stats()
+    assert stats["connections"] == 2 and stats["failures"] == 1
+    pool.close()
+
+
+def test_connection_pool_gives_up_after_retries():
+    pool = ConnectionPool("TEST", lambda: None, size=1, retries=2, backoff=0)
+    with pytest.raises(ConnectionError):
+        with pool.acquire():
+            pass
+    assert pool.failures == 2
+
+
+def test_process_query_key_with_formatter_pool_keeps_order():
+    p2p_cust = P2PCustomerIndex(["persnbr", "CXCCustomerID"], [(7, "CXC7")])
+    rows = [(f"ACC{i}", i % 10, "X", f"USA:{i}") for i in range(25)]
+    cur = MagicMock()
+    cur.fetchmany.side_effect = [rows[:10], rows[10:20], rows[20:], []]
+    dbh = MagicMock()
+    dbh.cursor.return_value = cur
+    collector = ZoeRecordCollector()
+
+    formatter = RecordFormatterPool(2, p2p_cust)
+    try:
+        process_query_key("card_own_pers", dbh, "sql", p2p_cust, collector, 0, {}, formatter)
+        # the fetching threads are running, so the workers must not be forks of this process
+        assert formatter._executor._mp_context.get_start_method() != "fork"
+    finally:
+        formatter.shutdown()
+
+    assert collector.records() == format_record_batch(rows, p2p_cust, False)
+    assert "ACC7|7|CXC7" in collector.records()[7]
+
+
+def test_build_zoe_tasks_longest_expected_first():
+    durations = {"org:0": 5.0, "org:1": 1.0, "card_own_pers:1": 30.0}
+    tasks = build_zoe_tasks(2, durations)
+    names = [task.name for task in tasks]
+
+    assert len(tasks) == 6 * 2 + 1  # p2p_cust_org runs once
+    assert "p2p_cust_org:1" not in names
+    assert names[-3:] == ["card_own_pers:1", "org:0", "org:1"]
+    assert all(task.expected_secs is None for task in tasks[:-3])
+
+
+def test_task_durations_are_smoothed(tmp_path):
+    stats_file = str(tmp_path / "tasks.json")
+    assert load_task_durations(stats_file) == {}
+    save_task_durations(stats_file, {"org:0": 4.0}, {})
+    previous = load_task_durations(stats_file)
+    save_task_durations(stats_file, {"org:0": 2.0, "org:1": 1.0}, previous)
+    assert load_task_durations(stats_file) == {"org:0": 3.0, "org:1": 1.0}
+
+
+def test_plan_partitions_balances_row_counts():
+    histogram = [(0, 100), (10, 100), (20, 10), (30, 10), (40, 300), (50, 80)]
+    plan = plan_partitions(histogram, 3)
+    assert [(part["range_lo"], part["range_hi"]) for part in plan] == [(None, 20), (20, 50), (50, None)]
+    assert [part["expected_rows"] for part in plan] == [200, 320, 80]
+
+    assert plan_partitions([(1, 5)], 4) == [{"range_lo": None, "range_hi": None, "expected_rows": 5}]
+
+
+def test_planned_partitions_become_tasks_and_binds():
+    plan = plan_partitions([(0, 10), (5, 10)], 2)
+    tasks = build_zoe_tasks(4, {}, {"org": plan})
+    assert sorted(task.partition for task in tasks if task.key == "org") == [0, 1]
+    assert sorted(task.partition for task in tasks if task.key == "card_own_pers") == [0, 1, 2, 3]
+
+    sql = "select * from org where orgnbr >= :range_lo and (:range_hi is null or orgnbr < :range_hi)"
+    values = {"max_thread": 2, "thread_id": 1, "range_lo": 5, "range_hi": None}
+    assert bind_values(sql, values) == {"range_lo": 5, "range_hi": None}
+
+
+def test_fetch_tuner_grows_while_round_trips_dominate():
+    row = ("abcd", None, 12)  # 7 bytes estimated
+    tuner = FetchTuner("org", memory_budget=7 * 5000)
+    tuner.observe([row] * 1000, 1000, 0.1)
+    assert tuner.arraysize == 2000
+    tuner.observe([row] * 2000, 2000, 0.1)
+    assert tuner.arraysize == 4000
+    tuner.observe([row] * 4000, 4000, 0.1)
+    assert tuner.arraysize == 5000  # capped by the memory budget
+    tuner.observe([row] * 5000, 5000, 0.5)
+    assert tuner.arraysize == 5000  # throughput stopped improving
+    tuner.observe([row] * 10, 5000, 0.01)
+
+    stats = tuner.stats()
+    assert stats["round_trips"] == 5
+    assert stats["rows"] == 12010
+    assert stats["bytes"] == 12010 * 7
+
+
+def test_fetch_tuner_sizes_cursor():
+    cur = MagicMock()
+    cur.fetchmany.side_effect = [[(1,)] * 3, []]
+    tuner = FetchTuner("org", initial_rows=3)
+    tuner.configure(cur)
+    assert cur.prefetchrows == 4
+    assert list(tuner.fetch_batches(cur)) == [[(1,)] * 3]
+    assert tuner.stats()["round_trips"] == 2
+
+
+@pytest.mark.parametrize("is_org", [False, True])
+def test_compiled_detail_layout_matches_build_detail_record(is_org):
+    import random
+    rnd = random.Random(42)
+    p2p_cust = P2PCustomerIndex(
+        ["persnbr", "CXCCustomerID", "registeredEmail", "registeredPhone"],
+        [(pers, rnd.choice(["CXC", "", None]), rnd.choice(["a@b.com", None]), rnd.choice(["555", ""])) for pers in range(10)],
+    )
+    ids = [None, "", "DL:1:NC:USA:D123:2030", "PP:2:XX:CAN:P9:2031|DL:3:NC:USA::2032", "TX:4:ON:MEX:M1"]
+    for width in range(0, 56):
+        rows = []
+        for _ in range(30):
+            row = [rnd.choice([None, "val", 7, 1.5]) for _ in range(width)]
+            if width > 1:
+                row[1] = rnd.choice(list(range(12)) + [None])
+            if width > 16:
+                row[16] = rnd.choice(ids)
+            rows.append(tuple(row))
+        expected = [line for line in (build_detail_record(list(row), p2p_cust, is_org) for row in rows) if line]
+        assert format_record_batch(rows, p2p_cust, is_org) == expected, f"width {width}"
+    assert compile_detail_formatter(50, is_org) is compile_detail_formatter(50, is_org)
+
+
+@pytest.mark.parametrize("is_org", [False, True])
+def test_arrow_batch_matches_row_path(is_org):
+    pa = pytest.importorskip("pyarrow")
+    import datetime
+    import random
+    rnd = random.Random(7)
+    p2p_cust = P2PCustomerIndex(
+        ["persnbr", "CXCCustomerID", "registeredEmail", "registeredPhone"],
+        [(pers, rnd.choice(["CXC", "", None]), rnd.choice(["a@b.com", None]), rnd.choice(["555", ""])) for pers in range(10)],
+    )
+    p2p_columns = build_p2p_columns(p2p_cust)
+    values = [None, "val", 7, datetime.datetime(2024, 5, 6, 7, 8, 9)]
+    ids = [None, "", "DL:1:NC:USA:D123:2030", "PP:2:XX:CAN:P9:2031|DL:3:NC:USA::2032"]
+    for width in range(2, 56):
+        columns = []
+        for pos in range(width):
+            value = rnd.choice(values)
+            columns.append([rnd.choice([None, value]) for _ in range(30)])
+        columns[1] = [rnd.choice(list(range(12)) + [None]) for _ in range(30)]
+        if width > 16:
+            columns[16] = [rnd.choice(ids) for _ in range(30)]
+        table = pa.table({f"c{pos}": column for pos, column in enumerate(columns)})
+        rows = list(zip(*columns))
+        assert format_arrow_batch(table, p2p_columns, is_org) == format_record_batch(rows, p2p_cust, is_org), f"width {width}"
+
+
+def test_columnar_query_falls_back_on_float_columns():
+    pa = pytest.importorskip("pyarrow")
+    dbh = MagicMock()
+    dbh.fetch_df_batches.return_value = iter([pa.table({"acct": ["A1"], "pers": [1], "amt": [1.5]})])
+    zoe_data = ZoeRecordCollector()
+    p2p_columns = build_p2p_columns(P2PCustomerIndex(["persnbr", "CXCCustomerID"], []))
+    rows = process_query_key_columnar("org", dbh, "select 1", p2p_columns, zoe_data, 0, {})
+    assert rows is None
+    assert len(zoe_data) == 0
+
+
+def test_external_sorter_merges_spilled_runs():
+    sorter = ExternalSorter(memory_budget=1000, chunk_items=3)
+    values = [(n * 7919) % 101 for n in range(101)]
+    for value in values:
+        sorter.add((value, str(value)), 10)
+    assert len(sorter._runs) > 1
+    assert list(sorter.sorted()) == sorted((value, str(value)) for value in values)
+    sorter.close()
+
+
+def _write_zoe_file(path, records):
+    lines = ["CDE0001:X", "1|LOAD|03|FTF"]
+    lines += [f"6|A|03|FTF|{seq}|{acct}|{pers}|{value}" for seq, (acct, pers, value) in enumerate(records, 1)]
+    path.write_text("\n".join(lines) + "\n")
+
+
+@pytest.mark.parametrize("numpy_available", [True, False])
+@pytest.mark.parametrize("engine", ["SORT", "DIGEST", "PARALLEL"])
+@pytest.mark.parametrize("deletes", ["N", "Y"])
+def test_delta_engines_match_hash_delta(script_data_delta, apwx_with, tmp_path, monkeypatch, deletes, engine,
+                                        numpy_available):
+    if not numpy_available:
+        monkeypatch.setattr("zoe.np", None)
+    import random
+    rnd = random.Random(11)
+    old_file, new_file = tmp_path / "old.txt", tmp_path / "new.txt"
+    _write_zoe_file(old_file, [(f"A{n}", rnd.randint(0, 300), rnd.choice("xyz")) for n in range(500)])
+    _write_zoe_file(new_file, [(f"A{n}", rnd.randint(0, 350), rnd.choice("xyz")) for n in range(500)])
+
+    outputs = {}
+    for delta_engine in ("HASH", engine):
+        apwx = apwx_with(
+            script_data_delta, OLD_ZOE_FILE=str(old_file), NEW_ZOE_FILE=str(new_file),
+            DELTA_ENGINE="HASH" if delta_engine == "PARALLEL" else delta_engine,
+            DELTA_WORKERS="3" if delta_engine == "PARALLEL" else "1",
+            DELTA_MEMORY_MB="0.01", DELTA_DELETES_YN=deletes,
+        )
+        output_file = tmp_path / f"delta_{delta_engine}.txt"
+        assert process_delta_mode(apwx, str(output_file)) is True
+        outputs[delta_engine] = output_file.read_text().splitlines()
+
+    assert outputs["HASH"][:-1] == outputs[engine][:-1]  # trailers differ only in their timestamp
+    details = [line.split("|") for line in outputs[engine][2:-1]]
+    assert [fields[4] for fields in details] == [str(seq) for seq in range(1, len(details) + 1)]
+    removed = set(get_zoe_file_hash(str(old_file))[0]) - set(get_zoe_file_hash(str(new_file))[0])
+    assert sum(fields[1] == "D" for fields in details) == (len(removed) if deletes == "Y" else 0)
+
+
+def test_delta_from_sidecar_matches_parsed_files(script_data_delta, apwx_with, tmp_path, capsys):
+    import random
+    rnd = random.Random(5)
+    for name, start in (("old", 0), ("new", 40)):
+        apwx = apwx_with(script_data_delta, SIDECAR_YN="Y")
+        records = [f"ACC{n}|{n}|{rnd.choice('xy')}|" + "|".join(["f"] * 53) for n in range(start, start + 200)]
+        write_new_mode_file(str(tmp_path / f"{name}.txt"), records, apwx, None)
+        assert (tmp_path / f"{name}.txt.idx").exists()
+    count = len(load_zoe_sidecar(str(tmp_path / "old.txt"))[0])
+    assert count == 200
+
+    apwx = apwx_with(
+        script_data_delta, OLD_ZOE_FILE=str(tmp_path / "old.txt"), NEW_ZOE_FILE=str(tmp_path / "new.txt"),
+        DELTA_DELETES_YN="Y", DELTA_WORKERS="2",
+    )
+    capsys.readouterr()
+    process_delta_mode(apwx, str(tmp_path / "delta_sidecar.txt"))
+    log = capsys.readouterr().out
+    assert "comparing with the DIGEST engine" in log  # the HASH engine switched, and DELTA_WORKERS is noted
+    assert "DELTA_WORKERS=2 only splits the HASH engine, the DIGEST engine runs serially" in log
+    for name in ("old", "new"):
+        (tmp_path / f"{name}.txt.idx").unlink()
+    process_delta_mode(apwx, str(tmp_path / "delta_parsed.txt"))
+
+    with_sidecar = (tmp_path / "delta_sidecar.txt").read_text().splitlines()
+    parsed = (tmp_path / "delta_parsed.txt").read_text().splitlines()
+    assert with_sidecar[:-1] == parsed[:-1]
+    assert with_sidecar[-1].split("|")[6] == parsed[-1].split("|")[6]  # CDE0110 account hash
+    assert {line.split("|")[1] for line in parsed[2:-1]} == {"A", "C", "D"}
+
+
+def test_sidecar_is_bound_to_the_file_it_indexes(script_data_delta, apwx_with, tmp_path):
+    from zoe import read_zoe_sidecar_header
+    zoe_file = tmp_path / "zoe.txt"
+    records = [f"ACC{n}|{n}|x|" + "|".join(["f"] * 53) for n in range(20)]
+    apwx = apwx_with(script_data_delta, SIDECAR_YN="Y")
+    write_new_mode_file(str(zoe_file), records, apwx, None)
+    assert read_zoe_sidecar_header(str(zoe_file)) is not None
+
+    stat = os.stat(zoe_file)
+    os.utime(zoe_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert read_zoe_sidecar_header(str(zoe_file)) is None
+
+    write_new_mode_file(str(zoe_file), records, apwx, None)
+    apwx = apwx_with(script_data_delta, SIDECAR_YN="N")
+    write_new_mode_file(str(zoe_file), [line.replace("|x|", "|y|") for line in records], apwx, None)
+    assert not (tmp_path / "zoe.txt.idx").exists()
+
+
+def test_zoe_file_reader_skips_control_lines_and_decodes_per_line(tmp_path):
+    zoe_file = tmp_path / "zoe.txt"
+    zoe_file.write_bytes(
+        b"CDE0001:X|CDE0002:Y\n"
+        b"1|LOAD|03|FTF\n"
+        b"6|A|03|FTF|1|ACC1|101|caf\xc3\xa9\n"
+        b"\n"
+        b"6|A|03|FTF|2|ACC2|X2|caf\xe9 \n"
+        b"9|LOAD|03|FTF|CDE0083:20240101|CDE0084:1200000|CDE0110:101\n"
+    )
+    assert list(ZoeFileReader(str(zoe_file))) == [
+        (b"101", b"ACC1|101|caf\xc3\xa9", 101),
+        (b"X2", b"ACC2|X2|caf\xe9", 0),
+    ]
+    assert [record for _, record, _ in iter_zoe_records(str(zoe_file))] == ["ACC1|101|café", "ACC2|X2|café"]
+    assert list(ZoeFileReader(str(tmp_path / "missing.txt"))) == []
+
+
+def test_incremental_merge_replaces_changed_persons(tmp_path):
+    previous = {
+        "card_own_pers": ["A1|100|old", "A2|200|same", "A3|100|old"],
+        "org": ["O1|300|same"],
+        "p2p_cust_org": ["P1|900|old"],
+    }
+    changes = {"card_own_pers": ["A1|100|new"], "org": [], "p2p_cust_org": ["P1|900|new"]}
+    merged = merge_incremental_records(previous, changes)
+    assert merged["card_own_pers"] == ["A2|200|same", "A1|100|new"]  # A3 no longer qualifies for person 100
+    assert merged["org"] == ["O1|300|same"]
+    assert merged["p2p_cust_org"] == ["P1|900|new"]
+    assert merge_incremental_records(previous, changes, {"200"})["card_own_pers"] == ["A1|100|new"]
+
+    # an org number equal to a person number: each only replaces records under its own query keys
+    previous = {"card_own_pers": ["ACC1|100|X|rest"], "org": ["ACC9|100|ORG|old"]}
+    merged = merge_incremental_records(previous, {"org": ["ACC9|100|ORG|new"]})
+    assert merged["card_own_pers"] == ["ACC1|100|X|rest"] and merged["org"] == ["ACC9|100|ORG|new"]
+    merged = merge_incremental_records(previous, {"card_own_pers": ["ACC1|100|Y|rest"]}, {"100"})
+    assert merged["card_own_pers"] == ["ACC1|100|Y|rest"] and merged["org"] == ["ACC9|100|ORG|old"]
+
+    from datetime import datetime
+    state_file = str(tmp_path / "zoe.watermark")
+    assert load_incremental_state(state_file) == (None, {})
+    save_incremental_state(state_file, datetime(2024, 3, 1, 6, 30), merged)
+    watermark, saved = load_incremental_state(state_file)
+    assert watermark == datetime(2024, 3, 1, 6, 30)
+    assert {key: lines for key, lines in saved.items() if lines} == {key: lines for key, lines in merged.items() if lines}
+
+
+def test_incremental_task_binds_watermark(script_data_new, mocker):
+    from datetime import datetime
+    config = {"sql_qq": "with qq as (select 1)", "sql_qq_changed": "with qq as (select 1 where :watermark is not null)",
+              "card_own_pers": "select * from qq", "org": "select * from org"}
+    script_data = ScriptData(apwx=script_data_new.apwx, dbh=None, config=config)
+    extraction = ZoeExtraction(script_data, MagicMock(), P2PCustomerIndex(["persnbr"], []), ZoeRecordCollector(), 2)
+    extraction.watermark = datetime(2024, 3, 1)
+    process_query_key = mocker.patch("zoe.process_query_key", return_value=0)
+
+    process_zoe_task(ZoeTask("card_own_pers", 1), extraction)
+    process_zoe_task(ZoeTask("org", 0), extraction)
+    (_, _, pers_sql, _, _, _, pers_values, *_), _ = process_query_key.call_args_list[0]
+    (_, _, org_sql, *_), _ = process_query_key.call_args_list[1]
+    assert pers_sql.startswith(config["sql_qq_changed"])
+    assert pers_values["watermark"] == datetime(2024, 3, 1)
+    assert org_sql == config["org"]  # no org_changed query configured
+
+
+@pytest.mark.parametrize("engine", ["THREAD", "ASYNC"])
+def test_incremental_run_matches_full_run(tmp_path, engine):
+    import json
+    from datetime import datetime
+    from zoe import WATERMARK_OVERLAP
+    from zoe_fakedb import FakeDbProfile, run_new_mode
+    from zoe_synth import PERSNBR_BASE
+    incremental_file = str(tmp_path / "incremental.txt")
+    state_file = str(tmp_path / "zoe.watermark")
+    args = {"MAX_THREADS": 2, "ENGINE": engine, "INCREMENTAL_YN": "Y", "WATERMARK_FILE": state_file}
+    profile = FakeDbProfile(rows=200, db_time=datetime(2024, 3, 1, 6, 30))
+    assert run_new_mode(incremental_file, profile, **args)
+    with open(state_file, encoding="utf-8") as f:
+        assert json.load(f)["watermark"] == (datetime(2024, 3, 1, 6, 30) - WATERMARK_OVERLAP).isoformat()
+
+    # DNA rows change, P2P customers change for persons whose DNA rows did not, and two persons are deleted
+    deleted = {PERSNBR_BASE + 3, PERSNBR_BASE + 205}
+    profile.change_rate, profile.p2p_seed, profile.deleted = 0.1, 7, deleted
+    assert run_new_mode(incremental_file, profile, **args)
+    full_file = str(tmp_path / "full.txt")
+    assert run_new_mode(full_file, FakeDbProfile(rows=200, change_rate=0.1, p2p_seed=7, deleted=deleted), MAX_THREADS=2)
+
+    incremental = sorted(record for _, record, _ in iter_zoe_records(incremental_file))
+    assert incremental == sorted(record for _, record, _ in iter_zoe_records(full_file))
+    assert not [record for record in incremental if record.split("|")[1] in {str(persnbr) for persnbr in deleted}]
+
+
+def test_new_mode_writes_delta_against_previous_run(script_data_new, apwx_with, mocker, tmp_path):
+    previous = [f"ACC{n}|{n}|" + "|".join(["v"] * 54) for n in range(50)]
+    current = [line.replace("|v|", "|w|", 1) if line.startswith("ACC7|") else line for line in previous[1:]]
+    current.append("ACC99|99|" + "|".join(["v"] * 54))
+
+    def run_new(records, **extra):
+        apwx = apwx_with(script_data_new, OUTPUT_FILE_PATH=str(tmp_path), DELTA_DELETES_YN="Y", **extra)
+        mocker.patch("zoe.collect_zoe_records_multithreaded", return_value=records)
+        return process_new_mode(apwx, script_data_new, str(tmp_path / apwx.args.OUTPUT_FILE_NAME))
+
+    assert run_new(previous, OUTPUT_FILE_NAME="previous.txt", SIDECAR_YN="Y")
+    assert run_new(
+        current, OUTPUT_FILE_NAME="current.txt", OLD_ZOE_FILE=str(tmp_path / "previous.txt"),
+        DELTA_OUTPUT_FILE_NAME="delta.txt",
+    )
+    assert (tmp_path / "current.txt.idx").exists()
+    details = [line.split("|") for line in (tmp_path / "delta.txt").read_text().splitlines()[2:-1]]
+    assert [(fields[1], fields[4], fields[5]) for fields in details] == [
+        ("C", "1", "ACC7"), ("A", "2", "ACC99"), ("D", "3", "ACC0"),
+    ]
+
+    with pytest.raises(ValueError):
+        run_new(current, OUTPUT_FILE_NAME="current.txt", OLD_ZOE_FILE=None, DELTA_OUTPUT_FILE_NAME="delta.txt")
+
+
+def test_synthetic_zoe_data_is_seeded(tmp_path):
+    from zoe_synth import synth_dna_rows, write_synth_zoe_file
+    rows = list(synth_dna_rows(200, seed=3))
+    assert rows == list(synth_dna_rows(200, seed=3))
+    assert rows != list(synth_dna_rows(200, seed=4))
+    changed = list(synth_dna_rows(200, seed=3, change_rate=0.1))
+    assert 0 < sum(old != new for old, new in zip(rows, changed)) < 60
+
+    old_file = write_synth_zoe_file(str(tmp_path / "old.txt"), 200, seed=3)
+    new_file = write_synth_zoe_file(str(tmp_path / "new.txt"), 200, seed=3, change_rate=0.1)
+    hash_old, _ = get_zoe_file_hash(old_file)
+    hash_new, _ = get_zoe_file_hash(new_file)
+    assert len(hash_old) == len(hash_new) == 200
+    assert sum(hash_old[key] != hash_new[key] for key in hash_old) == sum(old != new for old, new in zip(rows, changed))
+
+
+def test_new_mode_against_fake_databases(tmp_path):
+    from zoe_fakedb import FakeDbProfile, run_new_mode
+    from zoe_synth import synth_p2p_customers
+    profile = FakeDbProfile(rows=300, pad_bytes=20)
+    buffered = str(tmp_path / "buffered.txt")
+    streamed = str(tmp_path / "streamed.txt")
+    assert run_new_mode(buffered, profile, MAX_THREADS=3)
+    assert run_new_mode(streamed, profile, MAX_THREADS=2, STREAM_YN="Y")
+
+    hash_buffered, _ = get_zoe_file_hash(buffered)
+    hash_streamed, _ = get_zoe_file_hash(streamed)
+    p2p_rows = len(synth_p2p_customers(300 * (len(QUERY_KEYS) - 1)).rows)
+    assert len(hash_buffered) == 300 * (len(QUERY_KEYS) - 1) + p2p_rows
+    assert hash_buffered == hash_streamed
+
+
+def test_new_mode_metrics_report(tmp_path):
+    import json
+    from zoe_fakedb import FakeDbProfile, run_new_mode
+    metrics_file = tmp_path / "metrics.json"
+    assert run_new_mode(str(tmp_path / "zoe.txt"), FakeDbProfile(rows=100), MAX_THREADS=2, METRICS_FILE=str(metrics_file))
+
+    report = json.loads(metrics_file.read_text())
+    assert report["result"] is True
+    assert {query["task"] for query in report["queries"]} == {task.name for task in build_zoe_tasks(2, {})}
+    assert sum(query["rows"] for query in report["queries"]) == report["phases"]["write"]["records"]
+    assert set(report["threads"]) == {"0", "1"}
+    prom = (tmp_path / "metrics.prom").read_text()
+    assert 'zoe_query_rows{key="org",partition="1",thread=' in prom
+    assert "zoe_run_success{mode=\"NEW\"} 1" in prom
+
+
+def test_run_profiler_writes_thread_profiles_and_collapsed_stacks(tmp_path):
+    import threading
+    import time
+    prefix = str(tmp_path / "zoe.txt")
+    profiler = RunProfiler(prefix)
+    profiler.start()
+
+    def busy(name):
+        with profiled(profiler, name):
+            end = time.perf_counter() + 0.1
+            while time.perf_counter() < end:
+                build_detail_record(["ACC1", 1000] + ["v"] * 48, {})
+
+    thread = threading.Thread(target=busy, args=("worker-0",), name="zoe-worker-0")
+    thread.start()
+    thread.join()
+    profiler.stop()
+
+    assert os.path.exists(prefix + ".worker-0.prof")
+    stacks = (tmp_path / "zoe.txt.collapsed").read_text().splitlines()
+    assert any(line.startswith("zoe-worker-0;") and "build_detail_record" in line for line in stacks)
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in stacks)
+
+
+def test_debug_new_mode_profiles_main_phases_and_every_worker(tmp_path):
+    import sys
+    from zoe_fakedb import FakeDbProfile, run_new_mode
+    prefix = str(tmp_path / "zoe.txt")
+    assert run_new_mode(prefix, FakeDbProfile(rows=100, execute_secs=0.05), MAX_THREADS=2, DEBUG_YN="Y")
+
+    assert os.path.exists(prefix + ".p2p_load.prof") and os.path.exists(prefix + ".write.prof")
+    assert not os.path.exists(prefix + ".main.prof")  # would hold the only cProfile on 3.12+ while workers run
+    for worker in ("0", "1"):
+        assert os.path.exists(f"{prefix}.zoe-worker-{worker}.collapsed")
+        if sys.version_info < (3, 12):
+            assert os.path.exists(f"{prefix}.worker-{worker}.prof")
+
+
+def test_new_mode_resumes_failed_slices_from_checkpoint(tmp_path):
+    import json
+    from zoe_fakedb import FakeDbProfile, run_new_mode
+    checkpoint_dir = tmp_path / "checkpoint"
+    output = str(tmp_path / "zoe.txt")
+    with pytest.raises(RuntimeError, match="org:1"):
+        run_new_mode(output, FakeDbProfile(rows=200, failures={"org:1"}), MAX_THREADS=2,
+                     CHECKPOINT_DIR=str(checkpoint_dir))
+    manifest = json.loads((checkpoint_dir / "manifest.json").read_text())
+    assert "org:1" not in manifest["slices"] and "org:0" in manifest["slices"]
+    assert not (checkpoint_dir / "org.1.spill").exists() and not (checkpoint_dir / "org.1.spill.part").exists()
+
+    profile = FakeDbProfile(rows=200)
+    assert run_new_mode(output, profile, MAX_THREADS=2, CHECKPOINT_DIR=str(checkpoint_dir), RESUME_YN="Y")
+    assert profile.executed == ["org:1"]
+    assert not checkpoint_dir.exists()
+
+    clean = str(tmp_path / "clean.txt")
+    assert run_new_mode(clean, FakeDbProfile(rows=200), MAX_THREADS=2)
+    with open(output, encoding="utf-8") as f, open(clean, encoding="utf-8") as g:
+        assert f.read().splitlines()[:-1] == g.read().splitlines()[:-1]
+
+
+@pytest.mark.parametrize("engine", ["THREAD", "ASYNC"])
+def test_dropped_dna_connection_is_not_reused(tmp_path, engine):
+    from zoe_fakedb import FakeDbProfile, run_new_mode
+    profile = FakeDbProfile(rows=100, failures={"card_own_pers:0"})
+    with pytest.raises(RuntimeError) as failed:
+        run_new_mode(str(tmp_path / "zoe.txt"), profile, MAX_THREADS=1, ENGINE=engine,
+                     CHECKPOINT_DIR=str(tmp_path / "checkpoint"))
+    assert "Slices failed: card_own_pers:0." in str(failed.value)
+    assert profile.closed >= 1 and profile.connections >= 2
+
+
+def test_streaming_run_with_failed_slice_leaves_previous_file(tmp_path):
+    from zoe_fakedb import FakeDbProfile, run_new_mode
+    output = tmp_path / "zoe.txt"
+    output.write_text("previous run\n")
+    with pytest.raises(RuntimeError, match="org:1"):
+        run_new_mode(str(output), FakeDbProfile(rows=200, failures={"org:1"}), MAX_THREADS=2, STREAM_YN="Y",
+                     SIDECAR_YN="Y", CHECKPOINT_DIR=str(tmp_path / "checkpoint"))
+    assert output.read_text() == "previous run\n"
+    assert not any(name.startswith("zoe.txt.") for name in os.listdir(tmp_path))
+
+
+def test_checkpoint_resume_reuses_saved_partition_plans(tmp_path):
+    directory = str(tmp_path / "checkpoint")
+    saved = {"org": [{"range_lo": None, "range_hi": 500, "expected_rows": 480},
+                     {"range_lo": 500, "range_hi": None, "expected_rows": 520}]}
+    checkpoint = ZoeCheckpoint(directory, resume=False)
+    assert checkpoint.begin(ZoeRecordCollector(), 2, saved, None, {"org": "sql"}) == saved
+    checkpoint.finish(ZoeTask("org", 0), 480, False)
+
+    replanned = {"org": [{"range_lo": None, "range_hi": 510, "expected_rows": 495},
+                         {"range_lo": 510, "range_hi": None, "expected_rows": 507}]}
+    resumed = ZoeCheckpoint(directory, resume=True)
+    assert resumed.begin(ZoeRecordCollector(), 2, replanned, None, {"org": "sql"}) == saved
+    assert resumed.restore(ZoeTask("org", 0)) == 480
+
+    changed = ZoeCheckpoint(directory, resume=True)
+    assert changed.begin(ZoeRecordCollector(), 2, replanned, None, {"org": "other sql"}) == replanned
+    assert changed.restore(ZoeTask("org", 0)) is None
+
+
+def test_async_engine_matches_thread_engine(tmp_path):
+    from zoe_fakedb import FakeDbProfile, run_new_mode
+    thread_file = str(tmp_path / "thread.txt")
+    async_file = str(tmp_path / "async.txt")
+    assert run_new_mode(thread_file, FakeDbProfile(rows=300), MAX_THREADS=3)
+    profile = FakeDbProfile(rows=300, execute_secs=0.01, failures={"org:2"})
+    assert run_new_mode(async_file, profile, MAX_THREADS=3, ENGINE="ASYNC", FORMAT_WORKERS=1)
+    assert len(profile.executed) == 3 * (len(QUERY_KEYS) - 1)
+
+    hash_thread, _ = get_zoe_file_hash(thread_file)
+    hash_async, _ = get_zoe_file_hash(async_file)
+    missing = {key for key in hash_thread if key not in hash_async}
+    assert missing and all(hash_thread[key] == hash_async[key] for key in hash_async)
+
+    profile = FakeDbProfile(rows=300)
+    assert run_new_mode(async_file, profile, MAX_THREADS=3, ENGINE="ASYNC")
+    assert get_zoe_file_hash(async_file)[0] == hash_thread
+
+
+def test_async_engine_without_credentials_is_rejected(script_data_new, apwx_with, mocker):
+    import zoe
+    apwx = apwx_with(script_data_new, ENGINE="ASYNC")
+    run_zoe_threads = mocker.patch("zoe.run_zoe_threads")
+    with pytest.raises(ValueError, match="ENGINE=ASYNC needs the OSIUPDATE"):
+        zoe.run_zoe_extraction(apwx, script_data_new, ZoeRecordCollector())
+    run_zoe_threads.assert_not_called()
+
+
+def test_async_engine_formats_off_the_event_loop(tmp_path, monkeypatch):
+    import threading
+    import zoe
+    from zoe_fakedb import FakeDbProfile, run_new_mode
+    format_threads = set()
+
+    def format_batch(records, p2p_cust, is_org):
+        format_threads.add(threading.current_thread() is threading.main_thread())
+        return format_record_batch(records, p2p_cust, is_org)
+
+    monkeypatch.setattr(zoe, "format_record_batch", format_batch)
+    assert run_new_mode(str(tmp_path / "async.txt"), FakeDbProfile(rows=300), MAX_THREADS=3, ENGINE="ASYNC")
+    assert format_threads == {False}  # neither DNA batches nor p2p_cust_org are formatted on the event loop
+
+
+@pytest.mark.parametrize("engine", ["THREAD", "ASYNC"])
+def test_failed_partition_histogram_extracts_the_key_as_one_partition(tmp_path, engine):
+    from zoe_fakedb import FakeDbProfile, run_new_mode
+    plain_file = str(tmp_path / "plain.txt")
+    planned_file = str(tmp_path / "planned.txt")
+    assert run_new_mode(plain_file, FakeDbProfile(rows=100), MAX_THREADS=2)
+    config = {
+        "org": "where (:range_lo is null or n >= :range_lo) and (:range_hi is null or n < :range_hi) -- zoe_fakedb org",
+        "partition_plan": {"org": "select bucket, count(*) -- zoe_fakedb no_such_histogram"},
+    }
+    profile = FakeDbProfile(rows=100)
+    assert run_new_mode(planned_file, profile, config=config, MAX_THREADS=2, ENGINE=engine)
+
+    assert [task for task in profile.executed if task.startswith("org:")] == ["org:0"]
+    assert get_zoe_file_hash(planned_file)[0] == get_zoe_file_hash(plain_file)[0]
+
+
+def test_fakedb_latency_per_query_key(tmp_path):
+    import json
+    from zoe_fakedb import FakeDbProfile, run_new_mode
+    metrics_file = tmp_path / "metrics.json"
+    profile = FakeDbProfile(rows=20, execute_secs=0.01, key_execute_secs={"org": 0.2})
+    assert run_new_mode(str(tmp_path / "zoe.txt"), profile, MAX_THREADS=2, METRICS_FILE=str(metrics_file))
+    execute = {query["task"]: query["execute_secs"] for query in json.loads(metrics_file.read_text())["queries"]
+               if "execute_secs" in query}
+    assert all((secs >= 0.2) == task.startswith("org:") for task, secs in execute.items())
+    assert {task for task in execute if task.startswith("org:")} == {"org:0", "org:1"}
+
+
+@pytest.mark.parametrize("engine", ["THREAD", "ASYNC"])
+def test_new_mode_with_p2p_snapshot_index(tmp_path, engine):
+    import json
+    from zoe_fakedb import FakeDbProfile, run_new_mode
+    dict_file = str(tmp_path / "dict.txt")
+    snapshot_file = str(tmp_path / "snapshot.txt")
+    metrics_file = tmp_path / "metrics.json"
+    assert run_new_mode(dict_file, FakeDbProfile(rows=200), MAX_THREADS=2)
+    assert run_new_mode(
+        snapshot_file, FakeDbProfile(rows=200), MAX_THREADS=2, ENGINE=engine,
+        P2P_SNAPSHOT_FILE=str(tmp_path / "p2p.sqlite"), METRICS_FILE=str(metrics_file),
+    )
+
+    assert get_zoe_file_hash(snapshot_file)[0] == get_zoe_file_hash(dict_file)[0]
+    report = json.loads(metrics_file.read_text())
+    assert {query["task"] for query in report["queries"]} == {task.name for task in build_zoe_tasks(2, {})}
+
+
+@pytest.mark.parametrize("kernel_copy", ["copy_file_range", "sendfile"])
+def test_sharded_output_matches_single_file(script_data_new, apwx_with, tmp_path, monkeypatch, kernel_copy):
+    import zoe
+    monkeypatch.setattr(zoe, "available_cpus", lambda: 4)
+    records = [f"ACC{n}|{n}|CXC|{n}|" + "|".join(["f"] * 53) for n in range(1, 101)]
+    if kernel_copy == "sendfile":
+        monkeypatch.delattr(os, "copy_file_range", raising=False)
+    for name, shards in (("single", "1"), ("sharded", "3")):
+        apwx = apwx_with(script_data_new, SIDECAR_YN="Y", OUTPUT_SHARDS=shards)
+        write_new_mode_file(str(tmp_path / f"{name}.txt"), records, apwx, None)
+
+    single = (tmp_path / "single.txt").read_text().splitlines()
+    sharded = (tmp_path / "sharded.txt").read_text().splitlines()
+    assert sharded[:-1] == single[:-1]
+
+    def trailer_counts(trailer):
+        # account hash, added, changed, deleted and record count; the trailer also holds the time it was written
+        codes = ("CDE0110", "CDE0111", "CDE0120", "CDE0121", "CDE0133")
+        return [field for field in trailer.split("|") if field.split(":")[0] in codes]
+    assert trailer_counts(sharded[-1]) == trailer_counts(single[-1])
+    assert trailer_counts(sharded[-1])[1::3] == ["CDE0111:100", "CDE0133:102"]
+    assert [line.split("|")[4] for line in sharded[2:-1]] == [str(seq) for seq in range(1, 101)]
+    assert sorted(os.listdir(tmp_path)) == ["sharded.txt", "sharded.txt.idx", "single.txt", "single.txt.idx"]
+    *single_words, single_hash = load_zoe_sidecar(str(tmp_path / "single.txt"))
+    *sharded_words, sharded_hash = load_zoe_sidecar(str(tmp_path / "sharded.txt"))
+    assert [list(words) for words in sharded_words] == [list(words) for words in single_words]
+    assert sharded_hash == single_hash
+
+
+def test_output_shards_are_rejected_with_streaming(script_data_new, apwx_with):
+    apwx = apwx_with(script_data_new, STREAM_YN="Y", OUTPUT_SHARDS="4")
+    with pytest.raises(ValueError, match="OUTPUT_SHARDS"):
+        process_new_mode(apwx, script_data_new, "zoe.txt")
@@ -1,18 +1,57 @@
 import time
+import asyncio
+import cProfile
+import pstats
+import hashlib
+import mmap
+import struct
+import zlib
 import threading
+import queue
+import tracemalloc
 import datetime
 import yaml
 import os
-from dataclasses import dataclass
+import json
+import pickle
+import sqlite3
+import heapq
+import shutil
+import tempfile
+from dataclasses import dataclass, field
 from enum import StrEnum, auto
-from typing import Any, Optional, List, Dict
+from typing import Any, Optional, Iterable, List, Dict, NamedTuple
 from pathlib import Path
 from ftfcu_appworx import Apwx, JobTime
 from oracledb import Connection as DbConnection
-from datetime import datetime, timezone
-from multiprocessing import Manager
+from datetime import datetime, timedelta, timezone
+from array import array
+from collections import Counter, deque
+from itertools import groupby
+from operator import itemgetter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
+import oracledb
 import pyodbc
 import re
+import sys
+import multiprocessing
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:  # only the optional columnar fetch path (COLUMNAR_YN) needs pyarrow
+    pa = pc = None
+
+try:
+    import numpy as np
+except ImportError:  # the DIGEST delta engine falls back to dicts
+    np = None
+
+try:
+    import resource
+except ImportError:  # not on Windows, the metrics report has no peak RSS there
+    resource = None
 
 
 version = 1.00
@@ -20,6 +59,16 @@ version = 1.00
 TITLE_FORMAT = "{:>90}"
 LINE_FORMAT = "{:<20}"
 
+QUERY_KEYS = [
+    "card_tax_rpt_for_pers",
+    "card_own_pers",
+    "no_card_tax_rpt_for_pers",
+    "no_card_own_pers",
+    "card_own_pers_org",
+    "org",
+    "p2p_cust_org",
+]
+
 
 class AppWorxEnum(StrEnum):
     TNS_SERVICE_NAME = auto()
@@ -35,6 +84,26 @@ class AppWorxEnum(StrEnum):
     RPTONLY_YN = auto()
     OLD_ZOE_FILE = auto()
     NEW_ZOE_FILE = auto()
+    STREAM_YN = auto()
+    P2P_SNAPSHOT_FILE = auto()
+    FORMAT_WORKERS = auto()
+    TASK_STATS_FILE = auto()
+    FETCH_MEMORY_MB = auto()
+    COLUMNAR_YN = auto()
+    DELTA_ENGINE = auto()
+    DELTA_MEMORY_MB = auto()
+    DELTA_DELETES_YN = auto()
+    SIDECAR_YN = auto()
+    DELTA_WORKERS = auto()
+    INCREMENTAL_YN = auto()
+    WATERMARK_FILE = auto()
+    DELTA_OUTPUT_FILE_NAME = auto()
+    METRICS_FILE = auto()
+    CHECKPOINT_DIR = auto()
+    RESUME_YN = auto()
+    ENGINE = auto()
+    OUTPUT_SHARDS = auto()
+    P2P_SNAPSHOT_MAX_AGE_HOURS = auto()
 
     def _str_(self):
         return self.name
@@ -43,8 +112,384 @@ class AppWorxEnum(StrEnum):
 @dataclass
 class ScriptData:
     apwx: Apwx
-    dbh: DbConnection
+    dbh: Optional[DbConnection]
     config: Any
+    metrics: Optional["RunMetrics"] = None
+    profiler: Optional["RunProfiler"] = None
+    checkpoint: Optional["ZoeCheckpoint"] = None
+
+
+@dataclass
+class ZoeTask:
+    """one (query key, partition) unit of NEW-mode extraction work"""
+    key: str
+    partition: int
+    expected_secs: Optional[float] = None
+
+    @property
+    def name(self) -> str:
+        return f"{self.key}:{self.partition}"
+
+
+@dataclass
+class ZoeExtraction:
+    """state shared by the worker threads of one NEW-mode extraction"""
+    script_data: ScriptData
+    dna_pool: Any
+    p2p_cust: Any
+    zoe_data: Any
+    max_threads: int
+    formatter: Any = None
+    partition_plans: Dict[str, List[Dict]] = field(default_factory=dict)
+    row_counts: Dict[str, int] = field(default_factory=dict)
+    fetch_tuners: Dict[str, Any] = field(default_factory=dict)
+    p2p_columns: Optional[Dict[str, Any]] = None  # P2P index as Arrow arrays when COLUMNAR_YN=Y
+    watermark: Optional[datetime] = None  # only rows changed since then are extracted when set
+    failed_tasks: List[str] = field(default_factory=list)
+    previous_durations: Dict[str, float] = field(default_factory=dict)
+    detail_p2p: Any = None  # P2P index the DNA query keys are formatted with, p2p_cust unless set
+
+    def __post_init__(self):
+        if self.detail_p2p is None:
+            self.detail_p2p = self.p2p_cust
+
+
+class FetchTuner:
+    """adapts cursor arraysize/prefetchrows for one query key from the observed row width and fetch
+    round-trip time, within a memory budget per batch, and keeps that key's fetch telemetry"""
+
+    def __init__(self, key: str, memory_budget: int = 64 * 1048576, initial_rows: int = 1000,
+                 min_rows: int = 100, max_rows: int = 100000):
+        self.key = key
+        self.memory_budget = memory_budget
+        self.arraysize = initial_rows
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self.round_trips = 0
+        self.rows = 0
+        self.bytes = 0
+        self.fetch_secs = 0.0
+        self._best_rate = 0.0
+        self._growing = True
+        self._lock = threading.Lock()
+
+    def configure(self, cur):
+        """sizes the cursor before execute, prefetching one extra row saves a round-trip on exact fits"""
+        cur.arraysize = self.arraysize
+        if hasattr(cur, "prefetchrows"):
+            cur.prefetchrows = self.arraysize + 1
+
+    def fetch_batches(self, cur):
+        """yields fetchmany batches until the result set is exhausted, re-sizing between round-trips"""
+        while True:
+            size = self.arraysize
+            cur.arraysize = size
+            start = time.perf_counter()
+            records = cur.fetchmany(size)
+            self.observe(records, size, time.perf_counter() - start)
+            if not records:
+                break
+            yield records
+
+    def observe(self, records, requested: int, secs: float):
+        self.observe_rows(len(records), estimate_row_bytes(records), requested, secs)
+
+    def observe_rows(self, rows: int, row_bytes: int, requested: int, secs: float):
+        with self._lock:
+            self.round_trips += 1
+            self.rows += rows
+            self.bytes += row_bytes * rows
+            self.fetch_secs += secs
+            if rows < requested or secs <= 0 or row_bytes <= 0:
+                return  # a short last batch or unmeasurable wait says nothing about the right size
+
+            budget_rows = max(self.min_rows, min(self.max_rows, self.memory_budget // row_bytes))
+            rate = rows / secs
+            if self._growing and rate > self._best_rate * 1.1:
+                # larger batches still amortise the round-trip latency, keep doubling
+                self._best_rate = rate
+                self.arraysize = min(requested * 2, budget_rows)
+            else:
+                self._growing = False
+                self.arraysize = min(self.arraysize, budget_rows)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "key": self.key,
+                "round_trips": self.round_trips,
+                "rows": self.rows,
+                "bytes": self.bytes,
+                "fetch_secs": round(self.fetch_secs, 3),
+                "rows_per_sec": round(self.rows / self.fetch_secs) if self.fetch_secs else None,
+                "arraysize": self.arraysize,
+            }
+
+    def print_stats(self):
+        stats = self.stats()
+        print(
+            f"[FETCH] {stats['key']}: {stats['rows']} rows in {stats['round_trips']} round-trips, "
+            f"{stats['bytes'] / 1048576:.1f} MB, fetch wait {stats['fetch_secs']}s, "
+            f"{stats['rows_per_sec']} rows/s, arraysize {stats['arraysize']}"
+        )
+
+
+def estimate_row_bytes(records) -> int:
+    """text size of a fetched row, sampled from the first row of the batch"""
+    return sum(len(str(val)) for val in records[0] if val is not None) + 1 if records else 0
+
+
+def peak_rss_bytes() -> Optional[int]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # kilobytes everywhere but macOS
+
+
+class RunMetrics:
+    """thread-safe timings and counters of one run, written as a JSON report and a Prometheus textfile"""
+
+    def __init__(self, mode: str):
+        self.mode = mode
+        self.started = datetime.now()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self.queries: Dict[str, Dict] = {}
+        self.phases: Dict[str, Dict] = {}
+        self.pools: List[Dict] = []
+
+    def record_query(self, task_name: str, **values):
+        """one (query key, partition) task: thread, connect/execute/fetch/format seconds, rows and bytes"""
+        with self._lock:
+            self.queries[task_name] = values
+
+    def record_phase(self, name: str, secs: float, **values):
+        """a whole-run step such as loading the P2P index or writing the file"""
+        with self._lock:
+            self.phases[name] = {"secs": round(secs, 3), **values}
+
+    def record_pools(self, *pools):
+        with self._lock:
+            self.pools.extend(pool.stats() for pool in pools)
+
+    def report(self, result: bool) -> Dict:
+        with self._lock:
+            queries = [{"task": name, **values} for name, values in sorted(self.queries.items())]
+            phases = dict(self.phases)
+            pools = list(self.pools)
+        threads = {}
+        for query in queries:
+            thread = threads.setdefault(query["thread"], {"tasks": 0, "rows": 0, "bytes": 0, "busy_secs": 0.0})
+            thread["tasks"] += 1
+            thread["rows"] += query["rows"]
+            thread["bytes"] += query["bytes"]
+            thread["busy_secs"] = round(thread["busy_secs"] + query["secs"], 3)
+        for phase in phases.values():
+            if phase.get("records") and phase["secs"]:
+                phase["records_per_sec"] = round(phase["records"] / phase["secs"])
+        return {
+            "mode": self.mode,
+            "result": result,
+            "started": self.started.isoformat(timespec="seconds"),
+            "elapsed_secs": round(time.perf_counter() - self._start, 3),
+            "peak_rss_bytes": peak_rss_bytes(),
+            "phases": phases,
+            "pools": pools,
+            "threads": threads,
+            "queries": queries,
+        }
+
+    def write(self, file_path: str, result: bool):
+        """writes the JSON report to file_path and the same figures as a Prometheus textfile beside it"""
+        report = self.report(result)
+        prom_path = os.path.splitext(file_path)[0] + ".prom"
+        try:
+            outputs = ((file_path, json.dumps(report, indent=2)), (prom_path, format_prometheus_metrics(report)))
+            for path, text in outputs:
+                # textfile collectors may read at any time, so the files are replaced whole
+                with open(path + ".tmp", "w", encoding="utf-8") as f:
+                    f.write(text)
+                os.replace(path + ".tmp", path)
+            print(f"Wrote run metrics to {file_path} and {prom_path}")
+        except Exception as e:
+            print(f"Error writing run metrics {file_path}: {e}")
+
+
+def format_prometheus_metrics(report: Dict) -> str:
+    """the run report in the Prometheus text exposition format"""
+    samples = {}
+
+    def add(name: str, help_text: str, value, **labels):
+        if value is None:
+            return
+        label_text = ",".join(f'{label}="{labels[label]}"' for label in sorted(labels))
+        sample = f"{name}{{{label_text}}} {value}" if labels else f"{name} {value}"
+        samples.setdefault((name, help_text), []).append(sample)
+
+    mode = report["mode"]
+    add("zoe_run_success", "1 when the last run succeeded", int(bool(report["result"])), mode=mode)
+    add("zoe_run_duration_seconds", "wall time of the last run", report["elapsed_secs"], mode=mode)
+    add("zoe_run_peak_rss_bytes", "peak resident memory of the last run", report["peak_rss_bytes"], mode=mode)
+    for phase, values in report["phases"].items():
+        add("zoe_phase_duration_seconds", "wall time of a run step", values["secs"], mode=mode, phase=phase)
+        add("zoe_phase_records", "records handled by a run step", values.get("records"), mode=mode, phase=phase)
+        add("zoe_phase_bytes", "bytes read, written or held in memory by a run step", values.get("bytes"),
+            mode=mode, phase=phase)
+    for pool in report["pools"]:
+        add("zoe_pool_connections", "connections opened by a pool", pool["connections"], pool=pool["pool"])
+        add("zoe_pool_connect_failures", "failed connection attempts of a pool", pool["failures"], pool=pool["pool"])
+    for query in report["queries"]:
+        labels = {"key": query["key"], "partition": query["partition"], "thread": query["thread"]}
+        for step in ("connect", "execute", "fetch", "format"):
+            add("zoe_query_seconds", "time of a query task by step", query[f"{step}_secs"], step=step, **labels)
+        add("zoe_query_rows", "rows fetched by a query task", query["rows"], **labels)
+        add("zoe_query_bytes", "estimated bytes fetched by a query task", query["bytes"], **labels)
+
+    lines = []
+    for (name, help_text), values in samples.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", *values]
+    return "\n".join(lines) + "\n"
+
+
+class RunProfiler:
+    """DEBUG_YN=Y profiling: one cProfile per profiled thread, which cProfile alone does not do, and a stack
+    sampler over every thread for flame-graph collapsed-stack files, one per thread and one merged"""
+
+    SAMPLE_SECS = 0.01
+
+    def __init__(self, output_prefix: str):
+        self.output_prefix = output_prefix
+        self._lock = threading.Lock()
+        self._profiles: Dict[str, cProfile.Profile] = {}
+        self._stacks = Counter()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name="zoe-profiler", daemon=True)
+
+    def start(self):
+        self._sampler.start()
+
+    @contextmanager
+    def profile(self, name: str):
+        """profiles the calling thread for the duration of the block and keeps the stats under 'name'"""
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Python 3.12+ allows one active cProfile per process, this thread's sampled stacks still cover it
+            print(f"[PROFILE] {name} is not profiled, see its .collapsed stacks: {e}")
+            yield
+            return
+        try:
+            yield
+        finally:
+            profiler.disable()
+            with self._lock:
+                self._profiles[name] = profiler
+
+    def _sample(self):
+        own_ident = threading.get_ident()
+        while not self._stop.wait(self.SAMPLE_SECS):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self._stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        """stops sampling, writes '<zoe file>.<name>.prof' stats, '<zoe file>.<thread>.collapsed' stacks for
+        every sampled thread and the merged '<zoe file>.collapsed', and prints the merged top functions"""
+        self._stop.set()
+        self._sampler.join()
+        with self._lock:
+            profiles = dict(self._profiles)
+        stats_files = []
+        try:
+            for name, profiler in sorted(profiles.items()):
+                stats_file = f"{self.output_prefix}.{name}.prof"
+                profiler.dump_stats(stats_file)
+                stats_files.append(stats_file)
+            collapsed_file = f"{self.output_prefix}.collapsed"
+            by_thread = {}
+            with open(collapsed_file, "w", encoding="utf-8") as f:
+                for stack, count in sorted(self._stacks.items()):
+                    f.write(f"{stack} {count}\n")
+                    by_thread.setdefault(stack.split(";", 1)[0], []).append(f"{stack} {count}\n")
+            for thread_name, lines in by_thread.items():
+                with open(f"{self.output_prefix}.{thread_name}.collapsed", "w", encoding="utf-8") as f:
+                    f.writelines(lines)
+            print(f"[PROFILE] Wrote {len(stats_files)} profiles and the stacks of {len(by_thread)} threads")
+            if stats_files:
+                pstats.Stats(*stats_files).sort_stats("cumulative").print_stats(25)
+        except Exception as e:
+            print(f"Error writing profiles for {self.output_prefix}: {e}")
+
+
+def profiled(profiler: Optional[RunProfiler], name: str):
+    """the profiler's context for 'name', or a no-op when the run is not profiled"""
+    return profiler.profile(name) if profiler else nullcontext()
+
+
+def run_reported(apwx, script_data, mode: str, fh_zoe_path: str, action) -> bool:
+    """runs 'action' with the run metrics and, when DEBUG_YN=Y, the profiler set up, then writes them out.
+    Failed runs are reported too, so the scheduler can alert on them."""
+    script_data.metrics = RunMetrics(mode)
+    if apwx.args.DEBUG_YN == "Y":
+        script_data.profiler = RunProfiler(fh_zoe_path)
+        script_data.profiler.start()
+    result = False
+    try:
+        result = action()
+    finally:
+        if script_data.profiler:
+            script_data.profiler.stop()
+        if apwx.args.METRICS_FILE:
+            script_data.metrics.write(apwx.args.METRICS_FILE, result)
+    return result
+
+
+class ZoeRecordCollector:
+    """in-process sink for formatted ZOE lines, filled by worker threads one fetch batch at a time"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._slots: Dict[tuple, List[List[str]]] = {}
+        self.count = 0
+
+    def add_batch(self, slot: tuple, lines: List[str]):
+        """stores a whole batch under its (query key index, thread id) slot with a single lock round-trip"""
+        if not lines:
+            return
+        with self._lock:
+            self._slots.setdefault(slot, []).append(lines)
+            self.count += len(lines)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def records_by_key(self) -> Dict[str, List[str]]:
+        """returns the collected lines of each query key, ordered by slot like records()"""
+        by_key = {}
+        with self._lock:
+            for slot in sorted(self._slots):
+                lines = by_key.setdefault(QUERY_KEYS[slot[0]], [])
+                for batch in self._slots[slot]:
+                    lines.extend(batch)
+        return by_key
+
+    def records(self) -> List[str]:
+        """returns every collected line ordered by slot, so the output does not depend on thread timing"""
+        records = []
+        with self._lock:
+            for slot in sorted(self._slots):
+                for batch in self._slots[slot]:
+                    records.extend(batch)
+        return records
 
 
 def run(apwx: Apwx) -> bool:
@@ -59,129 +504,1456 @@ def run(apwx: Apwx) -> bool:
     print(f"ZOE file mode is {mode}")
     fh_zoe_path = os.path.join(apwx.args.OUTPUT_FILE_PATH, apwx.args.OUTPUT_FILE_NAME)
 
-    if mode == "NEW":
-        return process_new_mode(apwx, script_data, fh_zoe_path)
-    elif mode == "DELTA":
-        return process_delta_mode(apwx, fh_zoe_path)
-    else:
+    def dispatch() -> bool:
+        if mode == "NEW":
+            return process_new_mode(apwx, script_data, fh_zoe_path)
+        elif mode == "DELTA":
+            with profiled(script_data.profiler, "delta"):
+                return process_delta_mode(apwx, fh_zoe_path, script_data.metrics)
         print("MODE IS NOT NEW OR DELTA")
         return False
 
+    return run_reported(apwx, script_data, mode, fh_zoe_path, dispatch)
+
 
 def process_new_mode(apwx, script_data, fh_zoe_path: str) -> bool:
     """Handles the NEW mode logic by collecting ZOE records using threading and writing to a file"""
     file_stat = get_file_stat_if_exists(fh_zoe_path)
+    delta_path = None
+    if apwx.args.DELTA_OUTPUT_FILE_NAME:
+        delta_path = os.path.join(apwx.args.OUTPUT_FILE_PATH, apwx.args.DELTA_OUTPUT_FILE_NAME)
+        old_path = apwx.args.OLD_ZOE_FILE
+        if not old_path or os.path.abspath(old_path) == os.path.abspath(fh_zoe_path):
+            raise ValueError("DELTA_OUTPUT_FILE_NAME needs OLD_ZOE_FILE, the previous run's file, at another path")
+    if apwx.args.STREAM_YN == "Y" and int(apwx.args.OUTPUT_SHARDS or 1) > 1:
+        raise ValueError("OUTPUT_SHARDS needs the record count up front, it cannot be combined with STREAM_YN=Y")
+    if apwx.args.CHECKPOINT_DIR or apwx.args.RESUME_YN == "Y":
+        checkpoint_dir = apwx.args.CHECKPOINT_DIR or fh_zoe_path + ".checkpoint"
+        script_data.checkpoint = ZoeCheckpoint(checkpoint_dir, apwx.args.RESUME_YN == "Y")
+
+    if apwx.args.INCREMENTAL_YN == "Y":
+        result = process_new_mode_incremental(apwx, script_data, fh_zoe_path, file_stat)
+    elif apwx.args.STREAM_YN == "Y":
+        result = process_new_mode_streaming(apwx, script_data, fh_zoe_path, file_stat)
+    else:
+        zoe_data = collect_zoe_records_multithreaded(apwx, script_data)
+        print(f"Found {len(zoe_data)} ZOE records")
+
+        # the main thread's own phases are profiled, not the span the workers run in, as Python 3.12+
+        # allows only one active cProfile
+        with profiled(script_data.profiler, "write"):
+            write_new_mode_file(fh_zoe_path, zoe_data, apwx, file_stat, script_data.metrics)
+        result = True
+
+    if script_data.checkpoint:
+        script_data.checkpoint.remove()  # the file is complete, a rerun starts over
+    if delta_path:
+        # the LOAD file was indexed while it was written, so only its changed records are read back
+        print(f"Writing delta against {apwx.args.OLD_ZOE_FILE}")
+        with profiled(script_data.profiler, "delta"):
+            result = write_delta_file(
+                apwx, delta_path, apwx.args.OLD_ZOE_FILE, fh_zoe_path, "DIGEST", script_data.metrics
+            ) and result
+    return result
+
+
+def wants_sidecar(apwx) -> bool:
+    """whether NEW mode indexes the LOAD file as it writes it"""
+    return apwx.args.SIDECAR_YN == "Y" or bool(apwx.args.DELTA_OUTPUT_FILE_NAME)
+
+
+def process_new_mode_streaming(apwx, script_data, fh_zoe_path: str, file_stat) -> bool:
+    """NEW mode variant that writes detail records while the worker threads are still fetching"""
+    zoe_writer = StreamingZoeWriter(
+        fh_zoe_path, apwx.args.TEST_YN, file_stat, sidecar=wants_sidecar(apwx), profiler=script_data.profiler
+    )
+    zoe_writer.start()
+    try:
+        run_zoe_extraction(apwx, script_data, zoe_writer)
+    except BaseException:
+        zoe_writer.abort()
+        raise
+    zoe_writer.close()
+    print(f"Found {len(zoe_writer)} ZOE records")
+    if script_data.metrics:
+        script_data.metrics.record_phase(
+            "write", zoe_writer.write_secs, records=len(zoe_writer), bytes=os.path.getsize(fh_zoe_path)
+        )
+    return True
+
+
+INCREMENTAL_STATE_VERSION = 2  # records saved without P2P values, which are applied when writing
+WATERMARK_OVERLAP = timedelta(minutes=5)  # rows committed this long before the run started are extracted again
+DB_TIME_SQL = "SELECT CAST(SYSTIMESTAMP AS TIMESTAMP) FROM dual"
 
-    zoe_data = collect_zoe_records_multithreaded(apwx, script_data)
-    print(f"Found {len(zoe_data)} ZOE records")
 
-    write_new_mode_file(fh_zoe_path, zoe_data, apwx, file_stat)
+def process_new_mode_incremental(apwx, script_data, fh_zoe_path: str, file_stat) -> bool:
+    """NEW mode variant that extracts only the rows changed in DNA since the previous run's watermark and
+    merges them into that run's records to write the full file"""
+    if "sql_qq_changed" not in script_data.config:
+        raise ValueError("INCREMENTAL_YN=Y needs 'sql_qq_changed' in the config")
+    state_file = apwx.args.WATERMARK_FILE or fh_zoe_path + ".watermark"
+    watermark, previous = load_incremental_state(state_file)
+    if watermark is None:
+        print("No previous incremental state, extracting every record")
+    else:
+        print(f"Extracting rows changed since {watermark.isoformat()}")
+
+    checkpoint = script_data.checkpoint
+    dna_dbh = dna_db_connect_func(apwx)
+    try:
+        # rows changed while this run extracts are picked up again next time, from the first attempt when resumed
+        if checkpoint and checkpoint.resumed:
+            run_started = checkpoint.started
+        else:
+            run_started = read_incremental_watermark(dna_dbh, script_data.config)
+        deleted = load_deleted_persons(dna_dbh, script_data.config, watermark) if watermark is not None else set()
+    finally:
+        if dna_dbh is not None:
+            dna_dbh.close()
+    if checkpoint:
+        checkpoint.started = run_started
+
+    zoe_data = ZoeRecordCollector()
+    p2p_cust = run_zoe_extraction(apwx, script_data, zoe_data, watermark)
+    records_by_key = zoe_data.records_by_key()
+    if watermark is not None:
+        records_by_key = merge_incremental_records(previous, records_by_key, deleted)
+    records = []
+    for key in QUERY_KEYS:
+        lines = records_by_key.get(key, [])
+        if key not in ("card_own_pers_org", "org", "p2p_cust_org"):
+            lines = apply_p2p_to_records(lines, p2p_cust)
+        records += lines
+    print(f"Found {len(records)} ZOE records")
+
+    with profiled(script_data.profiler, "write"):
+        write_new_mode_file(fh_zoe_path, records, apwx, file_stat, script_data.metrics)
+    save_incremental_state(state_file, run_started, records_by_key)
     return True
 
 
+def read_incremental_watermark(dbh, config: Dict) -> datetime:
+    """the DNA database's time less WATERMARK_OVERLAP, the watermark of the next run; the app server's clock
+    is only used when the database cannot be asked, as skew between the two would lose rows"""
+    if dbh is not None:
+        try:
+            cur = dbh.cursor()
+            try:
+                cur.execute(config.get("sql_db_time", DB_TIME_SQL))
+                return cur.fetchone()[0] - WATERMARK_OVERLAP
+            finally:
+                cur.close()
+        except Exception as e:
+            print(f"Error reading the DNA database time: {e}")
+    print("Using the app server time for the watermark")
+    return datetime.now() - WATERMARK_OVERLAP
+
+
+def load_deleted_persons(dbh, config: Dict, watermark: datetime) -> set:
+    """persnbrs, as text, of the persons 'sql_qq_deleted' reports deleted in DNA since the watermark"""
+    if "sql_qq_deleted" not in config:
+        print("No 'sql_qq_deleted' in the config, persons deleted in DNA stay in the file until a full run")
+        return set()
+    if dbh is None:
+        raise ConnectionError("No DNA connection for 'sql_qq_deleted'")
+    cur = dbh.cursor()
+    try:
+        cur.execute(config["sql_qq_deleted"], {"watermark": watermark})
+        deleted = {str(row[0]) for row in cur.fetchall()}
+    finally:
+        cur.close()
+    print(f"Found {len(deleted)} persons deleted since {watermark.isoformat()}")
+    return deleted
+
+
+def load_incremental_state(state_file: str) -> tuple:
+    """(watermark, records by query key) saved by the previous incremental run, (None, {}) without one"""
+    records_file = state_file + ".records"
+    if not os.path.exists(state_file) or not os.path.exists(records_file):
+        return None, {}
+    with open(state_file, "r", encoding="utf-8") as f:
+        state = json.load(f)
+    if state.get("version") != INCREMENTAL_STATE_VERSION:
+        print("Incremental state was saved by an older version, extracting every record")
+        return None, {}
+    watermark = datetime.fromisoformat(state["watermark"])
+    records_by_key = {}
+    with open(records_file, "rb") as f:
+        for key, lines in read_pickled_chunks(f):
+            records_by_key.setdefault(key, []).extend(lines)
+    return watermark, records_by_key
+
+
+def save_incremental_state(state_file: str, watermark: datetime, records_by_key: Dict[str, List[str]]):
+    """saves this run's records and then its watermark, each through a temporary file so a failed run
+    leaves the previous state in place"""
+    records_file = state_file + ".records"
+    with open(records_file + ".tmp", "wb") as f:
+        for key, lines in records_by_key.items():
+            for pos in range(0, len(lines), 10000):
+                pickle.dump([(key, lines[pos:pos + 10000])], f, pickle.HIGHEST_PROTOCOL)
+    os.replace(records_file + ".tmp", records_file)
+    with open(state_file + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({
+            "version": INCREMENTAL_STATE_VERSION,
+            "watermark": watermark.isoformat(),
+            "records": sum(map(len, records_by_key.values())),
+        }, f)
+    os.replace(state_file + ".tmp", state_file)
+
+
+def merge_incremental_records(
+    previous: Dict[str, List[str]], changes: Dict[str, List[str]], deleted: Iterable[str] = ()
+) -> Dict[str, List[str]]:
+    """the previous run's records, with every person extracted again replaced by their new records under
+    every person query key, every organisation likewise under the organisation keys, and every deleted person
+    dropped; person and org numbers may coincide, so neither replaces the other's records. p2p_cust_org is
+    rebuilt in full from the P2P index on every run"""
+    org_keys = ("card_own_pers_org", "org")
+    changed_persons = {
+        line.split("|", 2)[1] for key, lines in changes.items()
+        if key not in org_keys and key != "p2p_cust_org" for line in lines
+    }
+    changed_orgs = {line.split("|", 2)[1] for key in org_keys for line in changes.get(key, [])}
+    removed_persons = changed_persons.union(deleted)
+    merged = {}
+    for key in QUERY_KEYS:
+        kept = []
+        if key != "p2p_cust_org":
+            removed = changed_orgs if key in org_keys else removed_persons
+            kept = [line for line in previous.get(key, []) if line.split("|", 2)[1] not in removed]
+        merged[key] = kept + changes.get(key, [])
+    print(
+        f"Merged changes for {len(changed_persons)} persons, {len(changed_orgs)} organisations and "
+        f"{len(removed_persons) - len(changed_persons)} deletions into {sum(map(len, previous.values()))} "
+        f"previous records"
+    )
+    return merged
+
+
+def apply_p2p_to_records(lines: List[str], p2p_cust) -> List[str]:
+    """person detail record lines formatted without P2P, as incremental runs keep them, with each person's
+    current P2P values applied: what format_record_batch gives with the P2P index for the same rows"""
+    positions = []  # (line position, P2P column, flag position or None) of every P2P field
+    pos = 0
+    for entry in resolve_detail_layout(DETAIL_LAYOUT[-1].start + 1, False):
+        if entry[0] == "p2p":
+            positions.append([pos, entry[1], None])
+        elif entry[0] == "flag":
+            positions[-1][2] = pos
+        pos += 6 if entry[0] == "ids" else 1
+    last = max(field_pos if flag_pos is None else flag_pos for field_pos, _, flag_pos in positions)
+
+    applied = []
+    for line in lines:
+        fields = line.split("|")
+        persnbr = fields[1] if len(fields) > 1 else ""
+        # the lines only have the persnbr's text, integer persnbrs are looked up as integers
+        p2p_rec = p2p_cust.get(persnbr)
+        if p2p_rec is None and persnbr.isdigit():
+            p2p_rec = p2p_cust.get(int(persnbr))
+        if p2p_rec is None or len(fields) <= last:
+            applied.append(line)
+            continue
+        for field_pos, column, flag_pos in positions:
+            value = p2p_rec.get(column)
+            if value:
+                fields[field_pos] = str(value)
+                if flag_pos is not None:
+                    fields[flag_pos] = "1"
+        applied.append("|".join(fields))
+    return applied
+
+
+class ZoeCheckpoint:
+    """spill files and a manifest of the completed (query key, partition) slices of a NEW run, so a rerun
+    with RESUME_YN=Y extracts only the slices that are missing. Slices are only reused when the thread count,
+    watermark and config match the run that saved them, and are then cut by the partition plans saved with them."""
+
+    MANIFEST = "manifest.json"
+    PLANS = "plans.pickle"  # pickled rather than JSON, so range bounds keep their database types
+
+    def __init__(self, directory: str, resume: bool):
+        self.directory = directory
+        self.started = datetime.now()
+        self.resumed = False
+        self.signature = None
+        self.completed: Dict[str, Dict] = {}
+        self.target = None
+        self._lock = threading.Lock()
+        self._spills: Dict[tuple, Any] = {}
+        manifest_path = os.path.join(directory, self.MANIFEST)
+        if resume and os.path.exists(manifest_path):
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            self.started = datetime.fromisoformat(manifest["started"])
+            self.resumed = True
+            self.signature = manifest["signature"]
+            self.completed = manifest["slices"]
+            print(f"Resuming from {len(self.completed)} completed slices in {directory}")
+        else:
+            if resume:
+                print(f"No checkpoint in {directory}, extracting every slice")
+            self.remove()
+        os.makedirs(directory, exist_ok=True)
+
+    def begin(self, target, max_threads: int, partition_plans: Dict, watermark: Optional[datetime], config,
+              incremental: bool = False) -> Dict:
+        """binds the record sink slices are restored to, drops the slices saved by a different setup and returns
+        the partition plans to extract with: the saved ones when resuming, as a fresh histogram can cut the
+        ranges differently from the slices already completed"""
+        self.target = target
+        signature = hashlib.sha256(json.dumps(
+            {"max_threads": max_threads, "watermark": watermark, "config": config, "incremental": incremental},
+            sort_keys=True, default=str,
+        ).encode("utf-8")).hexdigest()
+        plans_path = os.path.join(self.directory, self.PLANS)
+        if self.signature not in (None, signature):
+            print("Checkpoint was saved with other threads, watermark or config, extracting every slice")
+            self.remove()
+            os.makedirs(self.directory, exist_ok=True)
+            self.completed = {}
+        elif self.signature is not None and os.path.exists(plans_path):
+            with open(plans_path, "rb") as f:
+                partition_plans = pickle.load(f)
+            print(f"Reusing the checkpoint's partition plans for {', '.join(sorted(partition_plans)) or 'no keys'}")
+        self.signature = signature
+        with open(plans_path + ".tmp", "wb") as f:
+            pickle.dump(partition_plans, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(plans_path + ".tmp", plans_path)
+        self._save()
+        return partition_plans
+
+    def restore(self, task: ZoeTask) -> Optional[int]:
+        """feeds a completed slice's records to the sink and returns its row count, or None when it is missing"""
+        entry = self.completed.get(task.name)
+        if entry is None:
+            return None
+        slot = (QUERY_KEYS.index(task.key), task.partition)
+        if entry["file"]:
+            with open(os.path.join(self.directory, entry["file"]), "rb") as f:
+                for lines in read_pickled_chunks(f):
+                    self.target.add_batch(slot, lines)
+        return entry["rows"]
+
+    def add_batch(self, slot: tuple, lines: List[str]):
+        """forwards a batch to the sink and appends it to its slice's spill file"""
+        self.target.add_batch(slot, lines)
+        if not lines:
+            return
+        with self._lock:
+            spill = self._spills.get(slot)
+            if spill is None:
+                spill = self._spills[slot] = open(self._spill_path(slot) + ".part", "wb")
+        pickle.dump([lines], spill, pickle.HIGHEST_PROTOCOL)
+
+    def _spill_path(self, slot: tuple) -> str:
+        return os.path.join(self.directory, f"{QUERY_KEYS[slot[0]]}.{slot[1]}.spill")
+
+    def finish(self, task: ZoeTask, rows: int, failed: bool):
+        """records a finished slice in the manifest, or drops its partial spill file when it failed"""
+        slot = (QUERY_KEYS.index(task.key), task.partition)
+        path = self._spill_path(slot)
+        with self._lock:
+            spill = self._spills.pop(slot, None)
+        if spill is not None:
+            spill.close()
+            if failed:
+                os.remove(path + ".part")
+            else:
+                os.replace(path + ".part", path)
+        if failed:
+            return
+        with self._lock:
+            self.completed[task.name] = {"file": os.path.basename(path) if spill else None, "rows": rows}
+            self._save()
+
+    def _save(self):
+        manifest_path = os.path.join(self.directory, self.MANIFEST)
+        with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({
+                "started": self.started.isoformat(), "signature": self.signature, "slices": self.completed,
+            }, f, indent=2, sort_keys=True)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    def remove(self):
+        """deletes the manifest and every spill file"""
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name in (self.MANIFEST, self.PLANS) or name.endswith((".spill", ".part", ".tmp")):
+                os.remove(os.path.join(self.directory, name))
+        try:
+            os.rmdir(self.directory)
+        except OSError:
+            pass  # holds other files
+
+
 def collect_zoe_records_multithreaded(apwx, script_data) -> List[str]:
     """use multiple threads to fetch ZOE records in parallel and combine them into a single list"""
+    zoe_data = ZoeRecordCollector()
+    run_zoe_extraction(apwx, script_data, zoe_data)
+    return zoe_data.records()
+
+
+def run_zoe_extraction(apwx, script_data, zoe_data, watermark: Optional[datetime] = None):
+    """runs every (query key, partition) task with the ENGINE chosen, THREAD or ASYNC, feeding zoe_data,
+    and returns the P2P index loaded for it"""
+    if (apwx.args.ENGINE or "THREAD").upper() == "ASYNC":
+        dna_pool = create_dna_pool_async(apwx, int(apwx.args.MAX_THREADS))
+        if dna_pool is None:
+            raise ValueError("ENGINE=ASYNC needs the OSIUPDATE/OSIUPDATE_PW credentials for an oracledb async pool")
+        return asyncio.run(run_zoe_async(apwx, script_data, zoe_data, dna_pool, watermark))
+    return run_zoe_threads(apwx, script_data, zoe_data, watermark)
+
+
+def run_zoe_threads(apwx, script_data, zoe_data, watermark: Optional[datetime] = None):
+    """runs every (query key, partition) task on MAX_THREADS worker threads feeding zoe_data, returning the
+    P2P index"""
     threads_list = []
-    manager = Manager()
-    zoe_data = manager.list()
     max_threads = int(apwx.args.MAX_THREADS)
+    dna_pool = create_dna_pool(apwx, max_threads)
+    p2p_pool = create_p2p_pool(apwx, max_threads)
+
+    # the DNA sessions warm up in the background while the P2P index loads
+    dna_warm_up = threading.Thread(target=dna_pool.warm_up, name="dna-warm-up")
+    dna_warm_up.start()
+    try:
+        p2p_cust = load_shared_p2p_customers(p2p_pool, script_data)
+    finally:
+        p2p_pool.close()
+        dna_warm_up.join()
+
+    partition_plans = plan_query_partitions(script_data, dna_pool, max_threads)
+    extraction, tasks = prepare_zoe_extraction(
+        apwx, script_data, zoe_data, dna_pool, p2p_cust, partition_plans, watermark
+    )
+    task_queue = queue.Queue()
+    for task in tasks:
+        task_queue.put(task)
+    durations = {}
 
-    for thread_id in range(max_threads):
-        thread = threading.Thread(
-            target=thread_sub,
-            args=(
-                thread_id + 1,
-                script_data,
-                apwx,
-                thread_id,
-                max_threads,
-                zoe_data
-            ),
+    start = time.perf_counter()
+    try:
+        for thread_id in range(max_threads):
+            thread = threading.Thread(
+                target=thread_sub,
+                name=f"zoe-worker-{thread_id}",
+                args=(
+                    thread_id,
+                    task_queue,
+                    extraction,
+                    durations
+                ),
+            )
+            threads_list.append(thread)
+            thread.start()
+
+        for thread in threads_list:
+            thread.join()
+    finally:
+        dna_pool.close()
+        if extraction.formatter:
+            extraction.formatter.shutdown()
+    elapsed = time.perf_counter() - start
+
+    for pool in (dna_pool, p2p_pool):
+        pool.print_stats()
+    if script_data.metrics:
+        script_data.metrics.record_pools(dna_pool, p2p_pool)
+    finish_zoe_extraction(apwx, extraction, zoe_data, durations, elapsed)
+    return p2p_cust
+
+
+def prepare_zoe_extraction(apwx, script_data, zoe_data, dna_pool, p2p_cust, partition_plans, watermark):
+    """builds the state the workers of either engine share and returns it with the tasks still to run,
+    longest first; slices restored from a checkpoint are fed to zoe_data here"""
+    max_threads = int(apwx.args.MAX_THREADS)
+    format_workers = int(apwx.args.FORMAT_WORKERS or 0)
+    # incremental runs keep the DNA values and apply the P2P ones when writing, so a P2P change also
+    # reaches the persons whose DNA rows did not change
+    incremental = apwx.args.INCREMENTAL_YN == "Y"
+    detail_p2p = P2PCustomerIndex(["persnbr"], []) if incremental else p2p_cust
+    formatter = RecordFormatterPool(format_workers, detail_p2p) if format_workers > 0 else None
+
+    extraction = ZoeExtraction(script_data, dna_pool, p2p_cust, zoe_data, max_threads, formatter)
+    extraction.detail_p2p = detail_p2p
+    extraction.watermark = watermark
+    if apwx.args.COLUMNAR_YN == "Y":
+        if pa is None:
+            print("COLUMNAR_YN=Y but pyarrow is not installed, using the row fetch path")
+        else:
+            extraction.p2p_columns = build_p2p_columns(detail_p2p)
+    fetch_budget = int(float(apwx.args.FETCH_MEMORY_MB or 64) * 1048576)
+    extraction.fetch_tuners = {key: FetchTuner(key, fetch_budget) for key in QUERY_KEYS}
+    extraction.previous_durations = load_task_durations(apwx.args.TASK_STATS_FILE)
+    checkpoint = script_data.checkpoint
+    if checkpoint:
+        partition_plans = checkpoint.begin(
+            zoe_data, max_threads, partition_plans, watermark, script_data.config, incremental
         )
-        threads_list.append(thread)
-        thread.start()
+        extraction.zoe_data = checkpoint
+    extraction.partition_plans = partition_plans
+
+    tasks = []
+    for task in build_zoe_tasks(max_threads, extraction.previous_durations, partition_plans):
+        rows = checkpoint.restore(task) if checkpoint else None
+        if rows is not None:
+            extraction.row_counts[task.name] = rows
+            continue
+        tasks.append(task)
+    if checkpoint:
+        print(f"Restored {len(extraction.row_counts)} slices from the checkpoint, extracting {len(tasks)}")
+    return extraction, tasks
+
+
+def finish_zoe_extraction(apwx, extraction: ZoeExtraction, zoe_data, durations: Dict[str, float], elapsed: float):
+    """reports an extraction of either engine, saves the task durations and fails on failed slices
+    when they can be resumed"""
+    metrics = extraction.script_data.metrics
+    if metrics:
+        metrics.record_phase("extract", elapsed, records=len(zoe_data))
+    ideal = sum(durations.values()) / extraction.max_threads
+    print(f"Ran {len(durations)} tasks in {elapsed:.1f}s (ideal parallel time {ideal:.1f}s)")
+    print_partition_report(extraction)
+    for tuner in extraction.fetch_tuners.values():
+        if tuner.round_trips:
+            tuner.print_stats()
+    if apwx.args.TASK_STATS_FILE:
+        save_task_durations(apwx.args.TASK_STATS_FILE, durations, extraction.previous_durations)
+    if extraction.failed_tasks:
+        failed = ", ".join(sorted(extraction.failed_tasks))
+        if extraction.script_data.checkpoint:
+            raise RuntimeError(f"Slices failed: {failed}. Rerun with RESUME_YN=Y to extract only these")
+        print(f"WARNING: slices failed, the file is incomplete: {failed}")
+
+
+async def run_zoe_async(apwx, script_data, zoe_data, dna_pool, watermark: Optional[datetime] = None):
+    """ENGINE=ASYNC: every task is a coroutine on one event loop with at most MAX_THREADS queries in flight
+    on the oracledb async pool; the blocking P2P load runs in an executor meanwhile"""
+    max_threads = int(apwx.args.MAX_THREADS)
+    loop = asyncio.get_running_loop()
+    p2p_pool = create_p2p_pool(apwx, max_threads)
+    try:
+        p2p_load = loop.run_in_executor(None, load_shared_p2p_customers, p2p_pool, script_data)
+        partition_plans = await plan_query_partitions_async(script_data, dna_pool, max_threads)
+        p2p_cust = await p2p_load
+    except BaseException:
+        await dna_pool.close()
+        raise
+    finally:
+        p2p_pool.close()
 
-    for thread in threads_list:
-        thread.join()
+    extraction, tasks = prepare_zoe_extraction(
+        apwx, script_data, zoe_data, dna_pool, p2p_cust, partition_plans, watermark
+    )
+    task_queue = deque(tasks)
+    durations = {}
 
-    return list(zoe_data)
+    async def worker(worker_id: int):
+        while task_queue:
+            task = task_queue.popleft()
+            start = time.perf_counter()
+            stats = await process_zoe_task_async(task, extraction, worker_id)
+            finish_zoe_task(task, extraction, stats, time.perf_counter() - start, durations, worker_id)
 
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*(worker(worker_id) for worker_id in range(max_threads)))
+    finally:
+        await dna_pool.close()
+        if extraction.formatter:
+            extraction.formatter.shutdown()
+    elapsed = time.perf_counter() - start
+
+    p2p_pool.print_stats()
+    if script_data.metrics:
+        script_data.metrics.record_pools(p2p_pool)
+    finish_zoe_extraction(apwx, extraction, zoe_data, durations, elapsed)
+    return p2p_cust
 
-def write_new_mode_file(file_path: str, records: List[str], apwx, file_stat):
-    """writes header, details, trailers records to a file for new mode after cleaning and formatting the data"""
-    seq_nbr = 0
-    added = 0
-    acct_hash = 0
 
-    with open(file_path, "w", encoding="utf-8") as f:
-        f.write(build_cde_record() + "\n")
-        f.write(build_header_record({"test": apwx.args.TEST_YN, "fileType": "LOAD"}) + "\n")
+async def plan_query_partitions_async(script_data, dna_pool, max_threads: int) -> Dict[str, List[Dict]]:
+    """plan_query_partitions over the async pool, every histogram query running concurrently"""
+    plan_sql = script_data.config.get("partition_plan") or {}
+
+    async def histogram(key: str, sql: str):
+        dbh = None
+        failed = True
+        try:
+            dbh = await dna_pool.acquire()
+            cur = dbh.cursor()
+            try:
+                await cur.execute(sql)
+                rows = [(row[0], int(row[1])) for row in await cur.fetchall()]
+            finally:
+                cur.close()
+            failed = False
+            return rows
+        except Exception as e:
+            print(f"Error planning partitions for '{key}': {e}")
+            return []
+        finally:
+            if dbh is not None:
+                await release_async_connection(dna_pool, dbh, failed)
+
+    histograms = await asyncio.gather(*(histogram(key, sql) for key, sql in plan_sql.items()))
+    return {
+        key: plan_partitions_or_whole_range(key, rows, max_threads) for key, rows in zip(plan_sql, histograms)
+    }
 
-        print("Writing detail records")
+
+async def process_zoe_task_async(task: ZoeTask, extraction: ZoeExtraction, worker_id: int) -> Dict:
+    """process_zoe_task on an async pooled connection"""
+    if task.key == "p2p_cust_org":
+        # formatted from the P2P index alone, off the event loop so the fetches in flight are not stalled
+        return await asyncio.get_running_loop().run_in_executor(None, process_zoe_task, task, extraction)
+
+    sql, render_values = build_task_query(task, extraction)
+    stats = {}
+    dna_dbh = None
+    start = time.perf_counter()
+    try:
+        dna_dbh = await extraction.dna_pool.acquire()
+        stats["connect_secs"] = time.perf_counter() - start
+        extraction.row_counts[task.name] = await process_query_key_async(
+            task.key, dna_dbh, sql, extraction.detail_p2p, extraction.zoe_data, task.partition,
+            render_values, extraction.formatter, extraction.fetch_tuners.get(task.key), stats,
+        )
+    except Exception as e:
+        print(f"[WORKER {worker_id}] Error processing query '{task.key}': {e}")
+        stats["error"] = str(e)
+    finally:
+        if dna_dbh is not None:
+            # the query swallows its error, which may have been the session dying mid-fetch
+            await release_async_connection(extraction.dna_pool, dna_dbh, bool(stats.get("error")))
+    return stats
+
+
+async def release_async_connection(dna_pool, dbh, failed: bool):
+    """returns a connection to the async pool, or drops it after a failed statement so a broken session is
+    not lent out again, as ConnectionPool.invalidate does for the thread engine"""
+    if failed:
+        await dna_pool.drop(dbh)
+    else:
+        await dna_pool.release(dbh)
+
+
+async def process_query_key_async(
+    key, dbh, sql, p2p_cust, zoe_data, thread_id, render_values, formatter=None, tuner=None, stats=None
+) -> int:
+    """process_query_key with an oracledb async cursor; fetch waits yield the event loop to the other queries.
+    Batches are formatted off the loop, by the formatter pool or else the loop's default thread executor, as
+    formatting and its P2P lookups, SQLite queries with a snapshot, would stall every fetch in flight."""
+    tuner = tuner or FetchTuner(key)
+    stats = stats if stats is not None else {}
+    loop = asyncio.get_running_loop()
+    max_pending = formatter.max_pending if formatter is not None else 2
+    cur = dbh.cursor()
+    pending = deque()
+    rows = 0
+    row_bytes = 0
+    execute_secs = fetch_secs = format_secs = 0.0
+    try:
+        tuner.configure(cur)
+        start = time.perf_counter()
+        await cur.execute(sql, bind_values(sql, render_values))
+        execute_secs = time.perf_counter() - start
+
+        slot = (QUERY_KEYS.index(key), thread_id)
+        is_org = key in ["card_own_pers_org", "org"]
+        while True:
+            size = tuner.arraysize
+            cur.arraysize = size
+            start = time.perf_counter()
+            records = await cur.fetchmany(size)
+            secs = time.perf_counter() - start
+            tuner.observe(records, size, secs)
+            fetch_secs += secs
+            if not records:
+                break
+            rows += len(records)
+            row_bytes += estimate_row_bytes(records) * len(records)
+            start = time.perf_counter()
+            if formatter is None:
+                pending.append(loop.run_in_executor(None, format_record_batch, records, p2p_cust, is_org))
+            else:
+                pending.append(asyncio.wrap_future(formatter.submit([tuple(record) for record in records], is_org)))
+            # results are taken in submission order, so the slot keeps its row order
+            if len(pending) > max_pending:
+                zoe_data.add_batch(slot, await pending.popleft())
+            format_secs += time.perf_counter() - start
+        start = time.perf_counter()
+        while pending:
+            zoe_data.add_batch(slot, await pending.popleft())
+        format_secs += time.perf_counter() - start
+
+        print(f"[THREAD {thread_id}] Processed {rows} records from '{key}'.")
+
+    except Exception as e:
+        print(f"[THREAD {thread_id}] Error processing query '{key}': {e}")
+        stats["error"] = str(e)
+    finally:
+        cur.close()
+        stats.update(execute_secs=execute_secs, fetch_secs=fetch_secs, format_secs=format_secs, bytes=row_bytes)
+    return rows
+
+
+class ZoeLoadWriter:
+    """writes LOAD file records to an open file, tracking sequence number, account hash and counts for the trailer"""
+
+    def __init__(self, f, test_yn: str, sidecar=None):
+        self.f = f
+        self.test_yn = test_yn
+        self.sidecar = sidecar
+        self.seq_nbr = 0
+        self.added = 0
+        self.acct_hash = 0
+
+    def _write(self, line: str):
+        self.f.write(line + "\n")
+        if self.sidecar is not None:
+            self.sidecar.add_line(line)
+
+    def write_header(self):
+        self._write(build_cde_record())
+        self._write(build_header_record({"test": self.test_yn, "fileType": "LOAD"}))
+
+    def write_records(self, records: List[str]):
         for record in records:
             clean_record = clean_record_report(record)
             fields = clean_record.split("|")
 
             if len(fields) > 3:  # Ensure record has at least 4 fields (expected format)
-                acct_hash += safe_int(fields[3])
+                self.acct_hash += safe_int(fields[3])
 
-            detail_record = build_detail_report(seq_nbr + 1, fields, apwx.args.TEST_YN)
-            seq_nbr += 1
-            added += 1
-            f.write(detail_record + "\n")
+            detail_record = build_detail_report(self.seq_nbr + 1, fields, self.test_yn)
+            self.seq_nbr += 1
+            self.added += 1
+            self._write(detail_record)
 
+    def write_trailer(self, file_stat):
         trailer = build_trailer_record({
-            "record_ct": len(records) + 2,
-            "added": added,
+            "record_ct": self.seq_nbr + 2,
+            "added": self.added,
             "changed": 0,
             "deleted": 0,
-            "acctHash": acct_hash,
-            "test": apwx.args.TEST_YN,
+            "acctHash": self.acct_hash,
+            "test": self.test_yn,
             "fileType": "LOAD",
         }, file_stat)
-        f.write(trailer + "\n")
+        self._write(trailer)
 
 
-def process_delta_mode(apwx, file_path: str) -> bool:
+def write_new_mode_file(file_path: str, records: List[str], apwx, file_stat, metrics: Optional[RunMetrics] = None):
+    """writes header, details, trailers records to a file for new mode after cleaning and formatting the data"""
+    sidecar = ZoeSidecarWriter(file_path) if wants_sidecar(apwx) else None
+    shards = min(int(apwx.args.OUTPUT_SHARDS or 1), len(records))
+    if shards > available_cpus():
+        # shards beyond the CPUs only add process start-up and pickling to the same formatting work
+        shards = available_cpus()
+        print(f"OUTPUT_SHARDS is more than the {shards} CPUs available, writing {shards} shards")
+    start = time.perf_counter()
+    try:
+        if shards > 1:
+            zoe_writer = write_sharded_zoe_file(file_path, records, apwx.args.TEST_YN, file_stat, shards, sidecar)
+        else:
+            with open(file_path, "w", encoding="utf-8", newline="\n") as f:
+                zoe_writer = ZoeLoadWriter(f, apwx.args.TEST_YN, sidecar)
+                zoe_writer.write_header()
+
+                print("Writing detail records")
+                zoe_writer.write_records(records)
+                zoe_writer.write_trailer(file_stat)
+    except BaseException:
+        if sidecar:
+            sidecar.discard()
+        raise
+    if sidecar:
+        sidecar.close()
+    else:
+        remove_zoe_sidecar(file_path)
+    if metrics:
+        metrics.record_phase(
+            "write", time.perf_counter() - start, records=zoe_writer.added, bytes=os.path.getsize(file_path)
+        )
+
+
+def write_sharded_zoe_file(
+    file_path: str, records: List[str], test_yn: str, file_stat, shards: int, sidecar=None
+) -> ZoeLoadWriter:
+    """writes the detail records as 'shards' files in parallel processes, each numbering its slice from the
+    slice's position in the whole file, then joins them between the header and the trailer in the kernel.
+    Each worker is sent only its own slice of the records."""
+    size = -(-len(records) // shards)
+    starts = list(range(0, len(records), size))
+    shard_paths = [f"{file_path}.shard{shard}" for shard in range(len(starts))]
+    print(f"Writing detail records in {len(starts)} shards")
+    try:
+        with ProcessPoolExecutor(max_workers=len(starts), mp_context=worker_process_context()) as pool:
+            futures = [
+                pool.submit(_write_zoe_shard, shard_path, records[pos:pos + size], pos + 1, test_yn, bool(sidecar))
+                for shard_path, pos in zip(shard_paths, starts)
+            ]
+            results = [future.result() for future in futures]
+
+        with open(file_path, "w", encoding="utf-8", newline="\n") as f:
+            zoe_writer = ZoeLoadWriter(f, test_yn, sidecar)
+            zoe_writer.write_header()
+            f.flush()
+            for shard_path, (added, acct_hash) in zip(shard_paths, results):
+                if sidecar:
+                    sidecar.add_shard(shard_path)
+                append_file(f.fileno(), shard_path)
+                zoe_writer.seq_nbr += added
+                zoe_writer.added += added
+                zoe_writer.acct_hash += acct_hash
+            f.seek(0, os.SEEK_END)  # the shards were appended below the text layer
+            zoe_writer.write_trailer(file_stat)
+    finally:
+        for shard_path in shard_paths:
+            for path in (shard_path, shard_path + ".idx"):
+                if os.path.exists(path):
+                    os.remove(path)
+    return zoe_writer
+
+
+def available_cpus() -> int:
+    """CPUs this process may run on, which can be fewer than the machine has"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _write_zoe_shard(shard_path: str, records: List[str], first_seq: int, test_yn: str, sidecar: bool) -> tuple:
+    """writes one shard of detail records numbered from first_seq, returning (records written, account hash)"""
+    shard_sidecar = ZoeSidecarWriter(shard_path) if sidecar else None
+    with open(shard_path, "w", encoding="utf-8", newline="\n") as f:
+        zoe_writer = ZoeLoadWriter(f, test_yn, shard_sidecar)
+        zoe_writer.seq_nbr = first_seq - 1
+        zoe_writer.write_records(records)
+    if shard_sidecar:
+        shard_sidecar.close()
+    return zoe_writer.added, zoe_writer.acct_hash
+
+
+def append_file(dst_fd: int, src_path: str):
+    """appends a file at the position of dst_fd with copy_file_range, or sendfile, so the data never passes
+    through user space; falls back to a buffered copy where neither is available"""
+    with open(src_path, "rb") as src:
+        remaining = os.fstat(src.fileno()).st_size
+        copiers = []
+        if hasattr(os, "copy_file_range"):
+            copiers.append(lambda count: os.copy_file_range(src.fileno(), dst_fd, count))
+        if hasattr(os, "sendfile"):
+            copiers.append(lambda count: os.sendfile(dst_fd, src.fileno(), None, count))
+        for copy in copiers:
+            try:
+                while remaining > 0:
+                    copied = copy(remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                return
+            except OSError as e:
+                print(f"Kernel copy of {src_path} failed, trying the next method: {e}")
+        with open(dst_fd, "wb", closefd=False) as dst:
+            shutil.copyfileobj(src, dst)
+
+
+class ZoeSidecarWriter:
+    """writes '<ZOE file>.idx' alongside a LOAD file: for every record line the 64-bit key hash, record digest
+    and byte offset, after a header with the record count, account hash, and size and mtime of the ZOE file.
+    Offsets count one byte per newline, so LOAD files are written with newline='\\n' on every platform."""
+
+    HEADER = struct.Struct("<8sQqQQ")
+    MAGIC = b"ZOEIDX2\0"
+    ENTRY_WORDS = 3  # key hash, digest, offset
+    FLUSH_ENTRIES = 65536
+
+    def __init__(self, zoe_path: str):
+        self.zoe_path = zoe_path
+        self.path = zoe_path + ".idx"
+        self._f = open(self.path + ".tmp", "wb")
+        self._f.write(bytes(self.HEADER.size))
+        self._entries = array("Q")
+        self.count = 0
+        self.acct_hash = 0
+        self.offset = 0
+
+    def add_line(self, line: str):
+        """indexes one line written to the ZOE file, called for every line so the offsets stay exact"""
+        raw = line.encode("utf-8")
+        parsed = parse_zoe_record(strip_zoe_line(raw))
+        if parsed is not None:
+            key, record_data, acct = parsed
+            self._entries.extend((zoe_fingerprint(key), zoe_fingerprint(record_data), self.offset))
+            self.count += 1
+            self.acct_hash += acct
+            if len(self._entries) >= self.FLUSH_ENTRIES * self.ENTRY_WORDS:
+                self._flush()
+        self.offset += len(raw) + 1
+
+    def add_shard(self, shard_path: str):
+        """indexes a shard file appended to the ZOE file at the current offset, from the shard's own sidecar"""
+        keys, digests, offsets, acct_hash = load_zoe_sidecar(shard_path)
+        self._flush()
+        if np is not None:
+            entries = np.column_stack((keys, digests, np.asarray(offsets, dtype=np.uint64) + np.uint64(self.offset)))
+            self._f.write(entries.astype(np.uint64).tobytes())
+        else:
+            for key, digest, offset in zip(keys, digests, offsets):
+                self._entries.extend((key, digest, offset + self.offset))
+        self.count += len(keys)
+        self.acct_hash += acct_hash
+        self.offset += os.path.getsize(shard_path)
+
+    def _flush(self):
+        self._entries.tofile(self._f)
+        self._entries = array("Q")
+
+    def close(self):
+        """completes the index once the ZOE file is closed and moves it into place"""
+        self._flush()
+        self._f.seek(0)
+        zoe_stat = os.stat(self.zoe_path)
+        self._f.write(self.HEADER.pack(self.MAGIC, self.count, self.acct_hash, zoe_stat.st_size, zoe_stat.st_mtime_ns))
+        self._f.close()
+        os.replace(self.path + ".tmp", self.path)
+        print(f"Wrote sidecar index {self.path} ({self.count} records)")
+
+    def discard(self):
+        self._f.close()
+        os.remove(self.path + ".tmp")
+
+
+def read_zoe_sidecar_header(zoe_path: str) -> Optional[tuple]:
+    """(record count, account hash) from the sidecar index of a ZOE file, None when there is no sidecar or it
+    does not describe the file as it is now: the file must have the size and modification time it was indexed at"""
+    sidecar_path = zoe_path + ".idx"
+    if not os.path.exists(sidecar_path) or not os.path.exists(zoe_path):
+        return None
+    header = ZoeSidecarWriter.HEADER
+    with open(sidecar_path, "rb") as f:
+        magic, count, acct_hash, zoe_size, zoe_mtime = header.unpack(f.read(header.size).ljust(header.size, b"\0"))
+    entry_size = ZoeSidecarWriter.ENTRY_WORDS * 8
+    zoe_stat = os.stat(zoe_path)
+    if (magic != ZoeSidecarWriter.MAGIC or zoe_size != zoe_stat.st_size or zoe_mtime != zoe_stat.st_mtime_ns
+            or os.path.getsize(sidecar_path) != header.size + count * entry_size):
+        print(f"Ignoring stale sidecar index {sidecar_path}")
+        return None
+    return count, acct_hash
+
+
+def remove_zoe_sidecar(zoe_path: str):
+    """deletes the sidecar index left by an earlier write of a ZOE file that is now written without one"""
+    if os.path.exists(zoe_path + ".idx"):
+        os.remove(zoe_path + ".idx")
+        print(f"Removed the sidecar index of the previous {zoe_path}")
+
+
+def load_zoe_sidecar(zoe_path: str) -> Optional[tuple]:
+    """(key hashes, digests, offsets, account hash) from the sidecar index of a ZOE file, memory-mapped when
+    NumPy is available; None when it has no current sidecar"""
+    sidecar_header = read_zoe_sidecar_header(zoe_path)
+    if sidecar_header is None:
+        return None
+    count, acct_hash = sidecar_header
+    if count == 0:
+        return array("Q"), array("Q"), array("Q"), acct_hash
+    with open(zoe_path + ".idx", "rb") as f:
+        if np is not None:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            entries = np.frombuffer(buffer, dtype=np.uint64, count=count * 3, offset=ZoeSidecarWriter.HEADER.size)
+            entries = entries.reshape(count, 3)
+            return entries[:, 0], entries[:, 1], entries[:, 2], acct_hash
+        f.seek(ZoeSidecarWriter.HEADER.size)
+        words = array("Q")
+        words.frombytes(f.read(count * ZoeSidecarWriter.ENTRY_WORDS * 8))
+        return words[0::3], words[1::3], words[2::3], acct_hash
+
+
+class StreamingZoeWriter:
+    """record sink that feeds fetched batches through a bounded queue to a single LOAD file writer thread.
+    The file is written as '<file>.part' and only renamed into place once it is complete."""
+
+    def __init__(self, file_path: str, test_yn: str, file_stat, max_batches: int = 64, sidecar: bool = False,
+                 profiler: Optional[RunProfiler] = None):
+        self.file_path = file_path
+        self.part_path = file_path + ".part"
+        self.test_yn = test_yn
+        self.file_stat = file_stat
+        self.profiler = profiler
+        self.sidecar = ZoeSidecarWriter(file_path) if sidecar else None
+        self._queue = queue.Queue(maxsize=max_batches)
+        self._thread = threading.Thread(target=self._write_loop, name="zoe-writer")
+        self._file = None
+        self._writer = None
+        self._error = None
+        self.write_secs = 0.0  # time the writer thread spent formatting and writing, not waiting
+
+    def start(self):
+        self._file = open(self.part_path, "w", encoding="utf-8", newline="\n")
+        self._writer = ZoeLoadWriter(self._file, self.test_yn, self.sidecar)
+        self._writer.write_header()
+        self._thread.start()
+
+    def add_batch(self, slot: tuple, lines: List[str]):
+        """blocks while the queue is full, so fetching never runs more than max_batches ahead of the file"""
+        if lines:
+            self._queue.put(lines)
+
+    def __len__(self) -> int:
+        return self._writer.added if self._writer else 0
+
+    def _write_loop(self):
+        with profiled(self.profiler, "writer"):
+            while True:
+                lines = self._queue.get()
+                if lines is None:
+                    break
+                if self._error is not None:
+                    continue  # keep draining so producers never block on a dead writer
+                start = time.perf_counter()
+                try:
+                    self._writer.write_records(lines)
+                except Exception as e:
+                    self._error = e
+                self.write_secs += time.perf_counter() - start
+
+    def close(self):
+        """stops the writer thread, finishes the file with its trailer and moves it into place"""
+        self._queue.put(None)
+        self._thread.join()
+        try:
+            if self._error is None:
+                self._writer.write_trailer(self.file_stat)
+        except BaseException:
+            self._file.close()
+            self._discard()
+            raise
+        self._file.close()
+        if self._error is not None:
+            self._discard()
+            raise self._error
+        os.replace(self.part_path, self.file_path)
+        if self.sidecar:
+            self.sidecar.close()
+        else:
+            remove_zoe_sidecar(self.file_path)
+
+    def abort(self):
+        """stops the writer thread and deletes the unfinished file, leaving any previous file in place"""
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+        self._discard()
+
+    def _discard(self):
+        os.remove(self.part_path)
+        if self.sidecar:
+            self.sidecar.discard()
+
+
+def process_delta_mode(apwx, file_path: str, metrics: Optional[RunMetrics] = None) -> bool:
     """Handles DELTA mode logic by comparing new and old files and writing difference to output file"""
-    seq_nbr = 0
-    added = 0
-    changed = 0
-    deleted = 0
+    return write_delta_file(apwx, file_path, apwx.args.OLD_ZOE_FILE, apwx.args.NEW_ZOE_FILE, metrics=metrics)
+
+
+def write_delta_file(
+    apwx, file_path: str, old_path: str, new_path: str, engine: Optional[str] = None,
+    metrics: Optional[RunMetrics] = None,
+) -> bool:
+    """writes the UPDT file of the differences from old_path to new_path with the DELTA_ENGINE, or 'engine'"""
+    start = time.perf_counter()
+    engine = (engine or apwx.args.DELTA_ENGINE or "HASH").upper()
+    deletes = apwx.args.DELTA_DELETES_YN == "Y"
+    delta_workers = int(apwx.args.DELTA_WORKERS or 1)
+    if engine == "HASH" and read_zoe_sidecar_header(old_path) is not None:
+        engine = "DIGEST"  # same output, without parsing the old file
+        print(f"{old_path} has a sidecar index, comparing with the DIGEST engine")
+    if delta_workers > 1 and engine != "HASH":
+        print(f"DELTA_WORKERS={delta_workers} only splits the HASH engine, the {engine} engine runs serially")
 
     with open(file_path, "w", encoding="utf-8") as f:
-        f.write(build_cde_record() + "\n")
-        f.write(build_header_record({"test": apwx.args.TEST_YN, "fileType": "UPDT"}) + "\n")
+        delta_writer = ZoeDeltaWriter(f, apwx.args.TEST_YN)
+        delta_writer.write_header()
         file_stat = get_file_stat_if_exists(file_path)
-        hash_old, _ = get_zoe_file_hash(apwx.args.OLD_ZOE_FILE)
-        hash_new, acct_hash_new = get_zoe_file_hash(apwx.args.NEW_ZOE_FILE)
-        print("Comparing New to Old")
-        for key, new_rec in hash_new.items():
-            if key in hash_old:
-                # Start sequence number from 1 for file line records (not zero-based)
-                line_seq_nbr = seq_nbr + 1
-                if new_rec != hash_old[key]:
-                    f.write(build_delta_detail_report(line_seq_nbr, new_rec, 'C', apwx.args.TEST_YN) + "\n")
-                    seq_nbr += 1
-                    changed += 1
-            else:
-                f.write(build_delta_detail_report(line_seq_nbr, new_rec, 'A', apwx.args.TEST_YN) + "\n")
-                seq_nbr += 1
-                added += 1
+        if engine == "DIGEST":
+            acct_hash_new = diff_zoe_files_by_digest(old_path, new_path, delta_writer, deletes)
+        elif engine == "HASH" and delta_workers > 1:
+            acct_hash_new = diff_zoe_files_parallel(old_path, new_path, delta_writer, delta_workers, deletes)
+        elif engine == "SORT":
+            memory_budget = int(float(apwx.args.DELTA_MEMORY_MB or 512) * 1048576)
+            acct_hash_new = diff_zoe_files_sorted(old_path, new_path, delta_writer, memory_budget, deletes)
+        else:
+            hash_old, _ = get_zoe_file_hash(old_path)
+            hash_new, acct_hash_new = get_zoe_file_hash(new_path)
+            print("Comparing New to Old")
+            for key, new_rec in hash_new.items():
+                if key not in hash_old:
+                    delta_writer.write_record(new_rec, "A")
+                elif new_rec != hash_old[key]:
+                    delta_writer.write_record(new_rec, "C")
+            if deletes:
+                for key, old_rec in hash_old.items():
+                    if key not in hash_new:
+                        delta_writer.write_record(old_rec, "D")
+
+        delta_writer.write_trailer(acct_hash_new, file_stat)
+
+    if metrics:
+        metrics.record_phase(
+            "delta", time.perf_counter() - start, records=delta_writer.seq_nbr, engine=engine,
+            bytes=sum(os.path.getsize(path) for path in (old_path, new_path) if path and os.path.exists(path)),
+        )
+    return True
+
+
+class ZoeDeltaWriter:
+    """writes UPDT file records to an open file, numbering the detail records and counting them by action"""
 
+    def __init__(self, f, test_yn: str):
+        self.f = f
+        self.test_yn = test_yn
+        self.seq_nbr = 0
+        self.counts = {"A": 0, "C": 0, "D": 0}
+
+    def write_header(self):
+        self.f.write(build_cde_record() + "\n")
+        self.f.write(build_header_record({"test": self.test_yn, "fileType": "UPDT"}) + "\n")
+
+    def write_record(self, record: str, action: str):
+        # sequence numbers start from 1 for detail records
+        self.seq_nbr += 1
+        self.counts[action] += 1
+        self.f.write(build_delta_detail_report(self.seq_nbr, record, action, self.test_yn) + "\n")
+
+    def write_trailer(self, acct_hash: int, file_stat):
         trailer = build_trailer_record({
-            "record_ct": seq_nbr + 2,
-            "added": added,
-            "changed": changed,
-            "deleted": deleted,
-            "acctHash": acct_hash_new,
-            "test": apwx.args.TEST_YN,
+            "record_ct": self.seq_nbr + 2,
+            "added": self.counts["A"],
+            "changed": self.counts["C"],
+            "deleted": self.counts["D"],
+            "acctHash": acct_hash,
+            "test": self.test_yn,
             "fileType": "UPDT",
         }, file_stat)
+        self.f.write(trailer + "\n")
+
+
+class ExternalSorter:
+    """sorts more tuples than fit in memory: once the buffered items pass memory_budget bytes they are
+    sorted and pickled to a temporary run file, and sorted() merges the runs back lazily"""
+
+    def __init__(self, memory_budget: int, chunk_items: int = 10000):
+        self.memory_budget = memory_budget
+        self.chunk_items = chunk_items
+        self._items = []
+        self._bytes = 0
+        self._runs = []
+
+    def add(self, item: tuple, size: int):
+        self._items.append(item)
+        self._bytes += size + 100  # tuple and object overhead
+        if self._bytes >= self.memory_budget:
+            self._spill()
+
+    def _spill(self):
+        self._items.sort()
+        run_file = tempfile.TemporaryFile()
+        for pos in range(0, len(self._items), self.chunk_items):
+            pickle.dump(self._items[pos:pos + self.chunk_items], run_file, pickle.HIGHEST_PROTOCOL)
+        run_file.seek(0)
+        self._runs.append(run_file)
+        self._items = []
+        self._bytes = 0
+
+    def sorted(self):
+        """yields every item in order; runs are read back one chunk at a time"""
+        self._items.sort()
+        if not self._runs:
+            return iter(self._items)
+        print(f"Merging {len(self._runs)} sorted runs")
+        return heapq.merge(self._items, *(read_pickled_chunks(run_file) for run_file in self._runs))
+
+    def close(self):
+        for run_file in self._runs:
+            run_file.close()
+        self._runs = []
+        self._items = []
+
+
+def read_pickled_chunks(f):
+    """yields the items of the pickled lists written one after another to a binary file"""
+    while True:
+        try:
+            chunk = pickle.load(f)
+        except EOFError:
+            return
+        yield from chunk
 
-        f.write(trailer + "\n")
 
-    return True
+def sort_zoe_file(file_path: str, memory_budget: int) -> tuple:
+    """spills the records of a ZOE file as (key, position, record) sorted by key then file position,
+    returning the sorter and the file's account hash"""
+    sorter = ExternalSorter(memory_budget)
+    acct_hash = 0
+    for pos, (key, record_data, acct) in enumerate(iter_zoe_records(file_path)):
+        sorter.add((key, pos, record_data), len(record_data))
+        acct_hash += acct
+    return sorter, acct_hash
+
+
+def _latest_by_key(sorted_records):
+    """collapses (key, position, record) runs of one key into (key, first position, last record), the way
+    a dict keeps a key where it was first inserted with the value assigned last"""
+    for key, group in groupby(sorted_records, key=lambda item: item[0]):
+        first = last = next(group)
+        for last in group:
+            pass
+        yield key, first[1], last[2]
+
+
+def diff_zoe_files_sorted(old_path: str, new_path: str, delta_writer, memory_budget: int, deletes: bool) -> int:
+    """bounded-memory DELTA: sorts both files by key into spill runs, diffs them in one merge pass and writes
+    the A/C (and D) records in the order the hash comparison would; returns the new file's account hash"""
+    budget = max(memory_budget // 3, 65536)
+    old_sorter, _ = sort_zoe_file(old_path, budget)
+    new_sorter, acct_hash_new = sort_zoe_file(new_path, budget)
+    changes = ExternalSorter(budget)
+    try:
+        print("Comparing New to Old")
+        old_iter = _latest_by_key(old_sorter.sorted())
+        old = next(old_iter, None)
+        for key, new_pos, new_rec in _latest_by_key(new_sorter.sorted()):
+            while old is not None and old[0] < key:
+                if deletes:
+                    changes.add((1, old[1], "D", old[2]), len(old[2]))
+                old = next(old_iter, None)
+            if old is None or old[0] != key:
+                changes.add((0, new_pos, "A", new_rec), len(new_rec))
+                continue
+            if new_rec != old[2]:
+                changes.add((0, new_pos, "C", new_rec), len(new_rec))
+            old = next(old_iter, None)
+        while deletes and old is not None:
+            changes.add((1, old[1], "D", old[2]), len(old[2]))
+            old = next(old_iter, None)
+
+        # additions and changes in new file order, then deletions in old file order
+        for _, _, action, record in changes.sorted():
+            delta_writer.write_record(record, action)
+    finally:
+        for sorter in (old_sorter, new_sorter, changes):
+            sorter.close()
+    return acct_hash_new
+
+
+def zoe_fingerprint(data: bytes) -> int:
+    """64-bit blake2b digest of the raw bytes of a key or record"""
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+
+class ZoeFingerprintIndex:
+    """compact form of a ZOE file for DELTA: per key, a 64-bit hash of the key and of its last record, with
+    the positions of the key's first and last records; NumPy arrays sorted by key hash, or a dict without NumPy"""
+
+    def __init__(self, keys, digests, offsets=None):
+        count = len(keys)
+        self.offsets = offsets  # byte offset of each record line, by position, when loaded from a sidecar
+        if np is not None:
+            key_arr = np.asarray(keys, dtype=np.uint64)
+            order = np.argsort(key_arr, kind="stable")  # equal keys stay in file order
+            sorted_keys = key_arr[order]
+            group_start = np.ones(count, dtype=bool)
+            group_start[1:] = sorted_keys[1:] != sorted_keys[:-1]
+            group_end = np.ones(count, dtype=bool)
+            group_end[:-1] = group_start[1:]
+            self.keys = sorted_keys[group_start]
+            self.first_pos = order[group_start]
+            self.last_pos = order[group_end]
+            self.digests = np.asarray(digests, dtype=np.uint64)[self.last_pos]
+        else:
+            self.by_key = {}
+            for pos in range(count):
+                entry = self.by_key.get(keys[pos])
+                if entry is None:
+                    self.by_key[keys[pos]] = [digests[pos], pos, pos]
+                else:
+                    entry[0], entry[2] = digests[pos], pos
+
+    @classmethod
+    def from_file(cls, file_path: str) -> tuple:
+        """reads a ZOE file once, returning its index and account hash"""
+        keys, digests = array("Q"), array("Q")
+        acct_hash = 0
+        for key, record_data, acct in ZoeFileReader(file_path):
+            keys.append(zoe_fingerprint(key))
+            digests.append(zoe_fingerprint(record_data))
+            acct_hash += acct
+        return cls(keys, digests), acct_hash
+
+    @classmethod
+    def load(cls, file_path: str) -> tuple:
+        """index and account hash of a ZOE file, from its sidecar index when it has a current one"""
+        sidecar = load_zoe_sidecar(file_path)
+        if sidecar is None:
+            return cls.from_file(file_path)
+        print(f"Using sidecar index for {file_path}")
+        keys, digests, offsets, acct_hash = sidecar
+        return cls(keys, digests, offsets), acct_hash
+
+    def __len__(self) -> int:
+        return len(self.keys) if np is not None else len(self.by_key)
+
+    def diff(self, new: "ZoeFingerprintIndex", deletes: bool) -> tuple:
+        """compares this (old) index with the new one, returning {new last position: (first position, action)}
+        for added/changed keys and {old last position: first position} for deleted keys"""
+        if np is None:
+            wanted_new = {}
+            for key, (digest, first_pos, last_pos) in new.by_key.items():
+                old = self.by_key.get(key)
+                if old is None:
+                    wanted_new[last_pos] = (first_pos, "A")
+                elif old[0] != digest:
+                    wanted_new[last_pos] = (first_pos, "C")
+            wanted_old = {
+                last_pos: first_pos for key, (_, first_pos, last_pos) in self.by_key.items() if key not in new.by_key
+            } if deletes else {}
+            return wanted_new, wanted_old
+
+        slots = np.searchsorted(self.keys, new.keys)
+        found = np.zeros(len(new.keys), dtype=bool)
+        in_range = slots < len(self.keys)
+        found[in_range] = self.keys[slots[in_range]] == new.keys[in_range]
+        changed = np.zeros(len(new.keys), dtype=bool)
+        changed[found] = self.digests[slots[found]] != new.digests[found]
+        wanted_new = {int(last): (int(first), "A") for first, last in zip(new.first_pos[~found], new.last_pos[~found])}
+        wanted_new.update(
+            (int(last), (int(first), "C")) for first, last in zip(new.first_pos[changed], new.last_pos[changed])
+        )
+        wanted_old = {}
+        if deletes:
+            gone = ~np.isin(self.keys, new.keys)
+            wanted_old = {int(last): int(first) for first, last in zip(self.first_pos[gone], self.last_pos[gone])}
+        return wanted_new, wanted_old
+
+
+def _records_at(file_path: str, wanted: Dict[int, Any], offsets=None):
+    """yields (position, record data, wanted value) for the record positions of a ZOE file in 'wanted', seeking
+    straight to them when their byte offsets are known"""
+    if not wanted:
+        return
+    if offsets is None:
+        for pos, (_, record_data, _) in enumerate(ZoeFileReader(file_path)):
+            if pos in wanted:
+                yield pos, decode_zoe_field(record_data), wanted[pos]
+        return
+    with open(file_path, "rb") as f:
+        for pos in sorted(wanted, key=lambda pos: offsets[pos]):
+            f.seek(int(offsets[pos]))
+            _, record_data, _ = parse_zoe_record(strip_zoe_line(f.readline()))
+            yield pos, decode_zoe_field(record_data), wanted[pos]
+
+
+def diff_zoe_files_by_digest(old_path: str, new_path: str, delta_writer, deletes: bool) -> int:
+    """DELTA against fingerprint indexes of both files: only the records that changed are ever held as
+    strings, read back in a second pass; writes in the order of the hash comparison and returns the new
+    file's account hash"""
+    old_index, _ = ZoeFingerprintIndex.load(old_path)
+    new_index, acct_hash_new = ZoeFingerprintIndex.load(new_path)
+    print("Comparing New to Old")
+    wanted_new, wanted_old = old_index.diff(new_index, deletes)
+    old_offsets, new_offsets = old_index.offsets, new_index.offsets
+    del old_index, new_index
+
+    changes = [
+        (0, first_pos, action, record)
+        for _, record, (first_pos, action) in _records_at(new_path, wanted_new, new_offsets)
+    ]
+    changes += [(1, first_pos, "D", record) for _, record, first_pos in _records_at(old_path, wanted_old, old_offsets)]
+    # additions and changes in new file order, then deletions in old file order
+    changes.sort(key=lambda change: change[:2])
+    for _, _, action, record in changes:
+        delta_writer.write_record(record, action)
+    return acct_hash_new
+
+
+def _split_zoe_file(file_path: str, shard_dir: str, name: str, shards: int) -> tuple:
+    """splits the records of a ZOE file into shard files by key hash, each holding pickled chunks of
+    (file position, key, record data); returns the shard paths and the file's account hash"""
+    paths = [os.path.join(shard_dir, f"{name}.{shard}") for shard in range(shards)]
+    files = [open(path, "wb") for path in paths]
+    chunks = [[] for _ in range(shards)]
+    acct_hash = 0
+    try:
+        for pos, (key, record_data, acct) in enumerate(ZoeFileReader(file_path)):
+            shard = zlib.crc32(key) % shards
+            chunks[shard].append((pos, key, record_data))
+            if len(chunks[shard]) >= 10000:
+                pickle.dump(chunks[shard], files[shard], pickle.HIGHEST_PROTOCOL)
+                chunks[shard] = []
+            acct_hash += acct
+        for shard in range(shards):
+            pickle.dump(chunks[shard], files[shard], pickle.HIGHEST_PROTOCOL)
+    finally:
+        for f in files:
+            f.close()
+    return paths, acct_hash
+
+
+def _latest_in_shard(shard_path: str) -> Dict[bytes, list]:
+    """key -> [first position, last record data] for one shard file, as a dict would keep them"""
+    latest = {}
+    with open(shard_path, "rb") as f:
+        for pos, key, record_data in read_pickled_chunks(f):
+            entry = latest.get(key)
+            if entry is None:
+                latest[key] = [pos, record_data]
+            else:
+                entry[1] = record_data
+    return latest
+
+
+def _diff_zoe_shard(old_shard: str, new_shard: str, deletes: bool) -> List[tuple]:
+    """runs in a DELTA worker process: the (group, position, action, record) changes of one key shard,
+    sorted the way the serial comparison writes them"""
+    old = _latest_in_shard(old_shard)
+    new = _latest_in_shard(new_shard)
+    changes = []
+    for key, (pos, record_data) in new.items():
+        old_entry = old.get(key)
+        if old_entry is None:
+            changes.append((0, pos, "A", decode_zoe_field(record_data)))
+        elif old_entry[1] != record_data:
+            changes.append((0, pos, "C", decode_zoe_field(record_data)))
+    if deletes:
+        changes += [
+            (1, pos, "D", decode_zoe_field(record_data)) for key, (pos, record_data) in old.items() if key not in new
+        ]
+    changes.sort(key=lambda change: change[:2])
+    return changes
+
+
+def diff_zoe_files_parallel(old_path: str, new_path: str, delta_writer, workers: int, deletes: bool) -> int:
+    """HASH comparison spread over 'workers' processes: both files are split into key-hash shards, each shard
+    pair is diffed in the pool, and the sorted shard results are merged so sequence numbers, counts and the
+    account hash come out as in a serial run; returns the new file's account hash"""
+    with tempfile.TemporaryDirectory(prefix="zoe-delta-") as shard_dir, \
+            ProcessPoolExecutor(workers, mp_context=worker_process_context()) as pool:
+        old_split = pool.submit(_split_zoe_file, old_path, shard_dir, "old", workers)
+        new_split = pool.submit(_split_zoe_file, new_path, shard_dir, "new", workers)
+        old_shards, _ = old_split.result()
+        new_shards, acct_hash_new = new_split.result()
+
+        print(f"Comparing New to Old in {workers} shards")
+        shard_changes = list(pool.map(_diff_zoe_shard, old_shards, new_shards, [deletes] * workers))
+        # additions and changes in new file order, then deletions in old file order
+        for _, _, action, record in heapq.merge(*shard_changes, key=lambda change: change[:2]):
+            delta_writer.write_record(record, action)
+    return acct_hash_new
 
 
 def clean_record_report(record: str) -> str:
@@ -231,111 +2003,610 @@ def get_file_stat_if_exists(file_path: str):
 
 
 def thread_sub(
-    connection_num: int,
-    script_data,
-    apwx: Apwx,
     thread_id: int,
-    max_threads: int,
-    zoe_data: list,
+    task_queue: queue.Queue,
+    extraction: ZoeExtraction,
+    durations: Dict[str, float],
 
 ):
-    """run by each thread to handle database connections and process zoe records specific to its thread id"""
-    time.sleep(connection_num)
+    """run by each worker thread to drain the shared task queue, recording how long every task took"""
     print(f"Started thread: {thread_id}")
 
-    p2p_args = {
-        "zoe": True,
-        "storeApwx": "zoe",
-        "getDnaDb": True,
-        "getP2pDb": True,
-        "maxThread": max_threads,
-        "threadId": thread_id,
-        "p2pServer": apwx.args.P2P_SERVER,
-        "p2pSchema": apwx.args.P2P_SCHEMA,
-        "storeDbh": "zoe",
-    }
+    with profiled(extraction.script_data.profiler, f"worker-{thread_id}"):
+        while True:
+            try:
+                task = task_queue.get_nowait()
+            except queue.Empty:
+                break
+            start = time.perf_counter()
+            stats = process_zoe_task(task, extraction)
+            finish_zoe_task(task, extraction, stats, time.perf_counter() - start, durations, thread_id)
 
-    p2p_db_connect = p2p_db_connect_func(p2p_args)
+    print(f"Finished thread: {thread_id}")
 
-    dna_db_connect = dna_db_connect_func(apwx)
 
-    process_zoe_records(dna_db_connect, p2p_db_connect, script_data, max_threads, thread_id, zoe_data)
+def finish_zoe_task(task: ZoeTask, extraction: ZoeExtraction, stats: Dict, secs: float,
+                    durations: Dict[str, float], worker_id: int):
+    """records a task's duration and outcome with the checkpoint and the run metrics"""
+    durations[task.name] = secs
+    failed = bool(stats.get("error"))
+    if failed:
+        extraction.failed_tasks.append(task.name)
+    rows = extraction.row_counts.get(task.name, 0)
+    if extraction.script_data.checkpoint:
+        extraction.script_data.checkpoint.finish(task, rows, failed)
+    if extraction.script_data.metrics:
+        steps = ("connect_secs", "execute_secs", "fetch_secs", "format_secs")
+        extraction.script_data.metrics.record_query(
+            task.name, key=task.key, partition=task.partition, thread=worker_id, secs=round(secs, 3), rows=rows,
+            bytes=stats.get("bytes", 0), **{step: round(stats.get(step, 0.0), 3) for step in steps},
+        )
 
-    if dna_db_connect:
-        dna_db_connect.close()
 
-    print(f"Finished thread: {thread_id}")
+def plan_query_partitions(script_data, dna_pool, max_threads: int) -> Dict[str, List[Dict]]:
+    """runs the 'partition_plan' histogram query of each configured query key and splits its driving
+    key range into partitions of roughly equal row counts"""
+    plan_sql = script_data.config.get("partition_plan") or {}
+    partition_plans = {}
+    for key, sql in plan_sql.items():
+        try:
+            with dna_pool.acquire() as dbh:
+                cur = dbh.cursor()
+                try:
+                    cur.execute(sql)
+                    histogram = [(row[0], int(row[1])) for row in cur.fetchall()]
+                finally:
+                    cur.close()
+        except Exception as e:
+            print(f"Error planning partitions for '{key}': {e}")
+            histogram = []
+        partition_plans[key] = plan_partitions_or_whole_range(key, histogram, max_threads)
+    return partition_plans
+
+
+def plan_partitions_or_whole_range(key: str, histogram: List[tuple], partitions: int) -> List[Dict]:
+    """plan_partitions for a key's histogram; without one, a single partition over the open range, since
+    the key's statement references :range_lo/:range_hi and has to have them bound"""
+    if histogram:
+        return plan_partitions(histogram, partitions)
+    print(f"No partition histogram for '{key}', extracting it as one partition")
+    return [{"range_lo": None, "range_hi": None, "expected_rows": None}]
+
+
+def plan_partitions(histogram: List[tuple], partitions: int) -> List[Dict]:
+    """cuts an ordered (bucket start, row count) histogram into at most 'partitions' contiguous ranges.
+    The first range has no lower bound and the last no upper bound, so rows outside the histogram
+    are still extracted."""
+    total = sum(count for _, count in histogram)
+    cuts = []
+    cumulative = 0
+    for pos, (_, count) in enumerate(histogram):
+        target = total * (len(cuts) + 1) / partitions
+        # cut before this bucket when most of it lies past the target
+        if pos > 0 and len(cuts) < partitions - 1 and cumulative + count / 2 > target:
+            cuts.append(pos)
+        cumulative += count
+
+    bounds = [0] + cuts + [len(histogram)]
+    plan = []
+    for part in range(len(bounds) - 1):
+        plan.append({
+            "range_lo": histogram[bounds[part]][0] if part > 0 else None,
+            "range_hi": histogram[bounds[part + 1]][0] if part < len(bounds) - 2 else None,
+            "expected_rows": sum(count for _, count in histogram[bounds[part]:bounds[part + 1]]),
+        })
+    return plan
+
+
+def print_partition_report(extraction: ZoeExtraction):
+    """expected rows from the partition plan against the rows actually fetched, per query key and partition"""
+    for key in QUERY_KEYS:
+        plan = extraction.partition_plans.get(key)
+        counts = sorted(
+            (int(name.rsplit(":", 1)[1]), rows) for name, rows in extraction.row_counts.items()
+            if name.rsplit(":", 1)[0] == key
+        )
+        for partition, rows in counts:
+            expected = plan[partition]["expected_rows"] if plan else None
+            print(f"[PLAN] {key} partition {partition}: expected {'-' if expected is None else expected} actual {rows}")
+
 
+def bind_values(sql: str, values: Dict) -> Dict:
+    """keeps only the binds the statement references, oracledb rejects unused named binds"""
+    return {name: value for name, value in values.items() if re.search(rf":{name}\b", sql)}
+
+
+def build_zoe_tasks(
+    max_threads: int, task_durations: Dict[str, float], partition_plans: Optional[Dict[str, List[Dict]]] = None
+) -> List[ZoeTask]:
+    """one task per (query key, partition) ordered longest expected duration first; tasks without
+    history are scheduled before all others since they may be the long ones"""
+    partition_plans = partition_plans or {}
+    tasks = []
+    for key in QUERY_KEYS:
+        # the shared P2P index already holds the p2p_cust_org rows, they are emitted once per run
+        if key == "p2p_cust_org":
+            partitions = [0]
+        elif key in partition_plans:
+            partitions = range(len(partition_plans[key]))
+        else:
+            partitions = range(max_threads)
+        for partition in partitions:
+            task = ZoeTask(key, partition)
+            task.expected_secs = task_durations.get(task.name)
+            tasks.append(task)
+
+    tasks.sort(key=lambda task: float("-inf") if task.expected_secs is None else -task.expected_secs)
+    return tasks
+
+
+def load_task_durations(file_path: Optional[str]) -> Dict[str, float]:
+    """per-task durations recorded by previous runs, keyed by 'query_key:partition'"""
+    if not file_path or not os.path.exists(file_path):
+        return {}
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            return {name: float(secs) for name, secs in json.load(f).items()}
+    except Exception as e:
+        print(f"Error reading task stats {file_path}: {e}")
+        return {}
+
+
+def save_task_durations(file_path: str, durations: Dict[str, float], previous: Dict[str, float]):
+    """stores this run's durations, smoothed with the previous run to damp one-off slow queries"""
+    merged = dict(previous)
+    for name, secs in durations.items():
+        merged[name] = round((secs + previous[name]) / 2 if name in previous else secs, 3)
+    try:
+        with open(file_path, "w", encoding="utf-8") as f:
+            json.dump(merged, f, indent=2, sort_keys=True)
+    except Exception as e:
+        print(f"Error writing task stats {file_path}: {e}")
+
+
+class P2PCustomerIndex:
+    """read-only P2P customer rows keyed by 'persnbr', loaded once per run and shared by every worker thread"""
+
+    def __init__(self, columns, rows: List[tuple]):
+        self.columns = tuple(columns)
+        self.rows = rows  # every row in query order, reused for the p2p_cust_org detail records
+        persnbr_pos = self.columns.index("persnbr")
+        self._by_persnbr = {row[persnbr_pos]: row for row in rows if row[persnbr_pos]}
+
+    def __contains__(self, persnbr) -> bool:
+        return persnbr in self._by_persnbr
+
+    def __getitem__(self, persnbr) -> Dict:
+        return dict(zip(self.columns, self._by_persnbr[persnbr]))
+
+    def __len__(self) -> int:
+        return len(self._by_persnbr)
+
+    def get(self, persnbr, default=None):
+        row = self._by_persnbr.get(persnbr)
+        return dict(zip(self.columns, row)) if row is not None else default
+
+
+def load_shared_p2p_customers(p2p_pool, script_data):
+    """loads the customer index shared by all worker threads over a pooled P2P connection"""
+    snapshot_path = script_data.apwx.args.P2P_SNAPSHOT_FILE
+    max_age_hours = float(script_data.apwx.args.P2P_SNAPSHOT_MAX_AGE_HOURS or 0) or None
+    with profiled(script_data.profiler, "p2p_load"):
+        try:
+            with p2p_pool.acquire() as p2p_dbh:
+                return load_p2p_customers(p2p_dbh, script_data, snapshot_path, max_age_hours)
+        except ConnectionError as e:
+            print(e)
+            return load_p2p_customers(None, script_data, snapshot_path, max_age_hours)
+
+
+def load_p2p_customers(p2p_dbh, script_data, snapshot_path: Optional[str] = None,
+                       max_age_hours: Optional[float] = None):
+    """streams every 'p2p_cust_org' row into a P2PCustomerIndex and reports its load time and memory.
+    With a snapshot path the rows are kept in a local SQLite snapshot that is refreshed incrementally."""
+    if snapshot_path:
+        start = time.perf_counter()
+        refresh_p2p_snapshot(p2p_dbh, script_data, snapshot_path, max_age_hours)
+        p2p_cust = P2PSnapshotIndex(snapshot_path)
+        if script_data.metrics:
+            script_data.metrics.record_phase(
+                "p2p_load", time.perf_counter() - start, records=len(p2p_cust), bytes=os.path.getsize(snapshot_path)
+            )
+        print(
+            f"Loaded {len(p2p_cust)} P2P customers from snapshot {snapshot_path} "
+            f"in {time.perf_counter() - start:.2f}s ({os.path.getsize(snapshot_path) / 1048576:.1f} MB on disk)"
+        )
+        return p2p_cust
+
+    columns = ["persnbr"]
+    rows = []
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    mem_before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
 
-def load_p2p_customers(p2p_dbh, script_data):
-    """Fetch and return a dictionary of P2P customer records key by 'persnbr'."""
-    p2p_cust = {}
     if p2p_dbh:
+        tuner = FetchTuner("p2p_cust_org")
         try:
-            p2p_records = execute_sql_select(p2p_dbh, script_data.config["p2p_cust_org"])
-            for record in p2p_records:
-                persnbr = record["persnbr"]
-                if persnbr:
-                    p2p_cust[persnbr] = record
+            with p2p_dbh.cursor() as cur:
+                tuner.configure(cur)
+                cur.execute(script_data.config["p2p_cust_org"])
+                columns = [desc[0] for desc in cur.description]
+                for records in tuner.fetch_batches(cur):
+                    rows.extend(tuple(record) for record in records)
         except Exception as e:
             print(f"Error fetching P2P customer data: {e}")
+        tuner.print_stats()
+
+    try:
+        p2p_cust = P2PCustomerIndex(columns, rows)
+    except ValueError as e:
+        print(f"Error indexing P2P customer data: {e}")
+        p2p_cust = P2PCustomerIndex(["persnbr"], [])
+
+    elapsed = time.perf_counter() - start
+    mem_used = tracemalloc.get_traced_memory()[0] - mem_before
+    if started_tracing:
+        tracemalloc.stop()
+    if script_data.metrics:
+        script_data.metrics.record_phase("p2p_load", elapsed, records=len(rows), bytes=mem_used)
+    print(
+        f"Loaded {len(p2p_cust)} P2P customers ({len(rows)} rows) "
+        f"in {elapsed:.2f}s using {mem_used / 1048576:.1f} MB"
+    )
     return p2p_cust
 
 
-def process_query_key(key, dbh, sql, p2p_cust, zoe_data, thread_id, render_values):
-    """Execute a query and process its result set."""
-    cur = dbh.cursor()
-    try:
-        if key == "p2p_cust_org":
-            cur.execute(sql)
-        else:
-            cur.execute(sql, render_values)
+class P2PSnapshotIndex:
+    """P2P customer index served from the local SQLite snapshot (memory-mapped reads, one connection per thread)"""
 
-        max_rows = 1000
-        while True:
-            records = cur.fetchmany(max_rows)
-            if not records:
-                break
-            for record in records:
-                record_list = list(record)
-                is_org = key in ["card_own_pers_org", "org"]
-                line = build_detail_record(record_list, p2p_cust, is_org)
-                if line:
-                    zoe_data.append(line)
+    def __init__(self, snapshot_path: str):
+        self.snapshot_path = snapshot_path
+        self._local = threading.local()
+        meta = dict(self._conn().execute("SELECT name, value FROM p2p_meta"))
+        self.columns = tuple(json.loads(meta["columns"]))
+        self._count = self._conn().execute("SELECT COUNT(*) FROM p2p_cust").fetchone()[0]
 
-        print(f"[THREAD {thread_id}] Processed records from '{key}'.")
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"{Path(self.snapshot_path).resolve().as_uri()}?mode=ro", uri=True)
+            conn.execute("PRAGMA mmap_size = 1073741824")
+            self._local.conn = conn
+        return conn
 
-    except Exception as e:
-        print(f"[THREAD {thread_id}] Error processing query '{key}': {e}")
+    def _row(self, persnbr) -> Optional[List]:
+        found = self._conn().execute("SELECT row FROM p2p_cust WHERE persnbr = ?", (persnbr,)).fetchone()
+        return json.loads(found[0]) if found else None
+
+    def __contains__(self, persnbr) -> bool:
+        return self._row(persnbr) is not None
+
+    def __getitem__(self, persnbr) -> Dict:
+        row = self._row(persnbr)
+        if row is None:
+            raise KeyError(persnbr)
+        return dict(zip(self.columns, row))
+
+    def __len__(self) -> int:
+        return self._count
+
+    def get(self, persnbr, default=None):
+        row = self._row(persnbr)
+        return dict(zip(self.columns, row)) if row is not None else default
+
+    def __getstate__(self) -> Dict:
+        return {"snapshot_path": self.snapshot_path}  # worker processes reopen the snapshot themselves
+
+    def __setstate__(self, state: Dict):
+        self.__init__(state["snapshot_path"])
+
+    @property
+    def rows(self):
+        """every snapshot row in the order it was first loaded"""
+        for (row,) in self._conn().execute("SELECT row FROM p2p_cust ORDER BY rowid"):
+            yield tuple(json.loads(row))
+
+
+def p2p_watermark_text(watermark) -> str:
+    """the P2P snapshot watermark as stored: ISO text for timestamps, JSON for numbers and strings"""
+    if isinstance(watermark, datetime):
+        return json.dumps({"datetime": watermark.isoformat()})
+    return json.dumps(watermark)
+
+
+def parse_p2p_watermark(text):
+    """the watermark p2p_watermark_text stored, None for anything else such as an older snapshot's pickle"""
+    if not isinstance(text, str):
+        return None
+    watermark = json.loads(text)
+    return datetime.fromisoformat(watermark["datetime"]) if isinstance(watermark, dict) else watermark
+
+
+def refresh_p2p_snapshot(p2p_dbh, script_data, snapshot_path: str, max_age_hours: Optional[float] = None):
+    """brings the SQLite P2P snapshot up to date, pulling only rows changed since the stored watermark when the
+    config has 'p2p_cust_org_changed' and 'p2p_watermark_column', otherwise reloading 'p2p_cust_org' in full.
+    Rows without a persnbr are not kept. Deleted P2P rows are only dropped by a full reload, which also happens
+    once the last one is more than max_age_hours old."""
+    config = script_data.config
+    conn = sqlite3.connect(snapshot_path)
+    try:
+        conn.execute("CREATE TABLE IF NOT EXISTS p2p_meta (name TEXT PRIMARY KEY, value)")
+        conn.execute("CREATE TABLE IF NOT EXISTS p2p_cust (persnbr PRIMARY KEY, row TEXT NOT NULL)")
+        meta = dict(conn.execute("SELECT name, value FROM p2p_meta"))
+        watermark = parse_p2p_watermark(meta.get("watermark"))
+        watermark_column = config.get("p2p_watermark_column")
+        incremental = watermark is not None and "columns" in meta and bool(config.get("p2p_cust_org_changed"))
+        full_loaded = datetime.fromisoformat(meta["full_loaded"]) if "full_loaded" in meta else None
+        if incremental and max_age_hours and (
+                full_loaded is None or datetime.now() - full_loaded > timedelta(hours=max_age_hours)):
+            print(f"P2P snapshot was last reloaded in full at {full_loaded}, reloading it in full")
+            incremental = False
+
+        if not p2p_dbh:
+            if "columns" not in meta:
+                raise RuntimeError(f"No P2P connection and no snapshot in {snapshot_path}")
+            print(f"No P2P connection, using P2P snapshot as of {watermark}")
+            return
+
+        loaded = 0
+        tuner = FetchTuner("p2p_cust_org")
+        with p2p_dbh.cursor() as cur:
+            tuner.configure(cur)
+            if incremental:
+                cur.execute(config["p2p_cust_org_changed"], watermark)
+            else:
+                cur.execute(config["p2p_cust_org"])
+                conn.execute("DELETE FROM p2p_cust")
+            columns = [desc[0] for desc in cur.description]
+            persnbr_pos = columns.index("persnbr")
+            watermark_pos = columns.index(watermark_column) if watermark_column in columns else None
+            new_watermark = watermark if incremental else None
+
+            for records in tuner.fetch_batches(cur):
+                batch = []
+                for record in records:
+                    if not record[persnbr_pos]:
+                        continue
+                    batch.append((record[persnbr_pos], json.dumps(list(record), default=str)))
+                    if watermark_pos is not None and record[watermark_pos] is not None:
+                        if new_watermark is None or record[watermark_pos] > new_watermark:
+                            new_watermark = record[watermark_pos]
+                conn.executemany(
+                    "INSERT INTO p2p_cust (persnbr, row) VALUES (?, ?) "
+                    "ON CONFLICT(persnbr) DO UPDATE SET row = excluded.row",
+                    batch,
+                )
+                loaded += len(batch)
+
+        conn.execute("INSERT OR REPLACE INTO p2p_meta VALUES ('columns', ?)", (json.dumps(columns),))
+        if new_watermark is not None:
+            conn.execute(
+                "INSERT OR REPLACE INTO p2p_meta VALUES ('watermark', ?)", (p2p_watermark_text(new_watermark),)
+            )
+        if not incremental:
+            conn.execute("INSERT OR REPLACE INTO p2p_meta VALUES ('full_loaded', ?)", (datetime.now().isoformat(),))
+        conn.commit()
+        tuner.print_stats()
+        print(f"Refreshed P2P snapshot ({'incremental' if incremental else 'full'}): {loaded} rows, watermark {new_watermark}")
     finally:
-        if cur:
-            cur.close()
+        conn.close()
 
 
-def process_zoe_records(dna_dbh, p2p_dbh, script_data, max_thread, thread_id, zoe_data):
-    """Main entry point to process ZOE records."""
-    p2p_cust = load_p2p_customers(p2p_dbh, script_data)
-    render_values = {"max_thread": max_thread, "thread_id": thread_id}
+_worker_p2p_cust = None
 
-    query_keys = [
-        "card_tax_rpt_for_pers",
-        "card_own_pers",
-        "no_card_tax_rpt_for_pers",
-        "no_card_own_pers",
-        "card_own_pers_org",
-        "org",
-        "p2p_cust_org",
-    ]
 
-    for key in query_keys:
-        dbh = p2p_dbh if key == "p2p_cust_org" else dna_dbh
+def _init_format_worker(p2p_cust):
+    """runs once in each formatter process to keep its own copy of the shared P2P index"""
+    global _worker_p2p_cust
+    _worker_p2p_cust = p2p_cust
 
-        if key == "org" or key == "p2p_cust_org":
-            sql = script_data.config[key]
-        else:
-            sql = script_data.config["sql_qq"] + "\n" + script_data.config[key]
 
-        process_query_key(key, dbh, sql, p2p_cust, zoe_data, thread_id, render_values)
+def _format_batch_in_worker(records: List[tuple], is_org: bool) -> List[str]:
+    return format_record_batch(records, _worker_p2p_cust, is_org)
+
+
+def worker_process_context():
+    """start method of the worker process pools: forkserver, or spawn where that is missing, but never a fork
+    of this process, whose fetch and writer threads may hold locks a forked child would inherit held"""
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    context = multiprocessing.get_context("forkserver")
+    # the server imports this module once, so each worker forked from it starts without importing it again
+    context.set_forkserver_preload([__name__])
+    return context
+
+
+class RecordFormatterPool:
+    """process pool that formats raw fetch batches, so the fetching threads do not compete for the GIL"""
+
+    def __init__(self, workers: int, p2p_cust):
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=worker_process_context(),
+            initializer=_init_format_worker, initargs=(p2p_cust,),
+        )
+        self.max_pending = workers * 2  # batches a fetching thread may have in flight
+
+    def submit(self, records: List[tuple], is_org: bool):
+        return self._executor.submit(_format_batch_in_worker, records, is_org)
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+
+def format_record_batch(records, p2p_cust, is_org: bool) -> List[str]:
+    """formats one fetch batch of database rows into detail record lines"""
+    if not records:
+        return []
+    # rows of one result set all have the same width, so one compiled formatter serves the batch
+    return compile_detail_formatter(len(records[0]), is_org)(records, p2p_cust)
+
+
+def process_query_key(
+    key, dbh, sql, p2p_cust, zoe_data, thread_id, render_values, formatter=None, tuner=None, stats=None
+) -> int:
+    """Execute a query and process its result set, returning the number of rows fetched.
+    The execute, fetch wait and format seconds and the fetched bytes are added to 'stats' when given."""
+    tuner = tuner or FetchTuner(key)
+    stats = stats if stats is not None else {}
+    cur = dbh.cursor()
+    pending = deque()
+    rows = 0
+    row_bytes = 0
+    execute_secs = fetch_secs = format_secs = 0.0
+    try:
+        tuner.configure(cur)
+        start = time.perf_counter()
+        cur.execute(sql, bind_values(sql, render_values))
+        execute_secs = time.perf_counter() - start
+
+        slot = (QUERY_KEYS.index(key), thread_id)
+        is_org = key in ["card_own_pers_org", "org"]
+        fetch_start = time.perf_counter()
+        for records in tuner.fetch_batches(cur):
+            rows += len(records)
+            row_bytes += estimate_row_bytes(records) * len(records)
+            start = time.perf_counter()
+            if formatter is None:
+                zoe_data.add_batch(slot, format_record_batch(records, p2p_cust, is_org))
+            else:
+                # results are taken in submission order, so the slot keeps its row order
+                pending.append(formatter.submit([tuple(record) for record in records], is_org))
+                if len(pending) > formatter.max_pending:
+                    zoe_data.add_batch(slot, pending.popleft().result())
+            format_secs += time.perf_counter() - start
+        fetch_secs = time.perf_counter() - fetch_start - format_secs
+        start = time.perf_counter()
+        while pending:
+            zoe_data.add_batch(slot, pending.popleft().result())
+        format_secs += time.perf_counter() - start
+
+        print(f"[THREAD {thread_id}] Processed {rows} records from '{key}'.")
+
+    except Exception as e:
+        print(f"[THREAD {thread_id}] Error processing query '{key}': {e}")
+        stats["error"] = str(e)
+    finally:
+        if cur:
+            cur.close()
+        stats.update(execute_secs=execute_secs, fetch_secs=fetch_secs, format_secs=format_secs, bytes=row_bytes)
+    return rows
+
+
+def process_query_key_columnar(
+    key, dbh, sql, p2p_columns, zoe_data, thread_id, render_values, tuner=None, stats=None
+) -> Optional[int]:
+    """Execute a query as Arrow batches and format them column-wise, returning the number of rows fetched,
+    or None before anything is written when the result set has columns only the row path formats exactly."""
+    tuner = tuner or FetchTuner(key)
+    stats = stats if stats is not None else {}
+    slot = (QUERY_KEYS.index(key), thread_id)
+    is_org = key in ["card_own_pers_org", "org"]
+    rows = 0
+    row_bytes = 0
+    fetch_secs = format_secs = 0.0
+    try:
+        size = tuner.arraysize
+        batches = dbh.fetch_df_batches(statement=sql, parameters=bind_values(sql, render_values), size=size)
+        while True:
+            start = time.perf_counter()
+            df = next(batches, None)
+            secs = time.perf_counter() - start
+            fetch_secs += secs
+            if df is None:
+                break
+            table = pa.table(df)
+            if rows == 0 and not arrow_columns_supported(table.schema):
+                print(f"[THREAD {thread_id}] '{key}' has columns the columnar path cannot format, using the row path.")
+                return None
+            tuner.observe_rows(table.num_rows, table.nbytes // max(table.num_rows, 1), size, secs)
+            rows += table.num_rows
+            row_bytes += table.nbytes
+            start = time.perf_counter()
+            zoe_data.add_batch(slot, format_arrow_batch(table, p2p_columns, is_org))
+            format_secs += time.perf_counter() - start
+
+        print(f"[THREAD {thread_id}] Processed {rows} records from '{key}'.")
+
+    except Exception as e:
+        print(f"[THREAD {thread_id}] Error processing query '{key}': {e}")
+        stats["error"] = str(e)
+    # oracledb runs the statement on the first batch, so its execute time is part of the fetch wait
+    stats.update(execute_secs=0.0, fetch_secs=fetch_secs, format_secs=format_secs, bytes=row_bytes)
+    return rows
+
+
+def process_zoe_task(task: ZoeTask, extraction: ZoeExtraction) -> Dict:
+    """Runs one query key for one partition with a pooled DNA connection, returning its step timings."""
+    if task.key == "p2p_cust_org":
+        start = time.perf_counter()
+        rows = process_p2p_cust_org(extraction.p2p_cust, extraction.zoe_data, task.partition)
+        extraction.row_counts[task.name] = rows
+        return {"format_secs": time.perf_counter() - start}
+
+    sql, render_values = build_task_query(task, extraction)
+    stats = {}
+    start = time.perf_counter()
+    try:
+        with extraction.dna_pool.acquire() as dna_dbh:
+            stats["connect_secs"] = time.perf_counter() - start
+            rows = None
+            if extraction.p2p_columns is not None and hasattr(dna_dbh, "fetch_df_batches"):
+                rows = process_query_key_columnar(
+                    task.key, dna_dbh, sql, extraction.p2p_columns, extraction.zoe_data,
+                    task.partition, render_values, extraction.fetch_tuners.get(task.key), stats,
+                )
+            if rows is None:
+                rows = process_query_key(
+                    task.key, dna_dbh, sql, extraction.detail_p2p, extraction.zoe_data, task.partition,
+                    render_values, extraction.formatter, extraction.fetch_tuners.get(task.key), stats,
+                )
+            extraction.row_counts[task.name] = rows
+            if stats.get("error"):
+                # the query swallowed its error, which may have been the connection dying mid-fetch
+                extraction.dna_pool.invalidate(dna_dbh)
+    except ConnectionError as e:
+        print(f"[THREAD {task.partition}] Error processing query '{task.key}': {e}")
+        stats["error"] = str(e)
+    return stats
+
+
+def build_task_query(task: ZoeTask, extraction: ZoeExtraction) -> tuple:
+    """the statement of a task's query key and the bind values selecting its partition"""
+    config = extraction.script_data.config
+    changed_only = extraction.watermark is not None
+    if task.key == "org":
+        sql = config.get("org_changed", config["org"]) if changed_only else config["org"]
+    else:
+        sql = config["sql_qq_changed" if changed_only else "sql_qq"] + "\n" + config[task.key]
+    render_values = {"max_thread": extraction.max_threads, "thread_id": task.partition}
+    if changed_only:
+        render_values["watermark"] = extraction.watermark
+    plan = extraction.partition_plans.get(task.key)
+    if plan:
+        render_values["max_thread"] = len(plan)
+        render_values["range_lo"] = plan[task.partition]["range_lo"]
+        render_values["range_hi"] = plan[task.partition]["range_hi"]
+    return sql, render_values
+
+
+def process_p2p_cust_org(p2p_cust, zoe_data, thread_id):
+    """builds the 'p2p_cust_org' detail records from the shared P2P index instead of querying it again"""
+    slot = (QUERY_KEYS.index("p2p_cust_org"), thread_id)
+    max_rows = 1000
+    records = []
+    count = 0  # the snapshot index streams its rows, so they are counted on the way
+    for record in p2p_cust.rows:
+        records.append(record)
+        count += 1
+        if len(records) >= max_rows:
+            zoe_data.add_batch(slot, format_record_batch(records, p2p_cust, False))
+            records = []
+    zoe_data.add_batch(slot, format_record_batch(records, p2p_cust, False))
+
+    print(f"[THREAD {thread_id}] Processed records from 'p2p_cust_org'.")
+    return count
 
 
 def build_detail_record(record_ary: List, p2p_cust: Dict, is_org: bool = False) -> str:
@@ -346,9 +2617,10 @@ def build_detail_record(record_ary: List, p2p_cust: Dict, is_org: bool = False)
 
     persnbr = record_ary[1] if len(record_ary) > 1 else None
     line_ary = record_ary[0:2]  # Initialize line with first two fields (e.g., account number and person number)
+    p2p_rec = None if is_org else p2p_cust.get(persnbr)  # one lookup per row, the index may be disk-backed
 
-    if not is_org and persnbr in p2p_cust and p2p_cust[persnbr].get("CXCCustomerID"):
-        line_ary.append(p2p_cust[persnbr]["CXCCustomerID"])
+    if p2p_rec is not None and p2p_rec.get("CXCCustomerID"):
+        line_ary.append(p2p_rec["CXCCustomerID"])
     else:
         line_ary.append(persnbr)
 
@@ -359,8 +2631,8 @@ def build_detail_record(record_ary: List, p2p_cust: Dict, is_org: bool = False)
         line_ary.extend([""] * (13 - len(line_ary)))
 
     # Add registered email and flag if available in p2p_cust, else fallback to field 13 and flag 0
-    if not is_org and persnbr in p2p_cust and p2p_cust[persnbr].get("registeredEmail"):
-        line_ary.append(p2p_cust[persnbr]["registeredEmail"])
+    if p2p_rec is not None and p2p_rec.get("registeredEmail"):
+        line_ary.append(p2p_rec["registeredEmail"])
         line_ary.append(1)
     else:
         line_ary.append(record_ary[13] if len(record_ary) > 13 else "")
@@ -383,8 +2655,8 @@ def build_detail_record(record_ary: List, p2p_cust: Dict, is_org: bool = False)
         line_ary.extend([""] * 6)
 
     # Add registered phone and flag if available in p2p_cust, else fallback to field 23 and flag 0
-    if not is_org and persnbr in p2p_cust and p2p_cust[persnbr].get("registeredPhone"):
-        line_ary.append(p2p_cust[persnbr]["registeredPhone"])
+    if p2p_rec is not None and p2p_rec.get("registeredPhone"):
+        line_ary.append(p2p_rec["registeredPhone"])
         line_ary.append(1)
     else:
         line_ary.append(record_ary[23] if len(record_ary) > 23 else "")
@@ -440,6 +2712,232 @@ def parse_id(id_record_str: str, is_org: bool = False) -> List[str]:
     return id_ary[:6]
 
 
+class LayoutField(NamedTuple):
+    """one section of the detail record layout, see DETAIL_LAYOUT"""
+    kind: str
+    start: int
+    stop: int = 0
+    pad_to: int = 0
+    column: str = ""
+    flagged: bool = False
+
+
+# Declarative form of build_detail_record. Kinds, for a result set 'width' columns wide:
+#   copy           fields start..stop-1
+#   p2p            the P2P 'column' when the person has a non-empty one, else field start ("" past the
+#                  row); flagged sections also emit 1/0 for whether the P2P value was used
+#   copy_or_pad    fields start..stop-1 when the row reaches stop, else blanks until the line has pad_to fields
+#   copy_or_blank  fields start..stop-1 when the row reaches stop, else stop-start blanks
+#   id             the six ID fields parsed from field start
+#   field          field start, or a blank past the row
+DETAIL_LAYOUT = (
+    LayoutField("copy", 0, 2),
+    LayoutField("p2p", 1, column="CXCCustomerID"),
+    LayoutField("copy_or_pad", 2, 13, pad_to=13),
+    LayoutField("p2p", 13, column="registeredEmail", flagged=True),
+    LayoutField("copy_or_blank", 14, 16),
+    LayoutField("id", 16),
+    LayoutField("copy_or_blank", 17, 23),
+    LayoutField("p2p", 23, column="registeredPhone", flagged=True),
+    LayoutField("copy_or_pad", 24, 48, pad_to=48),
+    LayoutField("field", 49),
+)
+
+_detail_formatters: Dict[tuple, Any] = {}
+
+
+def resolve_detail_layout(width: int, is_org: bool) -> List[tuple]:
+    """DETAIL_LAYOUT resolved for rows 'width' columns wide into the fields of a line, in order:
+    ("cell", i), ("blank",), ("zero",), ("p2p", column, fallback cell or None), ("flag", column), ("ids", cell)"""
+    fields = []
+    for section in DETAIL_LAYOUT:
+        if section.kind == "copy":
+            fields.extend(("cell", pos) for pos in range(section.start, section.stop))
+        elif section.kind == "p2p":
+            fallback = section.start if width > section.start else None
+            if is_org:
+                fields.append(("cell", fallback) if fallback is not None else ("blank",))
+                if section.flagged:
+                    fields.append(("zero",))
+            else:
+                fields.append(("p2p", section.column, fallback))
+                if section.flagged:
+                    fields.append(("flag", section.column))
+        elif section.kind in ("copy_or_pad", "copy_or_blank"):
+            if width >= section.stop:
+                fields.extend(("cell", pos) for pos in range(section.start, section.stop))
+            elif section.kind == "copy_or_pad":
+                line_fields = sum(6 if entry[0] == "ids" else 1 for entry in fields)
+                fields.extend([("blank",)] * max(section.pad_to - line_fields, 0))
+            else:
+                fields.extend([("blank",)] * (section.stop - section.start))
+        elif section.kind == "id":
+            if is_org or width <= section.start:
+                fields.extend([("blank",)] * 6)  # parse_id gives six blanks for organisations and no IDs
+            else:
+                fields.append(("ids", section.start))
+        elif section.kind == "field":
+            fields.append(("cell", section.start) if width > section.start else ("blank",))
+    return fields
+
+
+def compile_detail_formatter(width: int, is_org: bool):
+    """compiles DETAIL_LAYOUT for rows 'width' columns wide into a function formatting a whole batch
+    with a single P2P lookup per row; produces exactly what build_detail_record does. Each row's cells
+    are extended with a blank, a "0", every P2P value or its fallback with its flag, and the parsed IDs,
+    so one itemgetter precomputed from the layout picks the whole line."""
+    formatter = _detail_formatters.get((width, is_org))
+    if formatter is not None:
+        return formatter
+
+    fields = resolve_detail_layout(width, is_org)
+    p2p_fields = []  # (P2P column, fallback cell or None), in the order their cells are appended
+    id_cells = []  # the cell each group of six ID fields is parsed from
+    for entry in fields:
+        if entry[0] == "p2p":
+            p2p_fields.append((entry[1], entry[2]))
+        elif entry[0] == "ids":
+            id_cells.append(entry[1])
+    blank, zero = width, width + 1
+    p2p_pos = {column: width + 2 + 2 * n for n, (column, _) in enumerate(p2p_fields)}
+
+    picks = []  # position in the extended cells of every field of the line
+    id_pos = width + 2 + 2 * len(p2p_fields)
+    for entry in fields:
+        if entry[0] == "cell":
+            picks.append(entry[1])
+        elif entry[0] == "blank":
+            picks.append(blank)
+        elif entry[0] == "zero":
+            picks.append(zero)
+        elif entry[0] == "p2p":
+            picks.append(p2p_pos[entry[1]])
+        elif entry[0] == "flag":
+            picks.append(p2p_pos[entry[1]] + 1)
+        elif entry[0] == "ids":
+            picks.extend(range(id_pos, id_pos + 6))
+            id_pos += 6
+    pick_line = itemgetter(*picks)  # the layout always gives a line of many fields
+
+    def format_batch(records, p2p_cust):
+        lines = []
+        if width < 2:
+            return lines
+        for record in records:
+            cells = ["" if val is None else str(val) for val in record]
+            cells += ("", "0")
+            if p2p_fields:
+                p2p_rec = p2p_cust.get(record[1])
+                for column, fallback in p2p_fields:
+                    value = p2p_rec.get(column) if p2p_rec is not None else None
+                    if value:
+                        cells += (str(value), "1")
+                    else:
+                        cells += (cells[fallback] if fallback is not None else "", "0")
+            for pos in id_cells:
+                cells += parse_id(record[pos])
+            lines.append("|".join(pick_line(cells)))
+        return lines
+
+    return _detail_formatters.setdefault((width, is_org), format_batch)
+
+
+def arrow_columns_supported(schema) -> bool:
+    """whether every column of a result set converts to text column-wise exactly as str() does per value"""
+    for column in schema:
+        kind = column.type
+        if pa.types.is_timestamp(kind) and kind.unit == "ns":
+            return False  # to_pylist would not give datetime objects
+        if not (pa.types.is_string(kind) or pa.types.is_large_string(kind) or pa.types.is_integer(kind)
+                or pa.types.is_null(kind) or pa.types.is_timestamp(kind) or pa.types.is_date(kind)):
+            return False  # floats, decimals and booleans print differently from Python
+    return True
+
+
+def arrow_column_as_text(column):
+    """one Arrow column as strings with nulls as empty strings, the column-wise '"" if val is None else str(val)'"""
+    kind = column.type
+    if pa.types.is_timestamp(kind) or pa.types.is_date(kind):
+        return pa.array(["" if val is None else str(val) for val in column.to_pylist()], pa.string())
+    if pa.types.is_null(kind):
+        return pa.array([""] * len(column), pa.string())
+    return pc.fill_null(column.cast(pa.string()), "")
+
+
+def build_p2p_columns(p2p_cust) -> Optional[Dict[str, Any]]:
+    """the P2P index as Arrow arrays for the columnar path: each distinct persnbr with the text of every P2P
+    column the layout overrides, null where the person has no non-empty value"""
+    persnbr_pos = list(p2p_cust.columns).index("persnbr")
+    persnbrs = list(dict.fromkeys(row[persnbr_pos] for row in p2p_cust.rows if row[persnbr_pos]))
+    columns = {section.column for section in DETAIL_LAYOUT if section.kind == "p2p"}
+    values = {column: [] for column in columns}
+    for persnbr in persnbrs:
+        p2p_rec = p2p_cust.get(persnbr) or {}
+        for column in columns:
+            value = p2p_rec.get(column)
+            values[column].append(str(value) if value else None)
+    try:
+        p2p_columns = {"persnbr": pa.array(persnbrs)}
+    except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+        print(f"P2P persnbr values do not form one Arrow type ({e}), using the row fetch path")
+        return None
+    p2p_columns.update((column, pa.array(texts, pa.string())) for column, texts in values.items())
+    return p2p_columns
+
+
+def _p2p_positions(persnbr, p2p_keys):
+    """position of each row's persnbr in the P2P key array, null where the person has no P2P record"""
+    kind = persnbr.type
+    if pa.types.is_integer(kind) and pa.types.is_integer(p2p_keys.type):
+        persnbr, p2p_keys = persnbr.cast(pa.int64()), p2p_keys.cast(pa.int64())
+    elif (pa.types.is_string(kind) or pa.types.is_large_string(kind)) and (
+            pa.types.is_string(p2p_keys.type) or pa.types.is_large_string(p2p_keys.type)):
+        p2p_keys = p2p_keys.cast(kind)
+    else:
+        return pa.nulls(len(persnbr), pa.int32())  # an int never equals a str, as with dict lookups
+    return pc.index_in(persnbr, value_set=p2p_keys)
+
+
+def format_arrow_batch(table, p2p_columns: Dict[str, Any], is_org: bool) -> List[str]:
+    """formats one Arrow batch into detail record lines column by column; produces exactly what
+    format_record_batch does for the same rows"""
+    width = table.num_columns
+    if width < 2 or table.num_rows == 0:
+        return []
+
+    texts = {}
+
+    def cell(pos):
+        if pos not in texts:
+            texts[pos] = arrow_column_as_text(table.column(pos))
+        return texts[pos]
+
+    blank = pa.scalar("", pa.string())
+    overrides = {}
+    positions = None
+    parts = []
+    for entry in resolve_detail_layout(width, is_org):
+        if entry[0] == "cell":
+            parts.append(cell(entry[1]))
+        elif entry[0] == "blank":
+            parts.append(blank)
+        elif entry[0] == "zero":
+            parts.append(pa.scalar("0", pa.string()))
+        elif entry[0] == "p2p":
+            if positions is None:
+                positions = _p2p_positions(table.column(1), p2p_columns["persnbr"])
+            override = overrides[entry[1]] = pc.take(p2p_columns[entry[1]], positions)
+            fallback = cell(entry[2]) if entry[2] is not None else blank
+            parts.append(pc.if_else(pc.is_valid(override), override, fallback))
+        elif entry[0] == "flag":
+            parts.append(pc.if_else(pc.is_valid(overrides[entry[1]]), "1", "0"))
+        elif entry[0] == "ids":
+            ids = [parse_id(val) for val in table.column(entry[1]).to_pylist()]
+            parts.extend(pa.array(column, pa.string()) for column in zip(*ids))
+
+    return pc.binary_join_element_wise(*parts, "|").to_pylist()
+
+
 def build_header_record(args: Dict) -> str:
     """header record string based on file type and test flag"""
     header_rec_ary = []
@@ -525,32 +3023,90 @@ def build_trailer_record(args: Dict, file_stat=None) -> str:
     return "|".join(str(val) for val in trailer_ary)
 
 
+def strip_zoe_line(raw: bytes) -> bytes:
+    """one ZOE file line without surrounding whitespace; lines with non-ASCII bytes at either end are stripped
+    as text, the way str.strip() also removes Unicode spaces"""
+    line = raw.strip()
+    if line and (line[0] > 127 or line[-1] > 127):
+        try:
+            line = line.decode("utf-8").strip().encode("utf-8")
+        except UnicodeDecodeError:
+            line = line.decode("latin-1").strip().encode("latin-1")
+    return line
+
+
+def parse_zoe_record(line: bytes) -> Optional[tuple]:
+    """(key, record data, account hash part) of one stripped ZOE file line, key and record data still as bytes;
+    None for lines that carry no record"""
+    if not line or line.startswith((b"CDE", b"9|")):
+        return None  # CDE and trailer lines
+    fields = line.split(b"|", 5)
+    if len(fields) < 6:
+        return None
+    record_data = fields[5]
+    record_fields = record_data.split(b"|", 2)
+    if len(record_fields) < 2:
+        return None  # the header has too few fields
+    key = record_fields[1]
+    return key, record_data, int(key) if key.isdigit() else 0
+
+
+def decode_zoe_field(data: bytes) -> str:
+    """utf-8, falling back to latin-1 for this value alone"""
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return data.decode("latin-1")
+
+
+class ZoeFileReader:
+    """reads a ZOE file through mmap, yielding (key, record data, account hash part) with key and record data
+    as bytes for every record line; CDE, header and trailer lines are skipped without being decoded"""
+
+    RELEASE_BYTES = 64 * 1048576  # read pages are dropped from the mapping in steps of this size
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+
+    def __iter__(self):
+        try:
+            f = open(self.file_path, "rb")
+        except FileNotFoundError:
+            print(f"File not found: {self.file_path}")
+            return
+        with f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return  # an empty file cannot be mapped
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                can_release = hasattr(mmap, "MADV_DONTNEED")
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    view.madvise(mmap.MADV_SEQUENTIAL)
+                released = 0
+                for raw in iter(view.readline, b""):
+                    parsed = parse_zoe_record(strip_zoe_line(raw))
+                    if parsed is not None:
+                        yield parsed
+                    if can_release and view.tell() - released >= self.RELEASE_BYTES:
+                        # pages already read stay in the page cache but no longer count against this process
+                        view.madvise(mmap.MADV_DONTNEED, released, self.RELEASE_BYTES)
+                        released += self.RELEASE_BYTES
+
+
+def iter_zoe_records(file_path: str):
+    """yields (key, record data, account hash part) for the records of a ZOE file, decoded line by line"""
+    for key, record_data, acct in ZoeFileReader(file_path):
+        yield decode_zoe_field(key), decode_zoe_field(record_data), acct
+
+
 def get_zoe_file_hash(file_path: str) -> tuple:
     """Get hash of ZOE file records"""
     hash_zoe = {}
     acct_hash = 0
 
     try:
-        try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                lines = f.readlines()
-        except UnicodeDecodeError:
-            with open(file_path, "r", encoding="latin-1") as f:
-                lines = f.readlines()
-
-        for line in lines:
-            line = line.strip()
-            if line and not line.startswith("CDE") and "|" in line:
-                parts = line.split("|")
-                if len(parts) > 6:
-                    key = parts[6] if len(parts) > 6 else line
-                    record_data = "|".join(parts[5:]) if len(parts) > 5 else line
-                    hash_zoe[key] = record_data
-
-                    if len(parts) > 6 and parts[6].isdigit():
-                        acct_hash += int(parts[6])
-    except FileNotFoundError:
-        print(f"File not found: {file_path}")
+        for key, record_data, acct in iter_zoe_records(file_path):
+            hash_zoe[key] = record_data
+            acct_hash += acct
     except Exception as e:
         print(f"Error reading file {file_path}: {e}")
 
@@ -589,13 +3145,209 @@ def dna_db_connect_func(apwx: Apwx):
         return None
 
 
+class ConnectionPool:
+    """thread-safe pool of reusable connections with parallel warm-up, retry with backoff and connect metrics"""
+
+    def __init__(self, name: str, connect, size: int, retries: int = 4, backoff: float = 0.5):
+        self.name = name
+        self.size = size
+        self.retries = retries
+        self.backoff = backoff
+        self._connect = connect
+        self._idle = queue.LifoQueue()  # hand out the most recently used, still-warm connection first
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._broken = set()
+        self.connect_times: List[float] = []
+        self.failures = 0
+
+    def _open(self):
+        """connects with exponential backoff instead of fixed sleeps; returns None once all retries fail"""
+        delay = self.backoff
+        for attempt in range(1, self.retries + 1):
+            start = time.perf_counter()
+            dbh = self._connect()
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                if dbh:
+                    self.connect_times.append(elapsed)
+                    return dbh
+                self.failures += 1
+            if attempt < self.retries:
+                time.sleep(delay)
+                delay *= 2
+        return None
+
+    def _reserve(self) -> bool:
+        with self._lock:
+            if self._opened >= self.size:
+                return False
+            self._opened += 1
+            return True
+
+    def _open_reserved(self):
+        dbh = self._open()
+        if dbh is None:
+            with self._lock:
+                self._opened -= 1
+        return dbh
+
+    def _add_idle(self):
+        if self._reserve():
+            dbh = self._open_reserved()
+            if dbh is not None:
+                self._idle.put(dbh)
+
+    def warm_up(self) -> int:
+        """opens every connection of the pool in parallel and returns how many are ready"""
+        threads = [threading.Thread(target=self._add_idle) for _ in range(self.size)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self._idle.qsize()
+
+    def invalidate(self, dbh):
+        """marks a lent connection as unusable, for callers that handle its error themselves"""
+        with self._lock:
+            self._broken.add(id(dbh))
+
+    @contextmanager
+    def acquire(self):
+        """lends a connection for one unit of work; a connection that raised or was invalidated is discarded
+        instead of reused"""
+        try:
+            dbh = self._idle.get_nowait()
+        except queue.Empty:
+            dbh = self._open_reserved() if self._reserve() else self._idle.get()
+        if dbh is None:
+            raise ConnectionError(f"Unable to connect to {self.name} DB after {self.retries} attempts")
+
+        try:
+            yield dbh
+        except BaseException:
+            self._discard(dbh)
+            raise
+        with self._lock:
+            broken = id(dbh) in self._broken
+            self._broken.discard(id(dbh))
+        if broken:
+            self._discard(dbh)
+        else:
+            self._idle.put(dbh)
+
+    def _discard(self, dbh):
+        with self._lock:
+            self._opened -= 1
+        self._close(dbh)
+
+    def _close(self, dbh):
+        try:
+            dbh.close()
+        except Exception as e:
+            print(f"Error closing {self.name} connection: {e}")
+
+    def close(self):
+        while True:
+            try:
+                dbh = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(dbh)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            times = list(self.connect_times)
+        return {
+            "pool": self.name,
+            "connections": len(times),
+            "failures": self.failures,
+            "connect_min_ms": round(min(times) * 1000, 1) if times else None,
+            "connect_avg_ms": round(sum(times) / len(times) * 1000, 1) if times else None,
+            "connect_max_ms": round(max(times) * 1000, 1) if times else None,
+        }
+
+    def print_stats(self):
+        stats = self.stats()
+        print(
+            f"[{stats['pool']} POOL] connections: {stats['connections']} failures: {stats['failures']} "
+            f"connect ms min/avg/max: {stats['connect_min_ms']}/{stats['connect_avg_ms']}/{stats['connect_max_ms']}"
+        )
+
+
+class OracleSessionPool(ConnectionPool):
+    """ConnectionPool that leases its sessions from an oracledb session pool"""
+
+    def __init__(self, user: str, password: str, dsn: str, size: int):
+        self._session_pool = oracledb.create_pool(
+            user=user, password=password, dsn=dsn, min=size, max=size, increment=0,
+            getmode=oracledb.POOL_GETMODE_TIMEDWAIT, wait_timeout=60000,
+        )
+        super().__init__("DNA", self._acquire_session, size)
+
+    def _acquire_session(self):
+        try:
+            return self._session_pool.acquire()
+        except Exception as e:
+            print(f"Failed to connect to DNA DB: {e}")
+            return None
+
+    def _close(self, dbh):
+        try:
+            self._session_pool.drop(dbh)  # only discarded connections get here, so never hand them back
+        except Exception as e:
+            print(f"Error dropping DNA session: {e}")
+
+    def close(self):
+        super().close()
+        self._session_pool.close(force=True)
+
+
+def create_dna_pool(apwx: Apwx, size: int) -> ConnectionPool:
+    """DNA connections come from an oracledb session pool when the Apwx credentials are available,
+    otherwise from pooled apwx.db_connect connections"""
+    user = getattr(apwx.args, "OSIUPDATE", None)
+    password = getattr(apwx.args, "OSIUPDATE_PW", None)
+    if user and password:
+        return OracleSessionPool(user, password, apwx.args.TNS_SERVICE_NAME, size)
+    return ConnectionPool("DNA", lambda: dna_db_connect_func(apwx), size)
+
+
+def create_dna_pool_async(apwx: Apwx, size: int):
+    """oracledb async session pool for ENGINE=ASYNC, or None without the Apwx credentials it connects with"""
+    user = getattr(apwx.args, "OSIUPDATE", None)
+    password = getattr(apwx.args, "OSIUPDATE_PW", None)
+    if not (user and password):
+        return None
+    return oracledb.create_pool_async(
+        user=user, password=password, dsn=apwx.args.TNS_SERVICE_NAME, min=size, max=size, increment=0,
+    )
+
+
+def create_p2p_pool(apwx: Apwx, max_threads: int, size: int = 1) -> ConnectionPool:
+    """small pyodbc pool for the P2P SQL Server database"""
+    p2p_args = {
+        "zoe": True,
+        "storeApwx": "zoe",
+        "getDnaDb": True,
+        "getP2pDb": True,
+        "maxThread": max_threads,
+        "p2pServer": apwx.args.P2P_SERVER,
+        "p2pSchema": apwx.args.P2P_SCHEMA,
+        "storeDbh": "zoe",
+    }
+    return ConnectionPool("P2P", lambda: p2p_db_connect_func(p2p_args), size)
+
+
 def execute_sql_select(conn, sql: str) -> List[Dict]:
     """runs the query and returns results as a list of dist"""
     try:
         with conn.cursor() as cur:
+            tuner = FetchTuner("select")
+            tuner.configure(cur)
             cur.execute(sql)
             cols = [desc[0] for desc in cur.description]
-            return [dict(zip(cols, row)) for row in cur.fetchmany()]
+            return [dict(zip(cols, row)) for records in tuner.fetch_batches(cur) for row in records]
     except Exception as e:
         print(f"SQL execution error: {e}")
         return []
@@ -625,10 +3377,9 @@ def build_cde_record() -> str:
 
 
 def initialize(apwx: Apwx) -> ScriptData:
-    """initialize database connection"""
-    dbh = apwx.db_connect(autocommit=False)
+    """loads the config; DNA connections come from the pool built for NEW mode"""
     config = get_config(apwx)
-    return ScriptData(apwx=apwx, dbh=dbh, config=config)
+    return ScriptData(apwx=apwx, dbh=None, config=config)
 
 
 def get_config(apwx: Apwx) -> Any:
@@ -664,6 +3415,42 @@ def parse_args(apwx: Apwx) -> Apwx:
 
     parser.add_arg(AppWorxEnum.OLD_ZOE_FILE, type=str, required=False)
     parser.add_arg(AppWorxEnum.NEW_ZOE_FILE, type=str, required=False)
+    parser.add_arg(
+        AppWorxEnum.STREAM_YN, choices=["Y", "N"], default="N", required=False
+    )
+    parser.add_arg(AppWorxEnum.P2P_SNAPSHOT_FILE, type=str, required=False)
+    parser.add_arg(AppWorxEnum.FORMAT_WORKERS, type=str, default="0", required=False)
+    parser.add_arg(AppWorxEnum.TASK_STATS_FILE, type=str, required=False)
+    parser.add_arg(AppWorxEnum.FETCH_MEMORY_MB, type=str, default="64", required=False)
+    parser.add_arg(
+        AppWorxEnum.COLUMNAR_YN, choices=["Y", "N"], default="N", required=False
+    )
+    parser.add_arg(
+        AppWorxEnum.DELTA_ENGINE, choices=["HASH", "SORT", "DIGEST"], default="HASH", required=False
+    )
+    parser.add_arg(AppWorxEnum.DELTA_MEMORY_MB, type=str, default="512", required=False)
+    parser.add_arg(
+        AppWorxEnum.DELTA_DELETES_YN, choices=["Y", "N"], default="N", required=False
+    )
+    parser.add_arg(
+        AppWorxEnum.SIDECAR_YN, choices=["Y", "N"], default="N", required=False
+    )
+    parser.add_arg(AppWorxEnum.DELTA_WORKERS, type=str, default="1", required=False)
+    parser.add_arg(
+        AppWorxEnum.INCREMENTAL_YN, choices=["Y", "N"], default="N", required=False
+    )
+    parser.add_arg(AppWorxEnum.WATERMARK_FILE, type=str, required=False)
+    parser.add_arg(AppWorxEnum.DELTA_OUTPUT_FILE_NAME, type=str, required=False)
+    parser.add_arg(AppWorxEnum.METRICS_FILE, type=str, required=False)
+    parser.add_arg(AppWorxEnum.CHECKPOINT_DIR, type=str, required=False)
+    parser.add_arg(
+        AppWorxEnum.RESUME_YN, choices=["Y", "N"], default="N", required=False
+    )
+    parser.add_arg(
+        AppWorxEnum.ENGINE, choices=["THREAD", "ASYNC"], default="THREAD", required=False
+    )
+    parser.add_arg(AppWorxEnum.OUTPUT_SHARDS, type=str, default="1", required=False)
+    parser.add_arg(AppWorxEnum.P2P_SNAPSHOT_MAX_AGE_HOURS, type=str, default="24", required=False)
 
     apwx.parse_args()
     return apwx
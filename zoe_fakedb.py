@@ -0,0 +1,330 @@
+import argparse
+import asyncio
+import os
+import re
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+from itertools import islice
+from types import SimpleNamespace
+from typing import Dict, Iterator, List, Optional, Set
+
+import zoe
+from zoe import QUERY_KEYS, AppWorxEnum, ScriptData, run_reported
+from zoe_synth import ROW_WIDTH, SCALES, synth_dna_rows, synth_p2p_customers
+
+MARKER = re.compile(r"-- zoe_fakedb (\w+)")
+BIND = re.compile(r":(\w+)")
+ARG_DEFAULTS = {
+    "TEST_YN": "Y",
+    "DEBUG_YN": "N",
+    "MODE": "NEW",
+    "FORMAT_WORKERS": "0",
+    "FETCH_MEMORY_MB": "64",
+    "DELTA_ENGINE": "HASH",
+    "DELTA_MEMORY_MB": "512",
+    "DELTA_WORKERS": "1",
+    "P2P_SNAPSHOT_MAX_AGE_HOURS": "24",
+}
+
+
+@dataclass
+class FakeDbProfile:
+    """what the stand-in databases serve and how slowly"""
+    rows: int = 10000  # DNA rows per query key
+    seed: int = 0
+    p2p_seed: Optional[int] = None  # seeds the P2P customers instead of 'seed' when set
+    change_rate: float = 0.0  # share of rows the changed-since-watermark queries return
+    pad_bytes: int = 0  # extra characters in the last column of every DNA row
+    connect_secs: float = 0.0
+    execute_secs: float = 0.0
+    key_execute_secs: Dict[str, float] = field(default_factory=dict)  # execute_secs per query key, e.g. a slow one
+    fetch_secs: float = 0.0  # per fetchmany round-trip
+    row_secs: float = 0.0  # per row fetched
+    failures: Set[str] = field(default_factory=set)  # 'query_key:partition' slices whose fetch drops mid-way
+    deleted: Set[int] = field(default_factory=set)  # persnbrs no DNA query returns, reported by sql_qq_deleted
+    db_time: Optional[datetime] = None  # what the database clock reads, the local time when unset
+    executed: List[str] = field(default_factory=list)  # 'query_key:partition' of every statement run
+    connections: int = 0  # connections opened
+    closed: int = 0  # connections closed
+
+
+def fake_config() -> Dict[str, str]:
+    """a config whose statements name the query key they stand for and reference the binds NEW mode sends"""
+    config = {key: f"where mod(n, :max_thread) = :thread_id -- zoe_fakedb {key}" for key in QUERY_KEYS}
+    config["p2p_cust_org"] = "-- zoe_fakedb p2p_cust_org"
+    config["sql_qq"] = "-- zoe_fakedb sql_qq"
+    config["sql_qq_changed"] = "where changed > :watermark -- zoe_fakedb changed"
+    config["org_changed"] = config["org"] + "\nand changed > :watermark -- zoe_fakedb changed"
+    config["sql_qq_deleted"] = "select persnbr where deleted > :watermark -- zoe_fakedb deleted"
+    config["sql_db_time"] = "select systimestamp -- zoe_fakedb db_time"
+    return config
+
+
+class FakeCursor:
+    """DB-API cursor over generated rows; sleeps stand in for the network and database time"""
+
+    def __init__(self, profile: FakeDbProfile, connection: Optional["FakeConnection"] = None):
+        self.profile = profile
+        self.connection = connection
+        self.arraysize = 100
+        self.prefetchrows = 2
+        self.description = None
+        self._rows: Iterator[tuple] = iter(())
+
+    def execute(self, sql: str, binds: Optional[Dict] = None):
+        time.sleep(self._serve(sql, binds or {}))
+
+    def _serve(self, sql: str, binds: Dict) -> float:
+        """points the cursor at the rows the statement selects and returns how long executing it takes"""
+        if self.connection is not None and self.connection.dropped:
+            raise ConnectionResetError("zoe_fakedb connection was dropped")
+        unbound = [name for name in BIND.findall(sql) if name not in binds]
+        if unbound:
+            raise ValueError(f"ORA-01008: not all variables bound: {', '.join(unbound)}")
+        markers = MARKER.findall(sql)
+        if markers == ["db_time"]:
+            self.description = [("systimestamp",)]
+            self._rows = iter([(self.profile.db_time or datetime.now(),)])
+            return self.profile.execute_secs
+        if markers == ["deleted"]:
+            self.description = [("persnbr",)]
+            self._rows = iter([(persnbr,) for persnbr in sorted(self.profile.deleted)])
+            return self.profile.execute_secs
+        key = next((marker for marker in reversed(markers) if marker in QUERY_KEYS), None)
+        if key is None:
+            raise ValueError(f"zoe_fakedb cannot serve statement: {sql!r}")
+
+        if key == "p2p_cust_org":
+            p2p_seed = self.profile.seed if self.profile.p2p_seed is None else self.profile.p2p_seed
+            p2p_cust = synth_p2p_customers(self.profile.rows * (len(QUERY_KEYS) - 1), p2p_seed)
+            columns = list(p2p_cust.columns) + [f"c{pos}" for pos in range(len(p2p_cust.columns), ROW_WIDTH)]
+            pad = (None,) * (ROW_WIDTH - len(p2p_cust.columns))
+            self.description = [(column,) for column in columns]
+            self._rows = (row + pad for row in p2p_cust.rows)
+            return self.profile.key_execute_secs.get(key, self.profile.execute_secs)
+
+        self.description = [(f"c{pos}",) for pos in range(ROW_WIDTH)]
+        start = QUERY_KEYS.index(key) * self.profile.rows
+        max_thread = binds.get("max_thread", 1)
+        thread_id = binds.get("thread_id", 0)
+        if "changed" in markers:
+            rows = self._changed_rows(start, max_thread, thread_id)
+        else:
+            rows = synth_dna_rows(
+                self.profile.rows, self.profile.seed + start, self.profile.change_rate, start, max_thread, thread_id
+            )
+        self.profile.executed.append(f"{key}:{thread_id}")
+        self._rows = (self._padded(row) for row in rows if row[1] not in self.profile.deleted)
+        if f"{key}:{thread_id}" in self.profile.failures:
+            self._rows = self._dropped(self._rows)
+        return self.profile.key_execute_secs.get(key, self.profile.execute_secs)
+
+    def _dropped(self, rows: Iterator[tuple]) -> Iterator[tuple]:
+        """serves half of the slice, then fails like a dropped connection, which stays unusable"""
+        rows = list(rows)
+        yield from rows[:len(rows) // 2]
+        if self.connection is not None:
+            self.connection.dropped = True
+        raise ConnectionResetError("zoe_fakedb dropped the connection")
+
+    def _changed_rows(self, start: int, max_thread: int, thread_id: int) -> Iterator[tuple]:
+        """the rows of the slice that differ between the unchanged and the changed data set"""
+        seed = self.profile.seed + start
+        before = synth_dna_rows(self.profile.rows, seed, 0.0, start, max_thread, thread_id)
+        after = synth_dna_rows(self.profile.rows, seed, self.profile.change_rate, start, max_thread, thread_id)
+        return (new for old, new in zip(before, after) if old != new)
+
+    def _padded(self, row: tuple) -> tuple:
+        if not self.profile.pad_bytes:
+            return row
+        return row[:-1] + (f"{row[-1] or ''}{'X' * self.profile.pad_bytes}",)
+
+    def _fetch_secs(self, records: list) -> float:
+        return self.profile.fetch_secs + self.profile.row_secs * len(records)
+
+    def fetchone(self) -> Optional[tuple]:
+        records = self.fetchmany(1)
+        return records[0] if records else None
+
+    def fetchmany(self, size: Optional[int] = None) -> list:
+        records = list(islice(self._rows, size or self.arraysize))
+        time.sleep(self._fetch_secs(records))
+        return records
+
+    def fetchall(self) -> list:
+        records = list(self._rows)
+        time.sleep(self._fetch_secs(records))
+        return records
+
+    def close(self):
+        self._rows = iter(())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FakeAsyncCursor(FakeCursor):
+    """the oracledb AsyncCursor counterpart, waiting on the event loop instead of blocking the thread"""
+
+    async def execute(self, sql: str, binds: Optional[Dict] = None):
+        await asyncio.sleep(self._serve(sql, binds or {}))
+
+    async def fetchmany(self, size: Optional[int] = None) -> list:
+        records = list(islice(self._rows, size or self.arraysize))
+        await asyncio.sleep(self._fetch_secs(records))
+        return records
+
+    async def fetchall(self) -> list:
+        records = list(self._rows)
+        await asyncio.sleep(self._fetch_secs(records))
+        return records
+
+
+class FakeConnection:
+    """stands in for both the oracledb DNA and the pyodbc P2P connection"""
+
+    def __init__(self, profile: FakeDbProfile):
+        self.profile = profile
+        self.dropped = False
+        profile.connections += 1
+
+    def cursor(self) -> FakeCursor:
+        return FakeCursor(self.profile, self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.profile.closed += 1
+
+
+class FakeAsyncConnection(FakeConnection):
+    def cursor(self) -> FakeAsyncCursor:
+        return FakeAsyncCursor(self.profile, self)
+
+
+class FakeAsyncPool:
+    """the oracledb AsyncConnectionPool counterpart for ENGINE=ASYNC, lending at most 'size' connections;
+    like it, a released connection goes back to the pool as it is and only drop() closes it"""
+
+    def __init__(self, profile: FakeDbProfile, size: int):
+        self.profile = profile
+        self._slots = asyncio.Semaphore(size)
+        self._idle = []
+
+    async def acquire(self) -> FakeAsyncConnection:
+        await self._slots.acquire()
+        if self._idle:
+            return self._idle.pop()
+        await asyncio.sleep(self.profile.connect_secs)
+        return FakeAsyncConnection(self.profile)
+
+    async def release(self, dbh: FakeAsyncConnection):
+        self._idle.append(dbh)
+        self._slots.release()
+
+    async def drop(self, dbh: FakeAsyncConnection):
+        dbh.close()
+        self._slots.release()
+
+    async def close(self):
+        self._idle = []
+
+
+def connect(profile: FakeDbProfile) -> FakeConnection:
+    time.sleep(profile.connect_secs)
+    return FakeConnection(profile)
+
+
+def fake_apwx(output_file: str, profile: FakeDbProfile, **args):
+    """Apwx stand-in whose db_connect opens FakeConnections; every argument defaults as parse_args does"""
+    values = {member.name: None for member in AppWorxEnum}
+    values.update(ARG_DEFAULTS)
+    values.update(
+        TNS_SERVICE_NAME="FAKEDB",
+        CONFIG_FILE_PATH="zoe_fakedb.yaml",
+        OUTPUT_FILE_PATH=os.path.dirname(os.path.abspath(output_file)),
+        OUTPUT_FILE_NAME=os.path.basename(output_file),
+        P2P_SERVER="FAKEDB",
+        P2P_SCHEMA="FAKEDB",
+        MAX_THREADS="4",
+    )
+    values.update({name: str(value) if isinstance(value, int) else value for name, value in args.items()})
+    for name, value in values.items():
+        if name.endswith("_YN") and value is None:
+            values[name] = "N"
+    return SimpleNamespace(args=SimpleNamespace(**values), db_connect=lambda autocommit=False: connect(profile))
+
+
+@contextmanager
+def fake_databases(profile: FakeDbProfile):
+    """points the P2P connect function and the async DNA pool at the stand-ins for the duration of the block"""
+    p2p_connect = zoe.p2p_db_connect_func
+    create_async_pool = zoe.create_dna_pool_async
+    zoe.p2p_db_connect_func = lambda args: connect(profile)
+    zoe.create_dna_pool_async = lambda apwx, size: FakeAsyncPool(profile, size)
+    try:
+        yield
+    finally:
+        zoe.p2p_db_connect_func = p2p_connect
+        zoe.create_dna_pool_async = create_async_pool
+
+
+def run_new_mode(output_file: str, profile: FakeDbProfile, config: Optional[Dict] = None, **args) -> bool:
+    """the full multithreaded NEW path against the stand-in databases, reported as run() reports it;
+    config entries override fake_config()"""
+    apwx = fake_apwx(output_file, profile, **args)
+    script_data = ScriptData(apwx=apwx, dbh=None, config={**fake_config(), **(config or {})})
+    with fake_databases(profile):
+        return run_reported(apwx, script_data, "NEW", output_file,
+                            lambda: zoe.process_new_mode(apwx, script_data, output_file))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="runs NEW mode against local stand-in DNA and P2P databases")
+    parser.add_argument("output_file")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="10k", help="DNA rows per query key")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--pad-bytes", type=int, default=0, help="makes every DNA row this much wider")
+    parser.add_argument("--connect-ms", type=float, default=0.0)
+    parser.add_argument("--execute-ms", type=float, default=0.0)
+    parser.add_argument("--key-execute-ms", action="append", default=[], metavar="KEY=MS",
+                        help="execute latency of one query key instead of --execute-ms, e.g. org=500")
+    parser.add_argument("--fetch-ms", type=float, default=0.0, help="latency of every fetch round-trip")
+    parser.add_argument("--row-us", type=float, default=0.0, help="latency of every row fetched")
+    parser.add_argument("--arg", action="append", default=[], metavar="NAME=VALUE",
+                        help="any other zoe argument, e.g. STREAM_YN=Y or FORMAT_WORKERS=2")
+    args = parser.parse_args()
+    for pair in args.key_execute_ms:
+        if pair.split("=", 1)[0] not in QUERY_KEYS or "=" not in pair:
+            parser.error(f"--key-execute-ms needs KEY=MS with KEY one of {', '.join(QUERY_KEYS)}, got {pair!r}")
+
+    profile = FakeDbProfile(
+        rows=SCALES[args.scale],
+        seed=args.seed,
+        pad_bytes=args.pad_bytes,
+        connect_secs=args.connect_ms / 1000,
+        execute_secs=args.execute_ms / 1000,
+        key_execute_secs={
+            key: float(ms) / 1000 for key, ms in (pair.split("=", 1) for pair in args.key_execute_ms)
+        },
+        fetch_secs=args.fetch_ms / 1000,
+        row_secs=args.row_us / 1000000,
+    )
+    extra = dict(arg.split("=", 1) for arg in args.arg)
+    start = time.perf_counter()
+    result = run_new_mode(args.output_file, profile, MAX_THREADS=str(args.threads), **extra)
+    print(f"NEW mode against the stand-in databases took {time.perf_counter() - start:.2f}s, result {result}")
+
+
+if __name__ == "__main__":
+    main()
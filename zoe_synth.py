@@ -0,0 +1,97 @@
+import argparse
+import os
+import random
+from typing import Iterator, List
+
+from zoe import P2PCustomerIndex, ZoeLoadWriter, format_record_batch
+
+SCALES = {"10k": 10_000, "1m": 1_000_000, "10m": 10_000_000}
+ROW_WIDTH = 50
+PERSNBR_BASE = 1_000_000
+ID_SAMPLES = [
+    "DL:{n}:NC:USA:D{n:07d}:20300101",
+    "PP:{n}:XX:CAN:P{n:07d}:20310101|DL:{n}:NC:USA:D{n:07d}:20300101",
+    "TX:{n}:ON:MEX:M{n:07d}:20320101",
+    "",
+]
+
+
+def synth_dna_rows(count: int, seed: int = 0, change_rate: float = 0.0, start: int = 0,
+                   partitions: int = 1, partition: int = 0) -> Iterator[tuple]:
+    """yields 'count' DNA result rows, ROW_WIDTH columns wide, the same for the same seed; with change_rate,
+    that share of rows gets a different value in one column, so two runs with different rates look like the
+    extracts of consecutive days. Every row is seeded on its own, so the slice of rows with
+    n % partitions == partition is generated without the others."""
+    for n in range(start + (partition - start) % partitions, start + count, partitions):
+        rnd = random.Random(seed * 1_000_003 + n)
+        row = [f"{n:010d}", PERSNBR_BASE + n]
+        row += [f"NAME{rnd.randrange(100000)}", f"{rnd.randrange(1, 9999)} MAIN ST", None, "RALEIGH", "NC"]
+        row += [f"{rnd.randrange(27000, 28999)}", "USA", rnd.choice(["M", "F", None]), f"19{rnd.randrange(40, 99)}0101"]
+        row += [f"919555{rnd.randrange(10000):04d}", None, f"user{n}@example.com", "Y", "N"]
+        row.append(rnd.choice(ID_SAMPLES).format(n=n) if rnd.random() < 0.9 else None)
+        row += [rnd.randrange(1000) for _ in range(6)]
+        row.append(f"919555{rnd.randrange(10000):04d}")
+        row += [rnd.choice(["A", "B", "C", None, "VALUE"]) for _ in range(ROW_WIDTH - len(row))]
+        # drawn after the row, so a row that does not change is the same at every rate
+        if change_rate and rnd.random() < change_rate:
+            row[4] = f"APT {rnd.randrange(1000)}"
+        yield tuple(row)
+
+
+def synth_p2p_customers(count: int, seed: int = 0, share: float = 0.3) -> P2PCustomerIndex:
+    """P2P customers for about 'share' of the persons of synth_dna_rows(count)"""
+    rnd = random.Random(seed)
+    rows = []
+    for n in range(count):
+        if rnd.random() < share:
+            rows.append((
+                PERSNBR_BASE + n,
+                f"CXC{n:09d}",
+                f"p2p{n}@example.com" if rnd.random() < 0.7 else "",
+                f"704555{rnd.randrange(10000):04d}" if rnd.random() < 0.5 else None,
+            ))
+    return P2PCustomerIndex(["persnbr", "CXCCustomerID", "registeredEmail", "registeredPhone"], rows)
+
+
+def synth_zoe_records(count: int, seed: int = 0, change_rate: float = 0.0, batch_size: int = 10000) -> Iterator[List[str]]:
+    """yields batches of formatted detail record lines for synth_dna_rows(count)"""
+    p2p_cust = synth_p2p_customers(count, seed)
+    batch = []
+    for row in synth_dna_rows(count, seed, change_rate):
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield format_record_batch(batch, p2p_cust, False)
+            batch = []
+    if batch:
+        yield format_record_batch(batch, p2p_cust, False)
+
+
+def write_synth_zoe_file(file_path: str, count: int, seed: int = 0, change_rate: float = 0.0,
+                         test_yn: str = "Y") -> str:
+    """writes a LOAD file of 'count' synthetic records the way NEW mode does, in batches"""
+    with open(file_path, "w", encoding="utf-8") as f:
+        zoe_writer = ZoeLoadWriter(f, test_yn)
+        zoe_writer.write_header()
+        for lines in synth_zoe_records(count, seed, change_rate):
+            zoe_writer.write_records(lines)
+        zoe_writer.write_trailer(None)
+    return file_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="writes seeded synthetic ZOE LOAD files")
+    parser.add_argument("output_dir")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="10k")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--change-rate", type=float, default=0.01, help="share of records changed in the new file")
+    args = parser.parse_args()
+    count = SCALES[args.scale]
+    old_path = write_synth_zoe_file(os.path.join(args.output_dir, f"zoe_{args.scale}_old.txt"), count, args.seed)
+    new_path = write_synth_zoe_file(
+        os.path.join(args.output_dir, f"zoe_{args.scale}_new.txt"), count, args.seed, args.change_rate
+    )
+    print(f"wrote {old_path} and {new_path} ({count} records each)")
+
+
+if __name__ == "__main__":
+    main()